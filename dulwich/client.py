@@ -21,6 +21,7 @@
 
 __docformat__ = 'restructuredText'
 
+import itertools
 import os
 import select
 import socket
@@ -28,9 +29,11 @@ import subprocess
 
 from dulwich.errors import (
     ChecksumMismatch,
+    GitProtocolError,
     HangupException,
     )
 from dulwich.protocol import (
+    DELIM_PKT,
     Protocol,
     TCP_GIT_PORT,
     ZERO_SHA,
@@ -48,6 +51,16 @@ def _fileno_can_read(fileno):
 
 CAPABILITIES = ["multi_ack", "side-band-64k", "ofs-delta"]
 
+# Number of haves sent before the first flush. Later windows are twice as
+# large, up to PIPESAFE_FLUSH, which is small enough that neither side can
+# block writing while the other is also writing.
+INITIAL_FLUSH = 16
+PIPESAFE_FLUSH = 32
+
+# Give up after this many haves without a new common commit, once some have
+# been found.
+MAX_IN_VAIN = 256
+
 
 class GitClient(object):
     """Git smart server client.
@@ -55,7 +68,7 @@ class GitClient(object):
     """
 
     def __init__(self, can_read, read, write, thin_packs=True, 
-        report_activity=None):
+        report_activity=None, protocol_version=0):
         """Create a new GitClient instance.
 
         :param can_read: Function that returns True if there is data available
@@ -65,9 +78,13 @@ class GitClient(object):
         :param thin_packs: Whether or not thin packs should be retrieved
         :param report_activity: Optional callback for reporting transport
             activity.
+        :param protocol_version: Version of the protocol to ask the server
+            for when fetching; servers that don't support version 2 answer
+            with version 0
         """
         self.proto = Protocol(read, write, report_activity)
         self._can_read = can_read
+        self._protocol_version = protocol_version
         self._capabilities = list(CAPABILITIES)
         if thin_packs:
             self._capabilities.append("thin-pack")
@@ -76,10 +93,13 @@ class GitClient(object):
         return " ".join(self._capabilities)
 
     def read_refs(self):
+        return self._read_refs(self.proto.read_pkt_seq())
+
+    def _read_refs(self, pkts):
         server_capabilities = None
         refs = {}
         # Receive refs from server
-        for pkt in self.proto.read_pkt_seq():
+        for pkt in pkts:
             (sha, ref) = pkt.rstrip("\n").split(" ", 1)
             if server_capabilities is None:
                 (ref, server_capabilities) = extract_capabilities(ref)
@@ -132,7 +152,8 @@ class GitClient(object):
 
         return new_refs
 
-    def fetch(self, path, target, determine_wants=None, progress=None):
+    def fetch(self, path, target, determine_wants=None, progress=None,
+              depth=None, filter_spec=None, ref_prefix=None):
         """Fetch into a target repository.
 
         :param path: Path to fetch from
@@ -140,64 +161,368 @@ class GitClient(object):
         :param determine_wants: Optional function to determine what refs 
             to fetch
         :param progress: Optional progress function
+        :param depth: Optional number of commits to fetch on each line of
+            history, making the target a shallow clone
+        :param filter_spec: Optional filter spec for a partial clone, such as
+            'blob:none'. Objects left out by the server are not fetched later
+            on, so the target will be missing them.
+        :param ref_prefix: Optional list of prefixes of the refs to fetch, see
+            fetch_pack()
         :return: remote refs
         """
         if determine_wants is None:
             determine_wants = target.object_store.determine_wants_all
+        graph_walker = target.get_graph_walker()
         f, commit = target.object_store.add_pack()
         try:
-            return self.fetch_pack(path, determine_wants, 
-                target.get_graph_walker(), f.write, progress)
+            refs = self.fetch_pack(path, determine_wants, graph_walker,
+                                   f.write, progress, depth, filter_spec,
+                                   ref_prefix)
         finally:
             commit()
+        # Only record the new shallow commits once the pack is in place
+        old_shallow = target.get_shallow()
+        if graph_walker.shallow != old_shallow:
+            target.update_shallow(graph_walker.shallow - old_shallow,
+                                  old_shallow - graph_walker.shallow)
+        return refs
+
+    def _read_section(self):
+        """Iterate over the pkt-lines up to a flush-pkt or delim-pkt."""
+        pkt = self.proto.read_pkt_line()
+        while pkt and pkt is not DELIM_PKT:
+            yield pkt
+            pkt = self.proto.read_pkt_line()
+
+    def _read_shallow_updates(self, graph_walker):
+        """Read the changes the server made to the shallow commits."""
+        new_shallow = set()
+        new_unshallow = set()
+        for pkt in self._read_section():
+            parts = pkt.rstrip("\n").split(" ")
+            if len(parts) != 2:
+                raise GitProtocolError("Expected shallow or unshallow, got %r"
+                                       % pkt)
+            if parts[0] == "shallow":
+                new_shallow.add(parts[1])
+            elif parts[0] == "unshallow":
+                new_unshallow.add(parts[1])
+            else:
+                raise GitProtocolError("Expected shallow or unshallow, got %r"
+                                       % pkt)
+        graph_walker.update_shallow(new_shallow, new_unshallow)
+
+    def _read_ack(self, graph_walker):
+        """Read an ACK or NAK from the server.
+
+        :return: None for a NAK, otherwise the status of the ACK, which is
+            the empty string for a final ACK.
+        """
+        pkt = self.proto.read_pkt_line()
+        parts = pkt.rstrip("\n").split(" ")
+        if parts[0] == "NAK":
+            return None
+        if parts[0] != "ACK":
+            raise GitProtocolError("Expected ACK or NAK, got %r" % pkt)
+        graph_walker.ack(parts[1])
+        if len(parts) < 3:
+            return ""
+        return parts[2]
+
+    def _negotiate(self, graph_walker, multi_ack):
+        """Tell the server which commits we have.
+
+        Haves are sent in flush-terminated windows, and the answers to a
+        window are only read after the next window has been sent, so the
+        server always has haves to work on. The negotiation stops once the
+        server is ready to send a pack or, once some commits are known to be
+        common, after MAX_IN_VAIN haves without finding more.
+
+        :param graph_walker: Object with next() and ack().
+        :param multi_ack: Whether the multi_ack capability is in use
+        """
+        count = 0
+        flush_at = INITIAL_FLUSH
+        # Windows sent whose answers haven't been read yet
+        flushes = 0
+        in_vain = 0
+        found_common = False
+        finished = False
+        have = graph_walker.next()
+        while have and not finished:
+            self.proto.write_pkt_line("have %s\n" % have)
+            count += 1
+            in_vain += 1
+            if count >= flush_at:
+                self.proto.write_pkt_line(None)
+                flushes += 1
+                if count < PIPESAFE_FLUSH:
+                    flush_at = count * 2
+                else:
+                    flush_at = count + PIPESAFE_FLUSH
+                if count == INITIAL_FLUSH:
+                    # Stay one window ahead of the server
+                    have = graph_walker.next()
+                    continue
+                status = self._read_ack(graph_walker)
+                while status is not None:
+                    found_common = True
+                    if status == "":
+                        # Single ack: the server won't say anything else
+                        flushes = 0
+                        multi_ack = False
+                        finished = True
+                        break
+                    in_vain = 0
+                    if status == "ready":
+                        finished = True
+                    status = self._read_ack(graph_walker)
+                else:
+                    flushes -= 1
+                if found_common and in_vain > MAX_IN_VAIN:
+                    break
+            if not finished:
+                have = graph_walker.next()
+        self.proto.write_pkt_line("done\n")
+        if not found_common:
+            # Expect a NAK in reply to the done
+            multi_ack = False
+            flushes += 1
+        while flushes or multi_ack:
+            status = self._read_ack(graph_walker)
+            if status is None:
+                flushes -= 1
+            elif status == "":
+                break
+            else:
+                multi_ack = True
+
+    def _read_pack_data(self, pack_data, progress):
+        """Read a pack sent on the side-band."""
+        for pkt in self._read_section():
+            channel = ord(pkt[0])
+            pkt = pkt[1:]
+            if channel == 1:
+                pack_data(pkt)
+            elif channel == 2:
+                progress(pkt)
+            else:
+                raise AssertionError("Invalid sideband channel %d" % channel)
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-                   progress):
+                   progress, depth=None, filter_spec=None, ref_prefix=None):
         """Retrieve a pack from a git smart server.
 
         :param determine_wants: Callback that returns list of commits to fetch
-        :param graph_walker: Object with next() and ack().
+        :param graph_walker: Object with next() and ack(). If it has a
+            shallow attribute, the commits in it are reported to the server
+            as shallow, and it needs an update_shallow() method for depth.
         :param pack_data: Callback called for each bit of data in the pack
         :param progress: Callback for progress reports (strings)
+        :param depth: Optional number of commits to fetch on each line of
+            history
+        :param filter_spec: Optional filter spec for a partial clone; like
+            git, it is ignored if the server doesn't support filters
+        :param ref_prefix: Optional list of prefixes of the refs to fetch.
+            With protocol version 2 only the refs that start with one of them
+            are listed by the server, so determine_wants may not see the
+            others; with version 0 the server always sends all refs.
         """
-        (refs, server_capabilities) = self.read_refs()
+        if self._protocol_version == 2:
+            pkt = self.proto.read_pkt_line()
+            if pkt == "version 2\n":
+                server_capabilities = self._read_v2_capabilities()
+                return self._fetch_pack_v2(server_capabilities,
+                    determine_wants, graph_walker, pack_data, progress,
+                    depth, filter_spec, ref_prefix)
+            # The server only speaks version 0; the pkt-line is the first ref
+            if pkt is None:
+                pkts = []
+            else:
+                pkts = itertools.chain([pkt], self.proto.read_pkt_seq())
+            (refs, server_capabilities) = self._read_refs(pkts)
+        else:
+            (refs, server_capabilities) = self.read_refs()
         wants = determine_wants(refs)
         if not wants:
             self.proto.write_pkt_line(None)
             return refs
         assert isinstance(wants, list) and type(wants[0]) == str
-        self.proto.write_pkt_line("want %s %s\n" % (wants[0], self.capabilities()))
+        capabilities = list(self._capabilities)
+        if "multi_ack_detailed" in server_capabilities:
+            capabilities.append("multi_ack_detailed")
+        shallow = getattr(graph_walker, "shallow", None)
+        if shallow or depth is not None:
+            if "shallow" not in server_capabilities:
+                raise GitProtocolError(
+                    "Server does not support shallow clients")
+            capabilities.append("shallow")
+        if filter_spec is not None and "filter" in server_capabilities:
+            capabilities.append("filter")
+        else:
+            filter_spec = None
+        self.proto.write_pkt_line("want %s %s\n" % (wants[0],
+                                                    " ".join(capabilities)))
         for want in wants[1:]:
             self.proto.write_pkt_line("want %s\n" % want)
+        for sha in sorted(shallow or []):
+            self.proto.write_pkt_line("shallow %s\n" % sha)
+        if depth is not None:
+            self.proto.write_pkt_line("deepen %d\n" % depth)
+        if filter_spec is not None:
+            self.proto.write_pkt_line("filter %s\n" % filter_spec)
+        self.proto.write_pkt_line(None)
+        if depth is not None:
+            self._read_shallow_updates(graph_walker)
+        self._negotiate(graph_walker, "multi_ack" in capabilities and
+                        "multi_ack" in server_capabilities)
+        self._read_pack_data(pack_data, progress)
+        return refs
+
+    def _read_v2_capabilities(self):
+        """Read the capabilities of a protocol version 2 server.
+
+        :return: Dictionary mapping the names of the capabilities to their
+            values, which are None for capabilities without a value
+        """
+        server_capabilities = {}
+        for pkt in self.proto.read_pkt_seq():
+            line = pkt.rstrip("\n")
+            if "=" in line:
+                name, value = line.split("=", 1)
+            else:
+                name, value = line, None
+            server_capabilities[name] = value
+        return server_capabilities
+
+    def _send_v2_command(self, command, args):
+        """Send a command to a protocol version 2 server.
+
+        :param command: Name of the command
+        :param args: List of pkt-lines with the arguments of the command
+        """
+        self.proto.write_pkt_line("command=%s\n" % command)
+        self.proto.write_pkt_line(DELIM_PKT)
+        for arg in args:
+            self.proto.write_pkt_line(arg)
         self.proto.write_pkt_line(None)
+
+    def _ls_refs(self, ref_prefix):
+        """List the refs of a protocol version 2 server.
+
+        :param ref_prefix: Optional list of prefixes of the refs to list
+        :return: Dictionary with the refs, including the peeled values of tags
+            as refs with a ^{} suffix, like in a version 0 advertisement
+        """
+        args = ["peel\n"]
+        for prefix in ref_prefix or []:
+            args.append("ref-prefix %s\n" % prefix)
+        self._send_v2_command("ls-refs", args)
+        refs = {}
+        for pkt in self.proto.read_pkt_seq():
+            fields = pkt.rstrip("\n").split(" ")
+            if len(fields) < 2:
+                raise GitProtocolError("Invalid ref line %r" % pkt)
+            sha, name = fields[:2]
+            refs[name] = sha
+            for attribute in fields[2:]:
+                if attribute.startswith("peeled:"):
+                    refs[name + "^{}"] = attribute[len("peeled:"):]
+        return refs
+
+    def _fetch_pack_v2(self, server_capabilities, determine_wants,
+                       graph_walker, pack_data, progress, depth, filter_spec,
+                       ref_prefix):
+        """Retrieve a pack from a protocol version 2 server.
+
+        The server keeps no state between the fetch requests of a
+        negotiation, so each of them repeats the arguments and the commits
+        known to be common, followed by a window of new haves.
+        """
+        if "ls-refs" not in server_capabilities:
+            raise GitProtocolError("Server does not support ls-refs")
+        if "fetch" not in server_capabilities:
+            raise GitProtocolError("Server does not support fetch")
+        fetch_features = (server_capabilities["fetch"] or "").split(" ")
+        refs = self._ls_refs(ref_prefix)
+        wants = determine_wants(refs)
+        if not wants:
+            self.proto.write_pkt_line(None)
+            return refs
+        args = []
+        for capability in ("thin-pack", "ofs-delta"):
+            if capability in self._capabilities:
+                args.append("%s\n" % capability)
+        for want in wants:
+            args.append("want %s\n" % want)
+        shallow = getattr(graph_walker, "shallow", None)
+        if shallow or depth is not None:
+            if "shallow" not in fetch_features:
+                raise GitProtocolError(
+                    "Server does not support shallow clients")
+        for sha in sorted(shallow or []):
+            args.append("shallow %s\n" % sha)
+        if depth is not None:
+            args.append("deepen %d\n" % depth)
+        if filter_spec is not None and "filter" in fetch_features:
+            args.append("filter %s\n" % filter_spec)
+
+        common = []
+        flush_at = INITIAL_FLUSH
+        in_vain = 0
         have = graph_walker.next()
-        while have:
-            self.proto.write_pkt_line("have %s\n" % have)
-            if self._can_read():
-                pkt = self.proto.read_pkt_line()
+        while True:
+            haves = []
+            while have and len(haves) < flush_at:
+                haves.append(have)
+                have = graph_walker.next()
+            in_vain += len(haves)
+            done = not have or (len(common) > 0 and in_vain > MAX_IN_VAIN)
+            request = args + ["have %s\n" % sha for sha in common + haves]
+            if done:
+                request.append("done\n")
+            self._send_v2_command("fetch", request)
+            if done:
+                break
+            pkt = self.proto.read_pkt_line()
+            if pkt != "acknowledgments\n":
+                raise GitProtocolError("Expected acknowledgments, got %r" %
+                                       pkt)
+            ready = False
+            pkt = self.proto.read_pkt_line()
+            while pkt and pkt is not DELIM_PKT:
                 parts = pkt.rstrip("\n").split(" ")
-                if parts[0] == "ACK":
+                if parts[0] == "ACK" and len(parts) == 2:
                     graph_walker.ack(parts[1])
-                    assert parts[2] == "continue"
-            have = graph_walker.next()
-        self.proto.write_pkt_line("done\n")
-        pkt = self.proto.read_pkt_line()
-        while pkt:
-            parts = pkt.rstrip("\n").split(" ")
-            if parts[0] == "ACK":
-                graph_walker.ack(pkt.split(" ")[1])
-            if len(parts) < 3 or parts[2] != "continue":
+                    if parts[1] not in common:
+                        common.append(parts[1])
+                        in_vain = 0
+                elif parts[0] == "ready":
+                    ready = True
+                elif parts[0] != "NAK":
+                    raise GitProtocolError("Expected ACK or NAK, got %r" % pkt)
+                pkt = self.proto.read_pkt_line()
+            if ready:
+                if pkt is not DELIM_PKT:
+                    raise GitProtocolError("Expected a packfile after ready")
                 break
-            pkt = self.proto.read_pkt_line()
-        for pkt in self.proto.read_pkt_seq():
-            channel = ord(pkt[0])
-            pkt = pkt[1:]
-            if channel == 1:
-                pack_data(pkt)
-            elif channel == 2:
-                progress(pkt)
+            if flush_at < PIPESAFE_FLUSH:
+                flush_at *= 2
+
+        pkt = self.proto.read_pkt_line()
+        while pkt != "packfile\n":
+            if pkt == "shallow-info\n":
+                self._read_shallow_updates(graph_walker)
+            elif pkt is None:
+                raise GitProtocolError("Server sent no packfile")
             else:
-                raise AssertionError("Invalid sideband channel %d" % channel)
+                # Skip sections we didn't ask for
+                for pkt in self._read_section():
+                    pass
+            pkt = self.proto.read_pkt_line()
+        self._read_pack_data(pack_data, progress)
+        # End the session
+        self.proto.write_pkt_line(None)
         return refs
 
 
@@ -222,7 +547,8 @@ class TCPGitClient(GitClient):
         self.proto.send_cmd("git-receive-pack", path, "host=%s" % self.host)
         return super(TCPGitClient, self).send_pack(path, changed_refs, generate_pack_contents)
 
-    def fetch_pack(self, path, determine_wants, graph_walker, pack_data, progress):
+    def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
+                   progress, depth=None, filter_spec=None, ref_prefix=None):
         """Fetch a pack from the remote host.
         
         :param path: Path of the reposiutory on the remote host
@@ -231,10 +557,18 @@ class TCPGitClient(GitClient):
         :param graph_walker: GraphWalker instance used to find missing shas
         :param pack_data: Callback for writing pack data
         :param progress: Callback for writing progress
+        :param depth: Optional number of commits to fetch on each line of
+            history
+        :param filter_spec: Optional filter spec for a partial clone
+        :param ref_prefix: Optional list of prefixes of the refs to fetch
         """
-        self.proto.send_cmd("git-upload-pack", path, "host=%s" % self.host)
+        args = ["host=%s" % self.host]
+        if self._protocol_version == 2:
+            # Extra parameters follow an empty argument
+            args.extend(["", "version=2"])
+        self.proto.send_cmd("git-upload-pack", path, *args)
         return super(TCPGitClient, self).fetch_pack(path, determine_wants,
-            graph_walker, pack_data, progress)
+            graph_walker, pack_data, progress, depth, filter_spec, ref_prefix)
 
 
 class SubprocessGitClient(GitClient):
@@ -245,17 +579,22 @@ class SubprocessGitClient(GitClient):
         self._args = args
         self._kwargs = kwargs
 
-    def _connect(self, service, *args, **kwargs):
-        argv = [service] + list(args)
-        self.proc = subprocess.Popen(argv, bufsize=0,
+    def _connect(self, service, path):
+        env = None
+        if (service == "git-upload-pack" and
+            self._kwargs.get("protocol_version", 0) == 2):
+            env = dict(os.environ)
+            env["GIT_PROTOCOL"] = "version=2"
+        self.proc = subprocess.Popen([service, path], bufsize=0,
                                 stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
+                                stdout=subprocess.PIPE, env=env)
         def read_fn(size):
             return self.proc.stdout.read(size)
         def write_fn(data):
             self.proc.stdin.write(data)
             self.proc.stdin.flush()
-        return GitClient(lambda: _fileno_can_read(self.proc.stdout.fileno()), read_fn, write_fn, *args, **kwargs)
+        return GitClient(lambda: _fileno_can_read(self.proc.stdout.fileno()),
+                         read_fn, write_fn, *self._args, **self._kwargs)
 
     def send_pack(self, path, changed_refs, generate_pack_contents):
         """Upload a pack to the server.
@@ -269,7 +608,7 @@ class SubprocessGitClient(GitClient):
         return client.send_pack(path, changed_refs, generate_pack_contents)
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data, 
-        progress):
+        progress, depth=None, filter_spec=None, ref_prefix=None):
         """Retrieve a pack from the server
 
         :param path: Path to the git repository on the server
@@ -278,10 +617,14 @@ class SubprocessGitClient(GitClient):
         :param graph_walker: GraphWalker instance
         :param pack_data: Function that can write pack data
         :param progress: Function that can write progress texts
+        :param depth: Optional number of commits to fetch on each line of
+            history
+        :param filter_spec: Optional filter spec for a partial clone
+        :param ref_prefix: Optional list of prefixes of the refs to fetch
         """
         client = self._connect("git-upload-pack", path)
         return client.fetch_pack(path, determine_wants, graph_walker, pack_data,
-                                 progress)
+                                 progress, depth, filter_spec, ref_prefix)
 
 
 class SSHSubprocess(object):
@@ -336,11 +679,13 @@ class SSHGitClient(GitClient):
         return client.send_pack(path, determine_wants, generate_pack_contents)
 
     def fetch_pack(self, path, determine_wants, graph_walker, pack_data,
-        progress):
+        progress, depth=None, filter_spec=None, ref_prefix=None):
+        # The ssh command line can't pass GIT_PROTOCOL to the server, so the
+        # server answers with protocol version 0
         remote = get_ssh_vendor().connect_ssh(self.host, ["git-upload-pack '%s'" % path], port=self.port, username=self.username)
         client = GitClient(lambda: _fileno_can_read(remote.proc.stdout.fileno()), remote.recv, remote.send, *self._args, **self._kwargs)
         return client.fetch_pack(path, determine_wants, graph_walker, pack_data,
-                                 progress)
+                                 progress, depth, filter_spec, ref_prefix)
 
 
 def get_transport_and_path(uri):
@@ -0,0 +1,557 @@
+# commit_graph.py -- Reading and writing git commit-graph files
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing of git commit-graph files.
+
+A commit-graph file contains the parents, root tree, commit time and
+generation number of a set of commits in a compact table, so that history
+can be walked without inflating and parsing the commit objects.
+
+The file consists of a header, a table of contents listing the chunks in
+the file and the chunks themselves:
+
+ * OIDF: fan-out table with 256 entries, like in pack indexes
+ * OIDL: the sorted binary SHA1s of the commits
+ * CDAT: for each commit the root tree, the positions of the first two
+   parents, the generation number and the commit time
+ * EDGE: positions of the remaining parents of octopus merges
+ * BIDX, BDAT: optional changed-path Bloom filters; for each commit a
+   Bloom filter of the paths that changed compared to its first parent
+
+Followed by a SHA1 checksum of the preceding contents.
+"""
+
+import struct
+
+from dulwich.errors import (
+    MissingCommitError,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    Commit,
+    Tag,
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+
+COMMIT_GRAPH_SIGNATURE = "CGPH"
+COMMIT_GRAPH_VERSION = 1
+HASH_VERSION_SHA1 = 1
+
+CHUNK_OID_FANOUT = "OIDF"
+CHUNK_OID_LOOKUP = "OIDL"
+CHUNK_COMMIT_DATA = "CDAT"
+CHUNK_EXTRA_EDGES = "EDGE"
+CHUNK_BLOOM_INDEXES = "BIDX"
+CHUNK_BLOOM_DATA = "BDAT"
+
+# Parent position used for commits with fewer than two parents.
+GRAPH_PARENT_NONE = 0x70000000
+# Set on the second parent position if it points into the EDGE chunk, and
+# on the last entry for a commit in the EDGE chunk.
+GRAPH_EXTRA_EDGES_NEEDED = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+COMMIT_DATA_SIZE = 20 + 4 + 4 + 8
+
+# Settings for changed-path Bloom filters, as used by C git.
+BLOOM_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGED_PATHS = 512
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+BLOOM_HEADER_SIZE = 12
+
+
+def _rotate_left(value, count):
+    return ((value << count) | (value >> (32 - count))) & 0xffffffff
+
+
+def murmur3_32(seed, data):
+    """Calculate the 32-bit murmur3 hash of a string.
+
+    This matches version 1 of the changed-path Bloom filters in C git,
+    which sign-extends bytes with the high bit set.
+
+    :param seed: Seed for the hash
+    :param data: String to hash
+    :return: The hash, as an unsigned 32-bit integer
+    """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    def byte(i):
+        b = ord(data[i])
+        if b & 0x80:
+            b |= 0xffffff00
+        return b
+    length = len(data)
+    for i in range(0, length - length % 4, 4):
+        k = (byte(i) | (byte(i+1) << 8) | (byte(i+2) << 16) |
+             (byte(i+3) << 24)) & 0xffffffff
+        k = (k * c1) & 0xffffffff
+        k = _rotate_left(k, 15)
+        k = (k * c2) & 0xffffffff
+        seed ^= k
+        seed = (_rotate_left(seed, 13) * 5 + 0xe6546b64) & 0xffffffff
+    tail = length - length % 4
+    k = 0
+    if length % 4 >= 3:
+        k ^= byte(tail+2) << 16
+    if length % 4 >= 2:
+        k ^= byte(tail+1) << 8
+    if length % 4 >= 1:
+        k ^= byte(tail)
+        k = (k * c1) & 0xffffffff
+        k = _rotate_left(k, 15)
+        k = (k * c2) & 0xffffffff
+        seed ^= k
+    seed ^= length
+    seed ^= seed >> 16
+    seed = (seed * 0x85ebca6b) & 0xffffffff
+    seed ^= seed >> 13
+    seed = (seed * 0xc2b2ae35) & 0xffffffff
+    seed ^= seed >> 16
+    return seed
+
+
+def bloom_key(path):
+    """Return the bit hashes for a path in a changed-path Bloom filter."""
+    hash0 = murmur3_32(BLOOM_SEED0, path)
+    hash1 = murmur3_32(BLOOM_SEED1, path)
+    return [(hash0 + i * hash1) & 0xffffffff
+            for i in range(BLOOM_NUM_HASHES)]
+
+
+def bloom_filter_contains(data, key):
+    """Check whether a Bloom filter may contain a key.
+
+    :param data: Contents of the Bloom filter
+    :param key: Hashes of the key, as returned by bloom_key()
+    :return: False if the key is definitely not in the filter
+    """
+    num_bits = len(data) * 8
+    if not num_bits:
+        return True
+    for h in key:
+        pos = h % num_bits
+        if not ord(data[pos // 8]) & (1 << (pos % 8)):
+            return False
+    return True
+
+
+def make_bloom_filter(paths):
+    """Create a changed-path Bloom filter.
+
+    :param paths: Paths of the changed files. Their parent directories are
+        added to the filter as well.
+    :return: Contents of the Bloom filter
+    """
+    if len(paths) > BLOOM_MAX_CHANGED_PATHS:
+        return "\xff"
+    keys = set()
+    for path in paths:
+        while path:
+            keys.add(path)
+            path = path.rpartition("/")[0]
+    if len(keys) > BLOOM_MAX_CHANGED_PATHS:
+        return "\xff"
+    num_bytes = (len(keys) * BLOOM_BITS_PER_ENTRY + 7) // 8
+    if not num_bytes:
+        return "\0"
+    data = [0] * num_bytes
+    num_bits = num_bytes * 8
+    for path in keys:
+        for h in bloom_key(path):
+            pos = h % num_bits
+            data[pos // 8] |= 1 << (pos % 8)
+    return "".join(map(chr, data))
+
+
+class CommitGraph(object):
+    """A commit-graph file."""
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Open a commit-graph file.
+
+        :param filename: Path to the commit-graph file
+        :param file: Optional file-like object to read from
+        :param contents: Optional contents of the file
+        :param size: Optional size of the contents
+        """
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        self._read_header()
+
+    def _read_header(self):
+        if self._contents[:4] != COMMIT_GRAPH_SIGNATURE:
+            raise AssertionError("%s is not a commit-graph file" %
+                                 self._filename)
+        (version, hash_version, num_chunks, num_base_graphs) = struct.unpack(
+            ">BBBB", self._contents[4:8])
+        if version != COMMIT_GRAPH_VERSION:
+            raise AssertionError("Unsupported commit-graph version %d" %
+                                 version)
+        if hash_version != HASH_VERSION_SHA1:
+            raise AssertionError("Unsupported commit-graph hash version %d" %
+                                 hash_version)
+        self._chunks = {}
+        for i in range(num_chunks):
+            entry = 8 + i * 12
+            chunk_id = str(self._contents[entry:entry+4])
+            (offset,) = struct.unpack(">Q", self._contents[entry+4:entry+12])
+            self._chunks[chunk_id] = offset
+        for chunk_id in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP,
+                         CHUNK_COMMIT_DATA):
+            if chunk_id not in self._chunks:
+                raise AssertionError("commit-graph chunk %s missing" %
+                                     chunk_id)
+        fanout = self._chunks[CHUNK_OID_FANOUT]
+        self._fan_out_table = struct.unpack(">256L",
+            self._contents[fanout:fanout+256*4])
+        self._oid_lookup = self._chunks[CHUNK_OID_LOOKUP]
+        self._commit_data = self._chunks[CHUNK_COMMIT_DATA]
+        self._extra_edges = self._chunks.get(CHUNK_EXTRA_EDGES)
+        self._bloom_indexes = self._chunks.get(CHUNK_BLOOM_INDEXES)
+        self._bloom_data = self._chunks.get(CHUNK_BLOOM_DATA)
+        if self._bloom_data is not None:
+            (version, num_hashes, bits_per_entry) = struct.unpack(">LLL",
+                self._contents[self._bloom_data:self._bloom_data+12])
+            if version != BLOOM_VERSION or num_hashes != BLOOM_NUM_HASHES:
+                # Filters computed with other settings can not be used
+                self._bloom_indexes = self._bloom_data = None
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        """Return the number of commits in the commit-graph."""
+        return self._fan_out_table[-1]
+
+    def _unpack_name(self, i):
+        offset = self._oid_lookup + i * 20
+        return str(self._contents[offset:offset+20])
+
+    def __iter__(self):
+        """Iterate over the hex SHA1s of the commits in the commit-graph."""
+        for i in xrange(len(self)):
+            yield sha_to_hex(self._unpack_name(i))
+
+    def _position(self, sha):
+        """Find the position of a commit in the commit-graph.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :return: Position of the commit, or None if it is not present
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        idx = ord(sha[0])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        if start == end:
+            return None
+        return bisect_find_sha(start, end-1, sha, self._unpack_name)
+
+    def __contains__(self, sha):
+        return self._position(sha) is not None
+
+    def _get_position(self, sha):
+        i = self._position(sha)
+        if i is None:
+            raise KeyError(sha)
+        return i
+
+    def _unpack_commit_data(self, i):
+        offset = self._commit_data + i * COMMIT_DATA_SIZE
+        return struct.unpack(">20sLLLL",
+            self._contents[offset:offset+COMMIT_DATA_SIZE])
+
+    def _get_parent_positions(self, i):
+        (tree, parent1, parent2, gen_time_high,
+            time_low) = self._unpack_commit_data(i)
+        if parent1 == GRAPH_PARENT_NONE:
+            return []
+        if parent2 == GRAPH_PARENT_NONE:
+            return [parent1]
+        if not parent2 & GRAPH_EXTRA_EDGES_NEEDED:
+            return [parent1, parent2]
+        ret = [parent1]
+        offset = self._extra_edges + (parent2 & ~GRAPH_EXTRA_EDGES_NEEDED) * 4
+        while True:
+            (edge,) = struct.unpack(">L", self._contents[offset:offset+4])
+            ret.append(edge & ~GRAPH_LAST_EDGE)
+            if edge & GRAPH_LAST_EDGE:
+                return ret
+            offset += 4
+
+    def get_parents(self, sha):
+        """Return the hex SHA1s of the parents of a commit.
+
+        :raise KeyError: If the commit is not in the commit-graph
+        """
+        return [sha_to_hex(self._unpack_name(p))
+                for p in self._get_parent_positions(self._get_position(sha))]
+
+    def get_tree(self, sha):
+        """Return the hex SHA1 of the root tree of a commit.
+
+        :raise KeyError: If the commit is not in the commit-graph
+        """
+        return sha_to_hex(self._unpack_commit_data(self._get_position(sha))[0])
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :raise KeyError: If the commit is not in the commit-graph
+        """
+        data = self._unpack_commit_data(self._get_position(sha))
+        return ((data[3] & 0x3) << 32) | data[4]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        Commits without parents have generation 1, other commits have a
+        generation one higher than the highest generation of their parents.
+
+        :raise KeyError: If the commit is not in the commit-graph
+        """
+        return self._unpack_commit_data(self._get_position(sha))[3] >> 2
+
+
+    def has_bloom_filters(self):
+        """Check whether this commit-graph has changed-path Bloom filters."""
+        return self._bloom_data is not None
+
+    def get_bloom_filter(self, sha):
+        """Return the changed-path Bloom filter for a commit.
+
+        :return: Contents of the Bloom filter, or None if there is none
+        :raise KeyError: If the commit is not in the commit-graph
+        """
+        i = self._get_position(sha)
+        if self._bloom_data is None:
+            return None
+        if i == 0:
+            start = 0
+        else:
+            offset = self._bloom_indexes + (i - 1) * 4
+            (start,) = struct.unpack(">L", self._contents[offset:offset+4])
+        offset = self._bloom_indexes + i * 4
+        (end,) = struct.unpack(">L", self._contents[offset:offset+4])
+        offset = self._bloom_data + BLOOM_HEADER_SIZE
+        return str(self._contents[offset+start:offset+end])
+
+    def path_maybe_changed(self, sha, path):
+        """Check whether a path may have changed in a commit.
+
+        Only changes compared to the first parent of the commit are recorded.
+
+        :param sha: SHA1 of the commit
+        :param path: Path of a file or directory, without trailing slash
+        :return: False if the path is definitely the same as in the first
+            parent (or does not exist in a root commit), True otherwise
+        """
+        try:
+            data = self.get_bloom_filter(sha)
+        except KeyError:
+            return True
+        if data is None:
+            return True
+        while path:
+            if not bloom_filter_contains(data, bloom_key(path)):
+                return False
+            path = path.rpartition("/")[0]
+        return True
+
+
+def load_commit_graph(path):
+    """Load a commit-graph file.
+
+    :param path: Path to the commit-graph file
+    :return: A CommitGraph
+    """
+    f = GitFile(path, 'rb')
+    return CommitGraph(path, f)
+
+
+def _iter_reachable_commits(object_store, heads):
+    """Iterate over all commits reachable from a set of heads.
+
+    Tags are peeled; heads pointing at other objects are ignored.
+
+    :raise MissingCommitError: if the parent of a commit is missing
+    """
+    todo = [(sha, False) for sha in heads]
+    seen = set()
+    while todo:
+        sha, is_parent = todo.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        try:
+            obj = object_store[sha]
+        except KeyError:
+            if is_parent:
+                raise MissingCommitError(sha)
+            raise
+        if isinstance(obj, Tag):
+            todo.append((obj.object[1], False))
+            continue
+        if not isinstance(obj, Commit):
+            continue
+        yield obj
+        todo.extend((parent, True) for parent in obj.parents)
+
+
+def _changed_paths(object_store, parent_tree, tree):
+    """Return the paths of the files that differ between two trees."""
+    paths = set()
+    for (oldpath, newpath), _, _ in object_store.tree_changes(parent_tree,
+                                                              tree):
+        paths.add(oldpath or newpath)
+    return paths
+
+
+def write_commit_graph(f, object_store, heads, changed_paths=False):
+    """Write a commit-graph file.
+
+    Like git, this refuses to write a commit-graph for a history with
+    missing commits, such as that of a shallow clone: the commit-graph would
+    tell readers that the commits whose parents are missing have none, and
+    that would remain in it after the parents are fetched.
+
+    :param f: File-like object to write to
+    :param object_store: Object store to read the commits from
+    :param heads: SHA1s of the commits (or tags) whose history to include
+    :param changed_paths: Whether to include changed-path Bloom filters
+    :return: Number of commits in the commit-graph
+    :raise MissingCommitError: if the parents of a commit are missing
+    """
+    commits = {}
+    for commit in _iter_reachable_commits(object_store, heads):
+        commits[commit.id] = (commit.tree, commit.parents, commit.commit_time)
+
+    # Compute generation numbers without recursion, so long histories do
+    # not exhaust the stack.
+    generations = {}
+    for sha in commits:
+        todo = [sha]
+        while todo:
+            sha = todo[-1]
+            if sha in generations:
+                todo.pop()
+                continue
+            pending = [p for p in commits[sha][1] if p not in generations]
+            if pending:
+                todo.extend(pending)
+                continue
+            generations[sha] = 1 + max([0] + [generations[p]
+                                              for p in commits[sha][1]])
+            todo.pop()
+
+    names = sorted(hex_to_sha(sha) for sha in commits)
+    positions = {}
+    for i, name in enumerate(names):
+        positions[sha_to_hex(name)] = i
+
+    commit_data = []
+    extra_edges = []
+    for name in names:
+        sha = sha_to_hex(name)
+        tree, parents, commit_time = commits[sha]
+        parent_positions = [positions[p] for p in parents]
+        if not parent_positions:
+            parent1 = parent2 = GRAPH_PARENT_NONE
+        elif len(parent_positions) == 1:
+            parent1 = parent_positions[0]
+            parent2 = GRAPH_PARENT_NONE
+        elif len(parent_positions) == 2:
+            parent1, parent2 = parent_positions
+        else:
+            parent1 = parent_positions[0]
+            parent2 = GRAPH_EXTRA_EDGES_NEEDED | len(extra_edges)
+            extra_edges.extend(parent_positions[1:-1])
+            extra_edges.append(parent_positions[-1] | GRAPH_LAST_EDGE)
+        commit_data.append(struct.pack(">20sLLLL", hex_to_sha(tree),
+            parent1, parent2,
+            (generations[sha] << 2) | ((commit_time >> 32) & 0x3),
+            commit_time & 0xffffffff))
+
+    fan_out_table = [0] * 256
+    for name in names:
+        fan_out_table[ord(name[0])] += 1
+    for i in range(1, 256):
+        fan_out_table[i] += fan_out_table[i-1]
+
+    chunks = [
+        (CHUNK_OID_FANOUT, struct.pack(">256L", *fan_out_table)),
+        (CHUNK_OID_LOOKUP, "".join(names)),
+        (CHUNK_COMMIT_DATA, "".join(commit_data)),
+        ]
+    if extra_edges:
+        chunks.append((CHUNK_EXTRA_EDGES,
+                       struct.pack(">%dL" % len(extra_edges), *extra_edges)))
+    if changed_paths:
+        bloom_indexes = []
+        bloom_data = []
+        end = 0
+        for name in names:
+            tree, parents, commit_time = commits[sha_to_hex(name)]
+            if parents:
+                parent_tree = commits[parents[0]][0]
+            else:
+                parent_tree = None
+            data = make_bloom_filter(
+                _changed_paths(object_store, parent_tree, tree))
+            end += len(data)
+            bloom_indexes.append(end)
+            bloom_data.append(data)
+        chunks.append((CHUNK_BLOOM_INDEXES,
+            struct.pack(">%dL" % len(bloom_indexes), *bloom_indexes)))
+        chunks.append((CHUNK_BLOOM_DATA,
+            struct.pack(">LLL", BLOOM_VERSION, BLOOM_NUM_HASHES,
+                        BLOOM_BITS_PER_ENTRY) + "".join(bloom_data)))
+
+    f = SHA1Writer(f)
+    f.write(COMMIT_GRAPH_SIGNATURE)
+    f.write(struct.pack(">BBBB", COMMIT_GRAPH_VERSION, HASH_VERSION_SHA1,
+                        len(chunks), 0))
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, data in chunks:
+        f.write(chunk_id + struct.pack(">Q", offset))
+        offset += len(data)
+    f.write("\0\0\0\0" + struct.pack(">Q", offset))
+    for chunk_id, data in chunks:
+        f.write(data)
+    f.write_sha()
+    return len(names)
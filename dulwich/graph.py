@@ -0,0 +1,183 @@
+# graph.py -- Queries on the commit graph.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Merge base, ancestry and depth queries on the commit graph.
+
+Commits are painted with the side of the query they are reachable from,
+newest first. Once a commit is reachable from both sides, everything below it
+is of no interest, and the walk stops as soon as only such commits are left.
+When the commits are in a commit-graph, generation numbers order the walk
+exactly and let is_ancestor() stop at the generation of the ancestor.
+
+find_shallow() finds where a history limited to a certain depth is cut off,
+for shallow clones and fetches.
+"""
+
+import heapq
+
+_PARENT1 = 1
+_PARENT2 = 2
+_STALE = 4
+
+_BOTH_PARENTS = _PARENT1 | _PARENT2
+
+# Generation of commits that are not in a commit-graph
+GENERATION_INFINITY = 0xffffffff
+
+
+def _get_generation(graph, sha):
+    if graph is not None:
+        try:
+            return graph.get_generation(sha)
+        except KeyError:
+            pass
+    return GENERATION_INFINITY
+
+
+def _paint_down_to_common(store, one, twos, min_generation=0):
+    """Paint the history of one and twos until their common commits are found.
+
+    :param store: Object store to look up commits in
+    :param one: SHA1 of a commit
+    :param twos: List of SHA1s of commits
+    :param min_generation: Generation below which commits are not visited
+    :return: Tuple with a list of the common commits found, which may include
+        commits that are ancestors of others, and a dictionary mapping
+        visited commits to their flags
+    """
+    graph = store.commit_graph
+    flags = {}
+    queue = []
+    # Number of queued commits that are not stale
+    state = {'counter': 0, 'nonstale': 0}
+
+    def push(sha, flag):
+        flags[sha] = flags.get(sha, 0) | flag
+        state['counter'] += 1
+        if not flag & _STALE:
+            state['nonstale'] += 1
+        heapq.heappush(queue, (-_get_generation(graph, sha),
+                               -store.get_commit_time(sha),
+                               state['counter'], sha, flag & _STALE))
+
+    push(one, _PARENT1)
+    for two in twos:
+        push(two, _PARENT2)
+
+    result = []
+    while state['nonstale']:
+        neg_generation, _, _, sha, queued_stale = heapq.heappop(queue)
+        if not queued_stale:
+            state['nonstale'] -= 1
+        if -neg_generation < min_generation:
+            continue
+        flag = flags[sha] & (_BOTH_PARENTS | _STALE)
+        if flag == _BOTH_PARENTS:
+            if sha not in result:
+                result.append(sha)
+            # Ancestors of a common commit are not interesting
+            flag |= _STALE
+        for parent in store.get_parents(sha):
+            if flags.get(parent, 0) & flag == flag:
+                continue
+            push(parent, flag)
+    return result, flags
+
+
+def is_ancestor(store, ancestor, descendant):
+    """Check whether a commit is an ancestor of another commit.
+
+    A commit is considered to be an ancestor of itself.
+
+    :param store: Object store to look up commits in
+    :param ancestor: SHA1 of the possible ancestor
+    :param descendant: SHA1 of the possible descendant
+    :return: True if ancestor is reachable from descendant
+    """
+    if ancestor == descendant:
+        return True
+    min_generation = _get_generation(store.commit_graph, ancestor)
+    if min_generation == GENERATION_INFINITY:
+        min_generation = 0
+    _, flags = _paint_down_to_common(store, ancestor, [descendant],
+                                     min_generation)
+    return bool(flags.get(ancestor, 0) & _PARENT2)
+
+
+def find_merge_base(store, one, two):
+    """Find the best common ancestors of two commits.
+
+    A best common ancestor is one that is not an ancestor of another common
+    ancestor; criss-cross merges can have more than one.
+
+    :param store: Object store to look up commits in
+    :param one: SHA1 of a commit
+    :param two: SHA1 of another commit
+    :return: List of SHA1s of the merge bases, empty if the commits have no
+        common history
+    """
+    if one == two:
+        return [one]
+    candidates, flags = _paint_down_to_common(store, one, [two])
+    # Candidates that were reached from another one are not the best
+    candidates = [sha for sha in candidates if not flags[sha] & _STALE]
+    if len(candidates) < 2:
+        return candidates
+    # Without reliable ordering, a candidate may have been found before a
+    # descendant that is also a candidate.
+    result = []
+    for i, sha in enumerate(candidates):
+        others = candidates[:i] + candidates[i+1:]
+        redundant = False
+        for other in others:
+            if is_ancestor(store, sha, other):
+                redundant = True
+                break
+        if not redundant:
+            result.append(sha)
+    return result
+
+
+def find_shallow(store, heads, depth):
+    """Find the commits on the edge of a depth-limited history.
+
+    Like git, a commit that can be reached by several paths is placed at the
+    depth of the shortest one.
+
+    :param store: Object store to look up commits in
+    :param heads: SHA1s of the commits to start from
+    :param depth: Number of commits to include along each line of history,
+        counting the heads; at least 1
+    :return: Tuple with the set of commits at the given depth, whose parents
+        are left out, and the set of the included commits whose parents are
+        included too
+    """
+    not_shallow = set()
+    seen = set(heads)
+    level = list(seen)
+    while level and depth > 1:
+        not_shallow.update(level)
+        next_level = []
+        for sha in level:
+            for parent in store.get_parents(sha):
+                if parent not in seen:
+                    seen.add(parent)
+                    next_level.append(parent)
+        level = next_level
+        depth -= 1
+    return set(level), not_shallow
@@ -0,0 +1,151 @@
+# instrumentation.py -- Counters and timing hooks for object access
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Opt-in counters and timing hooks for object store and pack access.
+
+Instrumentation is disabled by default. While it is disabled, the
+instrumented code paths only check whether the module level ``current``
+attribute is None.
+
+    >>> from dulwich import instrumentation
+    >>> instr = instrumentation.enable()
+    >>> instr.add_timing_callback(lambda name, seconds: None)
+    >>> instrumentation.disable()
+    >>> instr.snapshot()
+    {}
+
+The counters that are currently collected are:
+
+ * object_store.get_raw: Objects retrieved from a pack based object store
+ * object_store.pack_hit: Objects found in a pack
+ * object_store.pack_miss: Pack lookups that did not find the object, also
+   counted per pack as object_store.pack_miss.<pack file name>
+ * object_store.bulk_insert_hit: Objects found in a pack that is still
+   being written by bulk_insert()
+ * object_store.loose_hit, object_store.loose_miss: Loose object lookups
+   by get_raw()
+ * pack_index.lookup, pack_index.miss: Pack index lookups
+ * pack.offset_cache_hit, pack.offset_cache_miss: Lookups in the cache of
+   unpacked objects in a pack
+ * pack.bytes_inflated: Bytes decompressed when reading objects from packs
+ * pack.resolve_object: Objects resolved from packs
+ * pack.deltas_applied: Deltas applied while resolving objects
+ * pack.delta_chain_length.<n>: Number of resolved objects with a delta
+   chain of length n
+
+Timings are reported for object_store.get_raw and pack.resolve_object, and
+their totals are included in snapshots as <name>.seconds.
+"""
+
+import threading
+import time
+
+
+class Instrumentation(object):
+    """Collects counters and timings.
+
+    Counters and timings can be updated from several threads at once.
+
+    :ivar counters: Dictionary mapping counter names to their values
+    :ivar timings: Dictionary mapping timing names to total seconds spent
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self._timing_callbacks = []
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        """Increment a counter.
+
+        :param name: Name of the counter
+        :param amount: Amount to add to the counter
+        """
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        finally:
+            self._lock.release()
+
+    def add_timing_callback(self, callback):
+        """Add a function to be called for each timed operation.
+
+        :param callback: Function that is called with the name of the
+            operation and the number of seconds it took
+        """
+        self._timing_callbacks.append(callback)
+
+    def report_timing(self, name, start):
+        """Report the end of a timed operation.
+
+        :param name: Name of the operation
+        :param start: Time at which the operation started, as returned by
+            time.time()
+        """
+        seconds = time.time() - start
+        self._lock.acquire()
+        try:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+        finally:
+            self._lock.release()
+        for callback in self._timing_callbacks:
+            callback(name, seconds)
+
+    def snapshot(self):
+        """Return a dictionary with the current counters and total timings."""
+        self._lock.acquire()
+        try:
+            ret = dict(self.counters)
+            for name, seconds in self.timings.iteritems():
+                ret[name + ".seconds"] = seconds
+        finally:
+            self._lock.release()
+        return ret
+
+    def reset(self):
+        """Reset all counters and timings."""
+        self._lock.acquire()
+        try:
+            self.counters = {}
+            self.timings = {}
+        finally:
+            self._lock.release()
+
+
+# The active Instrumentation, or None if instrumentation is disabled.
+current = None
+
+
+def enable(instrumentation=None):
+    """Enable instrumentation.
+
+    :param instrumentation: Instrumentation to use, or None to create a new one
+    :return: The active Instrumentation
+    """
+    global current
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    current = instrumentation
+    return current
+
+
+def disable():
+    """Disable instrumentation."""
+    global current
+    current = None
@@ -20,18 +20,34 @@
 """Git object store interfaces and implementation."""
 
 
+from cStringIO import StringIO
 import errno
+import heapq
 import itertools
 import os
 import posixpath
 import stat
+import struct
+import sys
 import tempfile
+import threading
+import time
 import urllib2
+import zlib
 
+from dulwich.commit_graph import (
+    load_commit_graph,
+    write_commit_graph,
+    )
 from dulwich.errors import (
     NotTreeError,
+    ObjectFormatException,
     )
 from dulwich.file import GitFile
+from dulwich import instrumentation
+from dulwich.misc import (
+    make_sha,
+    )
 from dulwich.objects import (
     Commit,
     ShaFile,
@@ -45,14 +61,84 @@ from dulwich.objects import (
 from dulwich.pack import (
     Pack,
     PackData,
+    SHA1Writer,
+    create_delta,
     iter_sha1,
     load_pack_index,
+    unpack_object_header,
     write_pack,
     write_pack_data,
     write_pack_index_v2,
+    write_pack_object,
+    write_pack_raw_object,
     )
+from dulwich.walk import Walker
 
 PACKDIR = 'pack'
+INFODIR = 'info'
+
+# Objects larger than this are not considered for delta compression when
+# repacking, as creating deltas with difflib is quadratic in the worst case.
+MAX_DELTA_SIZE = 512 * 1024
+
+# Packs opened by any DiskObjectStore in this process, by real path of their
+# basename. Pack names are derived from their contents, so all stores that
+# find the same pack (for example forks sharing an alternate) can share a
+# single Pack along with its index and memory maps. Pack objects can be used
+# from several threads at once. Packs whose files have gone are dropped when
+# a store that contains them reloads its list of packs.
+_shared_packs = {}
+_shared_packs_lock = threading.Lock()
+
+
+def get_shared_pack(basename):
+    """Get the Pack for a basename, sharing it with other object stores.
+
+    :param basename: Path of the pack, without the .pack or .idx extension
+    :return: A Pack instance
+    """
+    key = os.path.realpath(basename)
+    _shared_packs_lock.acquire()
+    try:
+        pack = _shared_packs.get(key)
+        if pack is None:
+            pack = Pack(basename)
+            _shared_packs[key] = pack
+        return pack
+    finally:
+        _shared_packs_lock.release()
+
+
+def forget_shared_pack(basename):
+    """Remove a pack that is about to be deleted from the shared packs.
+
+    :param basename: Path of the pack, without the .pack or .idx extension
+    """
+    _shared_packs_lock.acquire()
+    try:
+        _shared_packs.pop(os.path.realpath(basename), None)
+    finally:
+        _shared_packs_lock.release()
+
+
+def _forget_missing_shared_packs(pack_dir, basenames):
+    """Remove the shared packs of a directory whose files have gone.
+
+    The packs are not closed, as other object stores may still be using
+    them; their files are closed once the last store lets go of them.
+
+    :param pack_dir: Path of the pack directory
+    :param basenames: Basenames of the packs that are in the directory
+    """
+    prefix = os.path.join(os.path.realpath(pack_dir), "")
+    present = set(os.path.realpath(basename) for basename in basenames)
+    _shared_packs_lock.acquire()
+    try:
+        for key in _shared_packs.keys():
+            if key.startswith(prefix) and key not in present:
+                del _shared_packs[key]
+    finally:
+        _shared_packs_lock.release()
 
 
 class BaseObjectStore(object):
@@ -69,6 +155,18 @@ class BaseObjectStore(object):
         """
         return ObjectStoreIterator(self, shas)
 
+    def sort_by_location(self, entries):
+        """Sort objects by where they are stored.
+
+        Reading objects in this order reads each pack from start to end, and
+        finds the bases of deltas in the cache of recently read objects.
+
+        :param entries: Iterable over tuples whose first item is a SHA1
+        :return: List of the entries; entries whose objects are stored in the
+            same place keep their order
+        """
+        return list(entries)
+
     def contains_loose(self, sha):
         """Check if a particular object is present by SHA1 and is loose."""
         raise NotImplementedError(self.contains_loose)
@@ -77,6 +175,18 @@ class BaseObjectStore(object):
         """Check if a particular object is present by SHA1 and is packed."""
         raise NotImplementedError(self.contains_packed)
 
+    def open_legacy_loose_object(self, sha):
+        """Open the file of a loose object stored in the legacy format.
+
+        The file contains the zlib-compressed header and contents of the
+        object, as git serves loose objects to dumb clients.
+
+        :param sha: SHA1 of the object
+        :return: File opened for reading, or None if the store can't provide
+            the object in that format
+        """
+        return None
+
     def __contains__(self, sha):
         """Check if a particular object is present by SHA1.
 
@@ -97,6 +207,17 @@ class BaseObjectStore(object):
         """
         raise NotImplementedError(self.get_raw)
 
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        Stores that can read the size from the header of an object do so
+        rather than unpacking it.
+
+        :param name: sha for the object.
+        :return: Size of the object contents
+        """
+        return len(self.get_raw(name)[1])
+
     def __getitem__(self, sha):
         """Obtain an object by SHA1."""
         type_num, uncomp = self.get_raw(sha)
@@ -106,6 +227,42 @@ class BaseObjectStore(object):
         """Iterate over the SHAs that are present in this store."""
         raise NotImplementedError(self.__iter__)
 
+    @property
+    def commit_graph(self):
+        """The CommitGraph for this store, or None if there is none."""
+        return None
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        The commit-graph is used if the commit is in it, so that the commit
+        does not have to be read and parsed.
+
+        :param sha: SHA1 of the commit
+        :return: List of parent SHA1s
+        """
+        graph = self.commit_graph
+        if graph is not None:
+            try:
+                return graph.get_parents(sha)
+            except KeyError:
+                pass
+        return self[sha].parents
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :param sha: SHA1 of the commit
+        :return: Commit time, in seconds since the epoch
+        """
+        graph = self.commit_graph
+        if graph is not None:
+            try:
+                return graph.get_commit_time(sha)
+            except KeyError:
+                pass
+        return self[sha].commit_time
+
     def add_object(self, obj):
         """Add a single object to this object store.
 
@@ -189,7 +346,7 @@ class BaseObjectStore(object):
                     yield path, mode, hexsha
 
     def find_missing_objects(self, haves, wants, progress=None,
-                             get_tagged=None):
+                             get_tagged=None, shallow=None, filter_spec=None):
         """Find the missing objects required for a set of revisions.
 
         :param haves: Iterable over SHAs already in common.
@@ -198,9 +355,14 @@ class BaseObjectStore(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param shallow: Iterable over SHAs of commits whose parents are not
+            to be sent and are not present in the target.
+        :param filter_spec: Optional filter spec for a partial clone, see
+            parse_filter_spec().
         :return: Iterator over (sha, path) pairs.
         """
-        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged)
+        finder = MissingObjectFinder(self, haves, wants, progress, get_tagged,
+                                     shallow, filter_spec)
         return iter(finder.next, None)
 
     def find_common_revisions(self, graphwalker):
@@ -218,13 +380,17 @@ class BaseObjectStore(object):
             sha = graphwalker.next()
         return haves
 
-    def get_graph_walker(self, heads):
+    def get_graph_walker(self, heads, skipping=False, shallow=None):
         """Obtain a graph walker for this object store.
         
         :param heads: Local heads to start search with
+        :param skipping: Whether to skip commits between those offered, see
+            ObjectStoreGraphWalker
+        :param shallow: SHA1s of commits whose parents are not present
         :return: GraphWalker object
         """
-        return ObjectStoreGraphWalker(heads, lambda sha: self[sha].parents)
+        return ObjectStoreGraphWalker(heads, self.get_parents,
+                                      self.get_commit_time, skipping, shallow)
 
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
@@ -240,12 +406,15 @@ class PackBasedObjectStore(BaseObjectStore):
 
     def __init__(self):
         self._pack_cache = None
+        self._bulk_inserter = None
 
     def contains_packed(self, sha):
         """Check if a particular object is present by SHA1 and is packed."""
         for pack in self.packs:
             if sha in pack:
                 return True
+        if self._bulk_inserter is not None and sha in self._bulk_inserter:
+            return True
         return False
 
     def _load_packs(self):
@@ -269,6 +438,26 @@ class PackBasedObjectStore(BaseObjectStore):
             self._pack_cache = self._load_packs()
         return self._pack_cache
 
+    def sort_by_location(self, entries):
+        packs = self.packs
+        # Objects that are read together are mostly in the same pack, so
+        # the pack of the previous object is searched first
+        last = [0]
+        def location(entry):
+            sha = entry[0]
+            if len(sha) == 40:
+                sha = hex_to_sha(sha)
+            for j in xrange(len(packs)):
+                i = (last[0] + j) % len(packs)
+                try:
+                    offset = packs[i].index.object_index(sha)
+                except KeyError:
+                    continue
+                last[0] = i
+                return (i, offset)
+            return (len(packs), 0)
+        return sorted(entries, key=location)
+
     def _iter_loose_objects(self):
         raise NotImplementedError(self._iter_loose_objects)
 
@@ -284,31 +473,97 @@ class PackBasedObjectStore(BaseObjectStore):
         """Check if a particular object is present by SHA1 and is loose."""
         return self._get_loose_object(sha) is not None
 
-    def get_raw(self, name):
-        """Obtain the raw text for an object.
+    def _get_loose_object_size(self, sha):
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return len(obj.as_raw_string())
+
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        Packed objects are sized from their pack entry header and loose
+        objects from their object header, so neither is unpacked.
 
         :param name: sha for the object.
-        :return: tuple with numeric type and object contents.
+        :return: Size of the object contents
         """
         if len(name) == 40:
             sha = hex_to_sha(name)
             hexsha = name
         elif len(name) == 20:
             sha = name
-            hexsha = None
+            hexsha = sha_to_hex(name)
         else:
             raise AssertionError
         for pack in self.packs:
             try:
-                return pack.get_raw(sha)
+                return pack.get_object_size(sha)
             except KeyError:
                 pass
-        if hexsha is None: 
-            hexsha = sha_to_hex(name)
-        ret = self._get_loose_object(hexsha)
-        if ret is not None:
+        if self._bulk_inserter is not None:
+            try:
+                return len(self._bulk_inserter.get_raw(sha)[1])
+            except KeyError:
+                pass
+        size = self._get_loose_object_size(hexsha)
+        if size is None:
+            raise KeyError(hexsha)
+        return size
+
+    def get_raw(self, name):
+        """Obtain the raw text for an object.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object contents.
+        """
+        if len(name) == 40:
+            sha = hex_to_sha(name)
+            hexsha = name
+        elif len(name) == 20:
+            sha = name
+            hexsha = None
+        else:
+            raise AssertionError
+        instr = instrumentation.current
+        if instr is not None:
+            instr.increment("object_store.get_raw")
+            start = time.time()
+        try:
+            for pack in self.packs:
+                try:
+                    ret = pack.get_raw(sha)
+                except KeyError:
+                    if instr is not None:
+                        instr.increment("object_store.pack_miss")
+                        instr.increment("object_store.pack_miss.%s" %
+                                        os.path.basename(pack._basename))
+                else:
+                    if instr is not None:
+                        instr.increment("object_store.pack_hit")
+                    return ret
+            if self._bulk_inserter is not None:
+                try:
+                    ret = self._bulk_inserter.get_raw(sha)
+                except KeyError:
+                    pass
+                else:
+                    if instr is not None:
+                        instr.increment("object_store.bulk_insert_hit")
+                    return ret
+            if hexsha is None:
+                hexsha = sha_to_hex(name)
+            ret = self._get_loose_object(hexsha)
+            if ret is None:
+                if instr is not None:
+                    instr.increment("object_store.loose_miss")
+                raise KeyError(hexsha)
+            if instr is not None:
+                instr.increment("object_store.loose_hit")
             return ret.type_num, ret.as_raw_string()
-        raise KeyError(hexsha)
+        finally:
+            if instr is not None:
+                instr.report_timing("object_store.get_raw", start)
 
     def add_objects(self, objects):
         """Add a set of objects to this object store.
@@ -326,6 +581,11 @@ class PackBasedObjectStore(BaseObjectStore):
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
+    # Number of seconds for which prune() leaves unreachable loose objects
+    # in place, so objects that are written before the refs that point at
+    # them are not removed. The same as the gc.pruneExpire default in git.
+    prune_expire = 14 * 24 * 60 * 60
+
     def __init__(self, path):
         """Open an object store.
 
@@ -335,6 +595,196 @@ class DiskObjectStore(PackBasedObjectStore):
         self.path = path
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
+        self._alternates = None
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+        self._commit_graph_stamp = None
+
+    def _commit_graph_path(self):
+        return os.path.join(self.path, INFODIR, "commit-graph")
+
+    def _get_commit_graph_stamp(self):
+        try:
+            st = os.stat(self._commit_graph_path())
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    @property
+    def commit_graph(self):
+        """The CommitGraph in objects/info/commit-graph, if any.
+
+        The file is read again when it has been replaced, for example by git
+        commit-graph write. Since commits never change, the entries in it
+        remain valid after new commits have been added.
+        """
+        stamp = self._get_commit_graph_stamp()
+        if not self._commit_graph_loaded or stamp != self._commit_graph_stamp:
+            # The previous CommitGraph may still be in use by another
+            # thread, so it is left to be closed once it is no longer used
+            graph = None
+            if stamp is not None:
+                try:
+                    graph = load_commit_graph(self._commit_graph_path())
+                except (OSError, IOError), e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    stamp = None
+            self._commit_graph = graph
+            self._commit_graph_stamp = stamp
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def write_commit_graph(self, heads, changed_paths=False):
+        """Write objects/info/commit-graph for the history of some heads.
+
+        :param heads: SHA1s of the commits whose history to include
+        :param changed_paths: Whether to include changed-path Bloom filters
+        :return: Number of commits written
+        :raise MissingCommitError: if the parents of a commit are missing, as
+            in shallow repositories
+        """
+        f = GitFile(self._commit_graph_path(), 'wb')
+        try:
+            count = write_commit_graph(f, self, heads, changed_paths)
+        except:
+            f.abort()
+            raise
+        f.close()
+        self._commit_graph_loaded = False
+        return count
+
+    def _read_alternate_paths(self):
+        try:
+            f = GitFile(os.path.join(self.path, INFODIR, "alternates"), 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        ret = []
+        try:
+            for l in f.readlines():
+                l = l.rstrip("\n")
+                if not l or l[0] == "#":
+                    continue
+                if not os.path.isabs(l):
+                    l = os.path.join(self.path, l)
+                ret.append(os.path.normpath(l))
+        finally:
+            f.close()
+        return ret
+
+    @property
+    def alternates(self):
+        """List of object stores listed in objects/info/alternates."""
+        if self._alternates is None:
+            self._alternates = [DiskObjectStore(path)
+                                for path in self._read_alternate_paths()]
+        return self._alternates
+
+    def add_alternate_path(self, path):
+        """Add an alternate path to this object store.
+
+        :param path: Path of the objects directory of the other repository
+        """
+        try:
+            os.mkdir(os.path.join(self.path, INFODIR))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        alternates_path = os.path.join(self.path, INFODIR, "alternates")
+        try:
+            f = GitFile(alternates_path, 'rb')
+        except (OSError, IOError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            contents = ""
+        else:
+            try:
+                contents = f.read()
+            finally:
+                f.close()
+        if contents and not contents.endswith("\n"):
+            contents += "\n"
+        f = GitFile(alternates_path, 'wb')
+        try:
+            f.write(contents + path + "\n")
+        finally:
+            f.close()
+        self._alternates = None
+
+    def _iter_alternates(self):
+        """Iterate over the alternates of this store, recursively.
+
+        Each object store is visited at most once, so cycles in the
+        alternates files do not cause infinite recursion.
+        """
+        seen = set([os.path.realpath(self.path)])
+        todo = list(self.alternates)
+        while todo:
+            store = todo.pop(0)
+            key = os.path.realpath(store.path)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield store
+            todo.extend(store.alternates)
+
+    def __contains__(self, sha):
+        """Check if a particular object is present by SHA1.
+
+        This also checks the alternates of this object store.
+        """
+        if self.contains_packed(sha) or self.contains_loose(sha):
+            return True
+        for alternate in self._iter_alternates():
+            if alternate.contains_packed(sha) or alternate.contains_loose(sha):
+                return True
+        return False
+
+    def get_raw(self, name):
+        """Obtain the raw text for an object.
+
+        Objects that are not in this store are looked up in its alternates.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and object contents.
+        """
+        try:
+            return super(DiskObjectStore, self).get_raw(name)
+        except KeyError:
+            pass
+        for alternate in self._iter_alternates():
+            try:
+                return PackBasedObjectStore.get_raw(alternate, name)
+            except KeyError:
+                pass
+        if len(name) == 20:
+            name = sha_to_hex(name)
+        raise KeyError(name)
+
+    def get_object_size(self, name):
+        """Obtain the size of the contents of an object.
+
+        Objects that are not in this store are looked up in its alternates.
+
+        :param name: sha for the object.
+        :return: Size of the object contents
+        """
+        try:
+            return super(DiskObjectStore, self).get_object_size(name)
+        except KeyError:
+            pass
+        for alternate in self._iter_alternates():
+            try:
+                return PackBasedObjectStore.get_object_size(alternate, name)
+            except KeyError:
+                pass
+        if len(name) == 20:
+            name = sha_to_hex(name)
+        raise KeyError(name)
 
     def _load_packs(self):
         pack_files = []
@@ -348,11 +798,14 @@ class DiskObjectStore(PackBasedObjectStore):
                     pack_files.append((os.stat(filename).st_mtime, filename))
         except OSError, e:
             if e.errno == errno.ENOENT:
+                _forget_missing_shared_packs(self.pack_dir, [])
                 return []
             raise
         pack_files.sort(reverse=True)
         suffix_len = len(".pack")
-        return [Pack(f[:-suffix_len]) for _, f in pack_files]
+        basenames = [f[:-suffix_len] for _, f in pack_files]
+        _forget_missing_shared_packs(self.pack_dir, basenames)
+        return [get_shared_pack(basename) for basename in basenames]
 
     def _pack_cache_stale(self):
         try:
@@ -382,6 +835,55 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def _get_loose_object_size(self, sha):
+        try:
+            f = GitFile(self._get_shafile_path(sha), 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            data = f.read(32)
+            if not ShaFile._is_legacy_object(data[:2]):
+                # New style objects use the same header as packs
+                return unpack_object_header(StringIO(data).read)[1]
+            # Only inflate up to the end of the "<type> <size>\0" header
+            decomp = zlib.decompressobj()
+            header = ""
+            while "\0" not in header:
+                if len(header) > 64:
+                    raise ObjectFormatException("Invalid object header")
+                if not data:
+                    data = f.read(1024)
+                    if not data:
+                        raise ObjectFormatException("Invalid object header")
+                header += decomp.decompress(data, 64)
+                data = decomp.unconsumed_tail
+            try:
+                return int(header[:header.index("\0")].split(" ", 1)[1])
+            except (IndexError, ValueError):
+                raise ObjectFormatException("Invalid object header")
+        finally:
+            f.close()
+
+    def open_legacy_loose_object(self, sha):
+        try:
+            f = GitFile(self._get_shafile_path(sha), 'rb')
+        except (OSError, IOError), e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            magic = f.read(2)
+            if len(magic) != 2 or not ShaFile._is_legacy_object(magic):
+                f.close()
+                return None
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        return f
+
     def move_in_thin_pack(self, path):
         """Move a specific file containing a pack into the pack directory.
 
@@ -407,7 +909,7 @@ class DiskObjectStore(PackBasedObjectStore):
         newbasename = os.path.join(self.pack_dir, "pack-%s" % pack_sha)
         os.rename(temppath+".pack", newbasename+".pack")
         os.rename(temppath+".idx", newbasename+".idx")
-        self._add_known_pack(Pack(newbasename))
+        self._add_known_pack(get_shared_pack(newbasename))
 
     def move_in_pack(self, path):
         """Move a specific file containing a pack into the pack directory.
@@ -418,13 +920,16 @@ class DiskObjectStore(PackBasedObjectStore):
         :param path: Path to the pack file.
         """
         p = PackData(path)
-        entries = p.sorted_entries()
-        basename = os.path.join(self.pack_dir, 
-            "pack-%s" % iter_sha1(entry[0] for entry in entries))
-        write_pack_index_v2(basename+".idx", entries, p.get_stored_checksum())
-        p.close()
+        try:
+            entries = p.sorted_entries()
+            basename = os.path.join(self.pack_dir, 
+                "pack-%s" % iter_sha1(entry[0] for entry in entries))
+            write_pack_index_v2(basename+".idx", entries,
+                                p.get_stored_checksum())
+        finally:
+            p.close()
         os.rename(path, basename + ".pack")
-        self._add_known_pack(Pack(basename))
+        self._add_known_pack(get_shared_pack(basename))
 
     def add_thin_pack(self):
         """Add a new thin pack to this object store.
@@ -453,14 +958,34 @@ class DiskObjectStore(PackBasedObjectStore):
             os.fsync(fd)
             f.close()
             if os.path.getsize(path) > 0:
-                self.move_in_pack(path)
+                try:
+                    self.move_in_pack(path)
+                except KeyError:
+                    # A thin pack, as sent to fetches that have some of the
+                    # objects already
+                    self.move_in_thin_pack(path)
         return f, commit
 
+    def bulk_insert(self):
+        """Start adding objects to a single new pack rather than loose files.
+
+        While the returned inserter is open, add_object() on this store writes
+        into the new pack, and objects added so far can be read back through
+        the store. Call commit() (or leave the with block) to move the pack
+        into place, or abort() to discard it.
+
+        :return: A PackInserter
+        """
+        return PackInserter(self)
+
     def add_object(self, obj):
         """Add a single object to this object store.
 
         :param obj: Object to add
         """
+        if self._bulk_inserter is not None:
+            self._bulk_inserter.add_object(obj)
+            return
         dir = os.path.join(self.path, obj.id[:2])
         try:
             os.mkdir(dir)
@@ -476,6 +1001,189 @@ class DiskObjectStore(PackBasedObjectStore):
         finally:
             f.close()
 
+    def repack(self, heads=None, window=10, depth=50):
+        """Repack the objects in this store into a single new pack.
+
+        Entries from existing packs are copied without being decompressed
+        where possible, including deltas whose base is also in the new pack.
+        Other objects are compressed again, storing them as deltas against
+        recently written objects of the same type where that saves space.
+
+        Packs with a .keep file are left alone and the objects in them are
+        not copied. Once the new pack is in place, the packs it supersedes
+        and the loose objects it contains are removed. Loose objects that
+        are not reachable from heads are left in place.
+
+        :param heads: SHA1s of the objects to keep, including everything
+            reachable from them. If None, all objects are kept.
+        :param window: Number of objects to try as delta bases for each
+            object that can not be copied
+        :param depth: Maximum length of delta chains
+        :return: The new Pack, or None if no objects needed to be packed
+        """
+        kept_packs = []
+        old_packs = []
+        for pack in self.packs:
+            if pack.is_kept():
+                kept_packs.append(pack)
+            else:
+                old_packs.append(pack)
+        if heads is None:
+            shas = ((sha, None) for sha in self)
+        else:
+            shas = self.find_missing_objects([], heads)
+        todo = {}
+        for sha, path in shas:
+            sha = hex_to_sha(sha)
+            for pack in kept_packs:
+                if sha in pack:
+                    break
+            else:
+                todo[sha] = path
+
+        new_pack = None
+        if todo:
+            new_pack = self._write_repacked(todo, old_packs, window, depth)
+        self._pack_cache = None
+        for pack in old_packs:
+            if new_pack is not None and pack._basename == new_pack._basename:
+                continue
+            forget_shared_pack(pack._basename)
+            pack.close()
+            # Remove the pack first, so readers never see it without index
+            os.remove(pack._data_path)
+            os.remove(pack._idx_path)
+        for hexsha in list(self._iter_loose_objects()):
+            sha = hex_to_sha(hexsha)
+            redundant = sha in todo
+            for pack in kept_packs:
+                redundant = redundant or sha in pack
+            if redundant:
+                os.remove(self._get_shafile_path(hexsha))
+        return new_pack
+
+    def prune(self, heads, expire=None):
+        """Remove loose objects that are not reachable from heads.
+
+        Only objects that have not been modified for expire seconds are
+        removed, so objects written by a concurrent push or fetch survive
+        until the refs that point at them are updated.
+
+        :param heads: SHA1s of the objects to keep, including everything
+            reachable from them
+        :param expire: Minimum age in seconds of the objects to remove, or
+            None for prune_expire
+        :return: List of the SHA1s of the removed objects
+        """
+        if expire is None:
+            expire = self.prune_expire
+        reachable = set(sha for sha, path in
+                        self.find_missing_objects([], heads))
+        cutoff = time.time() - expire
+        removed = []
+        for hexsha in list(self._iter_loose_objects()):
+            if hexsha in reachable:
+                continue
+            path = self._get_shafile_path(hexsha)
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            removed.append(hexsha)
+        return removed
+
+    def _write_repacked(self, todo, packs, window, depth):
+        """Write the objects for repack() into a new pack.
+
+        :param todo: Dictionary mapping binary SHA1s to write to their path
+        :param packs: Packs whose entries may be copied
+        :param window: Number of objects to try as delta bases
+        :param depth: Maximum length of delta chains
+        :return: The new Pack
+        """
+        fd, path = tempfile.mkstemp(dir=self.pack_dir, suffix=".pack")
+        raw_f = os.fdopen(fd, 'wb')
+        f = SHA1Writer(raw_f)
+        f.write("PACK")
+        f.write(struct.pack(">L", 2))
+        f.write(struct.pack(">L", len(todo)))
+        written = {} # binary sha -> (offset, delta depth)
+        entries = []
+        for pack in packs:
+            offset_shas = {}
+            for (sha, offset, type_num, delta_base, size, compressed,
+                 crc_ok) in pack.iter_raw_entries():
+                offset_shas[offset] = sha
+                if sha not in todo or sha in written or not crc_ok:
+                    continue
+                if type_num in (6, 7):
+                    if type_num == 6:
+                        delta_base = offset_shas.get(delta_base)
+                    if delta_base not in written:
+                        continue
+                    base_offset, base_depth = written[delta_base]
+                    if base_depth + 1 > depth:
+                        continue
+                    new_offset = f.tell()
+                    new_offset, crc32 = write_pack_raw_object(f, 6,
+                        new_offset - base_offset, size, compressed)
+                    written[sha] = (new_offset, base_depth + 1)
+                else:
+                    new_offset, crc32 = write_pack_raw_object(f, type_num,
+                        None, size, compressed)
+                    written[sha] = (new_offset, 0)
+                entries.append((sha, new_offset, crc32))
+
+        # Objects that could not be copied, ordered so that objects with
+        # the same name end up close to each other.
+        remaining = sorted((todo[sha] or "", sha)
+                           for sha in todo if sha not in written)
+        windows = {}
+        for _, sha in remaining:
+            type_num, raw = self.get_raw(sha)
+            candidates = windows.setdefault(type_num, [])
+            best = None
+            if len(raw) <= MAX_DELTA_SIZE:
+                for base_sha, base_raw in candidates:
+                    base_offset, base_depth = written[base_sha]
+                    if base_depth + 1 > depth:
+                        continue
+                    delta = create_delta(base_raw, raw)
+                    if best is None or len(delta) < len(best[1]):
+                        best = (base_sha, delta)
+            new_offset = f.tell()
+            if best is not None and len(best[1]) < len(raw) / 2:
+                base_offset, base_depth = written[best[0]]
+                new_offset, crc32 = write_pack_object(f, 6,
+                    (new_offset - base_offset, best[1]))
+                written[sha] = (new_offset, base_depth + 1)
+            else:
+                new_offset, crc32 = write_pack_object(f, type_num, raw)
+                written[sha] = (new_offset, 0)
+            entries.append((sha, new_offset, crc32))
+            if window and len(raw) <= MAX_DELTA_SIZE:
+                candidates.insert(0, (sha, raw))
+                del candidates[window:]
+
+        pack_sha = f.write_sha()
+        raw_f.flush()
+        os.fsync(fd)
+        raw_f.close()
+        entries.sort()
+        basename = os.path.join(self.pack_dir,
+            "pack-%s" % iter_sha1(entry[0] for entry in entries))
+        if os.path.exists(basename + ".pack"):
+            # A pack with exactly these objects is already present
+            os.remove(path)
+        else:
+            write_pack_index_v2(basename+".idx", entries, pack_sha)
+            os.rename(path, basename+".pack")
+        return get_shared_pack(basename)
+
     @classmethod
     def init(cls, path):
         try:
@@ -483,21 +1191,199 @@ class DiskObjectStore(PackBasedObjectStore):
         except OSError, e:
             if e.errno != errno.EEXIST:
                 raise
-        os.mkdir(os.path.join(path, "info"))
+        os.mkdir(os.path.join(path, INFODIR))
         os.mkdir(os.path.join(path, PACKDIR))
         return cls(path)
 
 
+class PackInserter(object):
+    """Streams objects added to a DiskObjectStore into a single new pack.
+
+    The pack header is written with a placeholder object count, which is
+    fixed up together with the trailing checksum when the pack is committed.
+    The index is written from the entries collected while writing, so the
+    pack does not have to be read again.
+    """
+
+    def __init__(self, store):
+        """Create a new PackInserter.
+
+        :param store: DiskObjectStore to add the new pack to
+        """
+        assert store._bulk_inserter is None, \
+            "bulk insert already in progress"
+        self.store = store
+        fd, self._path = tempfile.mkstemp(dir=store.pack_dir, suffix=".pack")
+        self._file = os.fdopen(fd, 'w+b')
+        self._file.write("PACK")
+        self._file.write(struct.pack(">L", 2))
+        self._file.write(struct.pack(">L", 0))
+        self._entries = {}
+        store._bulk_inserter = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def __len__(self):
+        """Number of objects added so far."""
+        return len(self._entries)
+
+    def __contains__(self, sha):
+        """Check whether an object was added to the pack being written."""
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return sha in self._entries
+
+    def add_object(self, obj):
+        """Add a single object to the pack being written.
+
+        Objects already present in the object store are skipped.
+
+        :param obj: Object to add
+        """
+        if obj.id in self.store:
+            return
+        offset, crc32 = write_pack_object(self._file, obj.type_num,
+                                          obj.as_raw_string())
+        self._entries[obj.sha().digest()] = (offset, crc32,
+                                             self._file.tell() - offset)
+
+    def get_raw(self, sha):
+        """Obtain the raw text for an object added to this pack.
+
+        :param sha: Binary or hex SHA1 of the object
+        :return: tuple with numeric type and object contents.
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        offset, crc32, length = self._entries[sha]
+        self._file.seek(offset)
+        try:
+            data = self._file.read(length)
+        finally:
+            self._file.seek(0, os.SEEK_END)
+        # Only undeltified objects are written, so the entry is just the
+        # type and size header followed by the deflated contents.
+        type_num = (ord(data[0]) >> 4) & 0x07
+        i = 0
+        while ord(data[i]) & 0x80:
+            i += 1
+        return type_num, zlib.decompress(data[i+1:])
+
+    def _finish_pack(self):
+        """Fix up the object count and append the pack checksum.
+
+        :return: 20-byte binary SHA1 digest of the pack contents
+        """
+        f = self._file
+        f.seek(8)
+        f.write(struct.pack(">L", len(self._entries)))
+        f.flush()
+        f.seek(0)
+        sha = make_sha()
+        while True:
+            data = f.read(1<<16)
+            if not data:
+                break
+            sha.update(data)
+        pack_sha = sha.digest()
+        f.seek(0, os.SEEK_END)
+        f.write(pack_sha)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        return pack_sha
+
+    def commit(self):
+        """Write the pack index and move the new pack into place.
+
+        :return: The new Pack, or None if no objects were added
+        """
+        self.store._bulk_inserter = None
+        if not self._entries:
+            self.abort()
+            return None
+        pack_sha = self._finish_pack()
+        entries = [(sha, offset, crc32)
+                   for (sha, (offset, crc32, length))
+                   in self._entries.iteritems()]
+        entries.sort()
+        basename = os.path.join(self.store.pack_dir,
+            "pack-%s" % iter_sha1(entry[0] for entry in entries))
+        write_pack_index_v2(basename+".idx", entries, pack_sha)
+        os.rename(self._path, basename+".pack")
+        pack = get_shared_pack(basename)
+        self.store._add_known_pack(pack)
+        return pack
+
+    def abort(self):
+        """Discard the pack being written."""
+        self.store._bulk_inserter = None
+        self._file.close()
+        try:
+            os.remove(self._path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _footprint(value, seen):
+    """Estimate the memory used by a value and everything it refers to.
+
+    :param value: The value
+    :param seen: Set with the ids of the values that were already counted,
+        which is updated
+    :return: Approximate number of bytes used
+    """
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    total = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            total += _footprint(key, seen) + _footprint(item, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            total += _footprint(item, seen)
+    attrs = getattr(value, "__dict__", None)
+    if attrs is not None:
+        total += _footprint(attrs, seen)
+    return total
+
+
 class MemoryObjectStore(BaseObjectStore):
-    """Object store that keeps all objects in memory."""
+    """Object store that keeps all objects in memory.
 
-    def __init__(self):
+    By default the parsed objects are kept. In compact mode only the
+    zlib-compressed raw contents are kept, keyed by binary SHA1, and objects
+    are parsed again each time they are retrieved. This uses much less
+    memory, at the cost of some CPU time for every lookup.
+    """
+
+    def __init__(self, compact=False):
+        """Create a new MemoryObjectStore.
+
+        :param compact: Whether to keep compressed raw contents rather than
+            parsed objects
+        """
         super(MemoryObjectStore, self).__init__()
         self._data = {}
+        self._compact = compact
+
+    def _to_key(self, sha):
+        if self._compact and len(sha) == 40:
+            return hex_to_sha(sha)
+        return sha
 
     def contains_loose(self, sha):
         """Check if a particular object is present by SHA1 and is loose."""
-        return sha in self._data
+        return self._to_key(sha) in self._data
 
     def contains_packed(self, sha):
         """Check if a particular object is present by SHA1 and is packed."""
@@ -505,6 +1391,8 @@ class MemoryObjectStore(BaseObjectStore):
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
+        if self._compact:
+            return itertools.imap(sha_to_hex, self._data.iterkeys())
         return self._data.iterkeys()
 
     @property
@@ -518,16 +1406,26 @@ class MemoryObjectStore(BaseObjectStore):
         :param name: sha for the object.
         :return: tuple with numeric type and object contents.
         """
-        return self[name].as_raw_string()
+        if self._compact:
+            type_num, compressed = self._data[self._to_key(name)]
+            return type_num, zlib.decompress(compressed)
+        obj = self[name]
+        return obj.type_num, obj.as_raw_string()
 
     def __getitem__(self, name):
+        if self._compact:
+            return ShaFile.from_raw_string(*self.get_raw(name))
         return self._data[name]
 
     def add_object(self, obj):
         """Add a single object to this object store.
 
         """
-        self._data[obj.id] = obj
+        if self._compact:
+            self._data[obj.sha().digest()] = (
+                obj.type_num, zlib.compress(obj.as_raw_string()))
+        else:
+            self._data[obj.id] = obj
 
     def add_objects(self, objects):
         """Add a set of objects to this object store.
@@ -535,7 +1433,18 @@ class MemoryObjectStore(BaseObjectStore):
         :param objects: Iterable over a list of objects.
         """
         for obj, path in objects:
-            self._data[obj.id] = obj
+            self.add_object(obj)
+
+    def memory_usage(self):
+        """Estimate the memory used to store the objects.
+
+        This counts the objects and all of their attributes, such as the
+        parsed fields and the cached text of parsed objects. Memory that
+        Python's allocator keeps aside is not counted.
+
+        :return: Approximate number of bytes used
+        """
+        return _footprint(self._data, set())
 
 
 class ObjectImporter(object):
@@ -579,7 +1488,7 @@ class ObjectStoreIterator(ObjectIterator):
 
     def __iter__(self):
         """Yield tuple with next object and path."""
-        for sha, path in self.itershas():
+        for sha, path in self.store.sort_by_location(self.itershas()):
             yield self.store[sha], path
 
     def iterobjects(self):
@@ -640,9 +1549,48 @@ def tree_lookup_path(lookup_obj, root_sha, path):
     return mode, sha
 
 
+_SIZE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_filter_spec(spec):
+    """Parse a filter spec for a partial clone, as used by git's --filter.
+
+    The supported filters are 'blob:none', which leaves out all blobs,
+    'blob:limit=<n>[kmg]', which leaves out blobs of at least n bytes, and
+    'tree:<depth>', which leaves out trees and blobs at least depth levels
+    below the root trees.
+
+    :param spec: Filter spec
+    :return: Tuple with the size from which blobs are left out and the depth
+        from which trees and blobs are left out, either of which may be None
+    :raise ValueError: If the filter spec is not supported
+    """
+    if spec == 'blob:none':
+        return 0, None
+    if spec.startswith('blob:limit='):
+        value = spec[len('blob:limit='):]
+        multiplier = _SIZE_UNITS.get(value[-1:].lower())
+        if multiplier is not None:
+            value = value[:-1]
+        else:
+            multiplier = 1
+        if value.isdigit():
+            return int(value) * multiplier, None
+    elif spec.startswith('tree:'):
+        value = spec[len('tree:'):]
+        if value.isdigit():
+            return None, int(value)
+    raise ValueError('Unsupported filter spec %r' % spec)
+
+
 class MissingObjectFinder(object):
     """Find the objects missing from another object store.
 
+    The commits to send are those reachable from the wants but not from the
+    haves. Like git, the trees of the commits on the edge between the two are
+    marked as already present along with everything in them, so trees and
+    blobs that did not change since the haves are neither walked nor sent.
+
     :param object_store: Object store containing at least all objects to be 
         sent
     :param haves: SHA1s of commits not to send (already present in target)
@@ -651,97 +1599,324 @@ class MissingObjectFinder(object):
     :param get_tagged: Function that returns a dict of pointed-to sha -> tag
         sha for including tags.
     :param tagged: dict of pointed-to sha -> tag sha for including tags
+    :param shallow: SHA1s of commits whose parents are neither sent nor
+        assumed to be present in the target, for shallow clones
+    :param filter_spec: Optional filter spec for a partial clone, see
+        parse_filter_spec(). The wanted objects themselves are always sent.
     """
 
     def __init__(self, object_store, haves, wants, progress=None,
-                 get_tagged=None):
+                 get_tagged=None, shallow=None, filter_spec=None):
         self.sha_done = set(haves)
-        self.objects_to_send = set([(w, None, False) for w in wants if w not in haves])
+        self.objects_to_send = set()
         self.object_store = object_store
+        self._commit_graph = object_store.commit_graph
+        if filter_spec is None:
+            self._blob_limit, self._tree_depth = None, None
+        else:
+            self._blob_limit, self._tree_depth = parse_filter_spec(
+                filter_spec)
+        # Blobs left out because of their size
+        self._filtered = set()
+        # Smallest depth at which each tree was found, if trees are filtered
+        # by depth
+        self._tree_depths = {}
         if progress is None:
             self.progress = lambda x: None
         else:
             self.progress = progress
         self._tagged = get_tagged and get_tagged() or {}
+        self._num_found = 0
+
+        have_commits = []
+        for sha in haves:
+            try:
+                have_commits.extend(self._peel_to_commits(sha, False))
+            except KeyError:
+                # Not something we have either
+                pass
+        want_commits = []
+        for sha in wants:
+            if sha not in self.sha_done:
+                want_commits.extend(self._peel_to_commits(sha, True))
+        if not want_commits:
+            return
+        shallow = frozenset(shallow or [])
+        walker = Walker(object_store, want_commits, exclude=have_commits,
+                        shallow=shallow)
+        commits = set(walker.iter_shas())
+        edge = set()
+        for sha in commits:
+            self.objects_to_send.add((sha, None, False))
+            if sha in shallow:
+                continue
+            edge.update(p for p in object_store.get_parents(sha)
+                        if p not in commits)
+        for sha in edge:
+            self.sha_done.add(sha)
+            try:
+                self._mark_tree_uninteresting(self._get_tree(sha))
+            except KeyError:
+                # Parents can be missing from shallow repositories
+                pass
+
+    def _peel_to_commits(self, sha, send):
+        """Find the commit an object refers to, if any.
+
+        :param sha: SHA1 of an object
+        :param send: Whether to send the objects that are not commits
+        :return: List with the SHA1 of the commit, empty if the object does
+            not refer to a commit
+        :raise KeyError: If the object or one it refers to is missing
+        """
+        while self._commit_graph is None or sha not in self._commit_graph:
+            o = self.object_store[sha]
+            if isinstance(o, Commit):
+                break
+            if not isinstance(o, Tag):
+                if send:
+                    self.add_todo([(sha, None, False)])
+                return []
+            if send:
+                self.add_todo([(sha, None, True)])
+            sha = o.object[1]
+        return [sha]
+
+    def _get_tree(self, commit_sha):
+        if self._commit_graph is not None:
+            try:
+                return self._commit_graph.get_tree(commit_sha)
+            except KeyError:
+                pass
+        return self.object_store[commit_sha].tree
+
+    def _mark_tree_uninteresting(self, tree_sha):
+        """Mark a tree and all trees and blobs in it as already present."""
+        todo = [tree_sha]
+        while todo:
+            sha = todo.pop()
+            if sha in self.sha_done:
+                continue
+            self.sha_done.add(sha)
+            for name, mode, entry_sha in self.object_store[sha].iteritems():
+                if stat.S_ISDIR(mode):
+                    todo.append(entry_sha)
+                elif not S_ISGITLINK(mode):
+                    self.sha_done.add(entry_sha)
+
+    def _blob_wanted(self, sha):
+        if self._blob_limit is None:
+            return True
+        if sha in self.sha_done or sha in self._filtered:
+            return False
+        # The size is read from the object header, without unpacking it
+        if (self._blob_limit and
+            self.object_store.get_object_size(sha) < self._blob_limit):
+            return True
+        self._filtered.add(sha)
+        return False
+
+    def _add_tree(self, sha, name, depth):
+        """Queue a tree found at a depth, when trees are filtered by depth.
+
+        A tree found at several depths is filtered by the smallest one, so a
+        tree that was already sent is walked again if it is found higher up.
+        """
+        old_depth = self._tree_depths.get(sha)
+        if old_depth is None:
+            if sha in self.sha_done:
+                # Present in the target
+                return
+        elif old_depth <= depth:
+            return
+        self._tree_depths[sha] = depth
+        if old_depth is not None and sha in self.sha_done:
+            self.parse_tree(self.object_store[sha], depth)
+        else:
+            self.objects_to_send.add((sha, name, False))
+
+    def _add_root_tree(self, sha):
+        if self._tree_depth is None:
+            self.add_todo([(sha, "", False)])
+        elif self._tree_depth > 0:
+            self._add_tree(sha, "", 0)
 
     def add_todo(self, entries):
         self.objects_to_send.update([e for e in entries if not e[0] in self.sha_done])
 
-    def parse_tree(self, tree):
-        self.add_todo([(sha, name, not stat.S_ISDIR(mode)) for (mode, name, sha) in tree.entries() if not S_ISGITLINK(mode)])
+    def parse_tree(self, tree, depth=None):
+        """Queue the entries of a tree.
+
+        :param tree: Tree object
+        :param depth: Depth of the tree below the root tree, if trees are
+            filtered by depth
+        """
+        if depth is not None:
+            depth += 1
+            if depth >= self._tree_depth:
+                return
+        entries = []
+        for mode, name, sha in tree.entries():
+            if S_ISGITLINK(mode):
+                continue
+            if not stat.S_ISDIR(mode):
+                if self._blob_wanted(sha):
+                    entries.append((sha, name, True))
+            elif depth is None:
+                entries.append((sha, name, False))
+            else:
+                self._add_tree(sha, name, depth)
+        self.add_todo(entries)
 
     def parse_commit(self, commit):
-        self.add_todo([(commit.tree, "", False)])
-        self.add_todo([(p, None, False) for p in commit.parents])
+        self._add_root_tree(commit.tree)
 
     def parse_tag(self, tag):
         self.add_todo([(tag.object[1], None, False)])
 
     def next(self):
-        if not self.objects_to_send:
-            return None
-        (sha, name, leaf) = self.objects_to_send.pop()
-        if not leaf:
+        while True:
+            if not self.objects_to_send:
+                return None
+            (sha, name, leaf) = self.objects_to_send.pop()
+            # The same object can be queued under several paths
+            if sha not in self.sha_done:
+                break
+        if (not leaf and self._commit_graph is not None and
+            sha in self._commit_graph):
+            self._add_root_tree(self._commit_graph.get_tree(sha))
+        elif not leaf:
             o = self.object_store[sha]
             if isinstance(o, Commit):
                 self.parse_commit(o)
             elif isinstance(o, Tree):
-                self.parse_tree(o)
+                self.parse_tree(o, self._tree_depths.get(sha))
             elif isinstance(o, Tag):
                 self.parse_tag(o)
         if sha in self._tagged:
             self.add_todo([(self._tagged[sha], None, True)])
         self.sha_done.add(sha)
-        self.progress("counting objects: %d\r" % len(self.sha_done))
+        self._num_found += 1
+        self.progress("counting objects: %d\r" % self._num_found)
         return (sha, name)
 
 
 class ObjectStoreGraphWalker(object):
     """Graph walker that finds out what commits are missing from an object 
     store.
-    
+
+    Commits are offered newest first. Once a commit has been acked, its
+    ancestors are known to be common and are no longer offered.
+
+    With skipping enabled, the walker behaves like git's "skipping"
+    negotiator: after each commit it offers, the number of commits it skips
+    before offering the next one on the same line of history grows by about
+    half. A client with a long history that the server does not have then
+    only needs O(log n) rounds, at the cost of finding a common commit that
+    may be somewhat older than the best one.
+
     :ivar heads: Revisions without descendants in the local repo
     :ivar get_parents: Function to retrieve parents in the local repo
+    :ivar shallow: Set of commits whose parents are not in the local repo
     """
 
-    def __init__(self, local_heads, get_parents):
+    def __init__(self, local_heads, get_parents, get_commit_time=None,
+                 skipping=False, shallow=None):
         """Create a new instance.
 
         :param local_heads: Heads to start search with
         :param get_parents: Function for finding the parents of a SHA1.
+        :param get_commit_time: Function for finding the commit time of a
+            SHA1, used to offer newer commits first. If None, commits are
+            offered in the order in which they are found.
+        :param skipping: Whether to skip commits between the ones offered.
+        :param shallow: SHA1s of commits whose parents are not present
         """
         self.heads = set(local_heads)
         self.get_parents = get_parents
+        self.shallow = set(shallow or [])
+        # Commits whose parents are not present, which includes commits that
+        # are no longer shallow until their parents have been fetched
+        self._without_parents = set(self.shallow)
+        self.get_commit_time = get_commit_time
+        self.skipping = skipping
         self.parents = {}
+        self._common = set()
+        # Number of commits to skip and the step it was derived from, for
+        # each commit that has been queued
+        self._ttl = {}
+        self._queue = []
+        self._counter = 0
+        for sha in self.heads:
+            self._push(sha, (0, 0))
+
+    def _push(self, sha, ttl):
+        self._ttl[sha] = ttl
+        if self.get_commit_time is None:
+            commit_time = 0
+        else:
+            commit_time = self.get_commit_time(sha)
+        self._counter += 1
+        heapq.heappush(self._queue, (-commit_time, self._counter, sha))
 
     def ack(self, sha):
         """Ack that a revision and its ancestors are present in the source."""
-        ancestors = set([sha])
-
-        # stop if we run out of heads to remove
-        while self.heads:
-            for a in ancestors:
-                if a in self.heads:
-                    self.heads.remove(a)
-
-            # collect all ancestors
-            new_ancestors = set()
-            for a in ancestors:
-                if a in self.parents:
-                    new_ancestors.update(self.parents[a])
-
-            # no more ancestors; stop
-            if not new_ancestors:
-                break
+        todo = [sha]
+        while todo:
+            sha = todo.pop()
+            if sha in self._common:
+                continue
+            self._common.add(sha)
+            self.heads.discard(sha)
+            # Ancestors that haven't been looked at yet are marked when they
+            # are taken from the queue.
+            todo.extend(self.parents.get(sha, []))
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Update the shallow commits after the server changed them.
 
-            ancestors = new_ancestors
+        :param new_shallow: SHA1s of commits that became shallow
+        :param new_unshallow: SHA1s of commits that are no longer shallow
+        """
+        self.shallow.update(new_shallow)
+        self.shallow.difference_update(new_unshallow)
+        self._without_parents.update(new_shallow)
 
     def next(self):
         """Iterate over ancestors of heads in the target."""
-        if self.heads:
-            ret = self.heads.pop()
-            ps = self.get_parents(ret)
-            self.parents[ret] = ps
-            self.heads.update(ps)
-            return ret
+        while self._queue:
+            _, _, sha = heapq.heappop(self._queue)
+            if sha in self._common:
+                continue
+            ttl, step = self._ttl[sha]
+            if sha in self._without_parents:
+                parents = []
+            else:
+                parents = self.get_parents(sha)
+            self.parents[sha] = parents
+            self.heads.discard(sha)
+            if ttl:
+                parent_ttl = (ttl - 1, step)
+            elif self.skipping:
+                parent_ttl = (step * 3 / 2 + 1, step * 3 / 2 + 1)
+            else:
+                parent_ttl = (0, 0)
+            queued_parent = False
+            for parent in parents:
+                if parent in self._common:
+                    continue
+                if parent in self.parents:
+                    # Already offered or skipped
+                    continue
+                queued_parent = True
+                if parent in self._ttl:
+                    # Offer it as soon as any of its children demands
+                    if parent_ttl[0] < self._ttl[parent][0]:
+                        self._ttl[parent] = parent_ttl
+                else:
+                    self._push(parent, parent_ttl)
+            # Commits whose parents have all been dealt with are always
+            # offered, so that the walk ends with the oldest commits.
+            if not ttl or not queued_parent:
+                return sha
         return None
@@ -35,6 +35,7 @@ try:
 except ImportError:
     from misc import defaultdict
 
+from cStringIO import StringIO
 import difflib
 from itertools import (
     chain,
@@ -49,6 +50,8 @@ try:
 except ImportError:
     from dulwich.misc import unpack_from
 import sys
+import threading
+import time
 import zlib
 
 from dulwich.errors import (
@@ -56,6 +59,7 @@ from dulwich.errors import (
     ChecksumMismatch,
     )
 from dulwich.file import GitFile
+from dulwich import instrumentation
 from dulwich.lru_cache import (
     LRUSizeCache,
     )
@@ -342,7 +346,15 @@ class PackIndex(object):
         """
         if len(sha) == 40:
             sha = hex_to_sha(sha)
-        return self._object_index(sha)
+        instr = instrumentation.current
+        if instr is None:
+            return self._object_index(sha)
+        instr.increment("pack_index.lookup")
+        try:
+            return self._object_index(sha)
+        except KeyError:
+            instr.increment("pack_index.miss")
+            raise
 
     def _object_index(self, sha):
         """See object_index.
@@ -436,44 +448,80 @@ def chunks_length(chunks):
     return sum(imap(len, chunks))
 
 
-def unpack_object(read_all, read_some=None):
-    """Unpack a Git object.
+def unpack_object_header(read):
+    """Read the header of a Git object in a pack.
 
-    :param read_all: Read function that blocks until the number of requested
+    :param read: Read function that blocks until the number of requested
         bytes are read.
-    :param read_some: Read function that returns at least one byte, but may not
-        return the number of bytes requested.
-    :return: tuple with type, uncompressed data, compressed size and tail data.
+    :return: tuple with type, uncompressed size, delta base and header size.
+        The delta base is the relative offset for offset deltas, the binary
+        SHA1 of the base for ref deltas and None otherwise.
     """
-    if read_some is None:
-        read_some = read_all
-    bytes = take_msb_bytes(read_all)
+    bytes = take_msb_bytes(read)
     type = (bytes[0] >> 4) & 0x07
     size = bytes[0] & 0x0f
     for i, byte in enumerate(bytes[1:]):
         size += (byte & 0x7f) << ((i * 7) + 4)
     raw_base = len(bytes)
     if type == 6: # offset delta
-        bytes = take_msb_bytes(read_all)
+        bytes = take_msb_bytes(read)
         raw_base += len(bytes)
         assert not (bytes[-1] & 0x80)
-        delta_base_offset = bytes[0] & 0x7f
+        delta_base = bytes[0] & 0x7f
         for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        uncomp, comp_len, unused = read_zlib_chunks(read_some, size)
-        assert size == chunks_length(uncomp)
-        return type, (delta_base_offset, uncomp), comp_len+raw_base, unused
+            delta_base += 1
+            delta_base <<= 7
+            delta_base += (byte & 0x7f)
     elif type == 7: # ref delta
-        basename = read_all(20)
+        delta_base = read(20)
         raw_base += 20
-        uncomp, comp_len, unused = read_zlib_chunks(read_some, size)
-        assert size == chunks_length(uncomp)
-        return type, (basename, uncomp), comp_len+raw_base, unused
     else:
-        uncomp, comp_len, unused = read_zlib_chunks(read_some, size)
-        assert chunks_length(uncomp) == size
+        delta_base = None
+    return type, size, delta_base, raw_base
+
+
+def _parse_delta_sizes(data):
+    """Parse the base and target sizes at the start of a delta.
+
+    :param data: Start of the uncompressed delta
+    :return: Tuple with the base and target size, or None if data is too
+        short
+    """
+    sizes = []
+    i = 0
+    while len(sizes) < 2:
+        size = 0
+        shift = 0
+        while True:
+            if i >= len(data):
+                return None
+            c = ord(data[i])
+            i += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                break
+        sizes.append(size)
+    return tuple(sizes)
+
+
+def unpack_object(read_all, read_some=None):
+    """Unpack a Git object.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param read_some: Read function that returns at least one byte, but may not
+        return the number of bytes requested.
+    :return: tuple with type, uncompressed data, compressed size and tail data.
+    """
+    if read_some is None:
+        read_some = read_all
+    type, size, delta_base, raw_base = unpack_object_header(read_all)
+    uncomp, comp_len, unused = read_zlib_chunks(read_some, size)
+    assert size == chunks_length(uncomp)
+    if type in (6, 7): # delta
+        return type, (delta_base, uncomp), comp_len+raw_base, unused
+    else:
         return type, uncomp, comp_len+raw_base, unused
 
 
@@ -509,6 +557,11 @@ class PackData(object):
     Currently there are no integrity checks done. Also no attempt is made to
     try and detect the delta case, or a request for an object at the wrong
     position.  It will all just throw a zlib or KeyError.
+
+    A PackData can be used from several threads at once: reads from the
+    file and the cache of objects by offset are protected by a lock. A
+    forked child process opens the file again, rather than share the file
+    offset with its parent.
     """
 
     def __init__(self, filename, file=None, size=None):
@@ -525,11 +578,14 @@ class PackData(object):
         self._header_size = 12
         if file is None:
             self._file = GitFile(self._filename, 'rb')
+            self._pid = os.getpid()
         else:
             self._file = file
+            self._pid = None
         (version, self._num_objects) = read_pack_header(self._file.read)
         self._offset_cache = LRUSizeCache(1024*1024*20,
             compute_size=_compute_object_size)
+        self._lock = threading.RLock()
 
     @classmethod
     def from_file(cls, file, size):
@@ -545,6 +601,18 @@ class PackData(object):
     def __del__(self):
         self.close()
 
+    def _get_file(self):
+        """Return the pack file, which must be used with the lock held.
+
+        A forked child process shares the file offset with its parent and
+        the other children, so it opens the file again.
+        """
+        if self._pid is not None and self._pid != os.getpid():
+            self._file.close()
+            self._file = GitFile(self._filename, 'rb')
+            self._pid = os.getpid()
+        return self._file
+
     def _get_size(self):
         if self._size is not None:
             return self._size
@@ -565,21 +633,57 @@ class PackData(object):
         :return: 20-byte binary SHA1 digest
         """
         s = make_sha()
-        self._file.seek(0)
         todo = self._get_size() - 20
+        offset = 0
         while todo > 0:
-            x = self._file.read(min(todo, 1<<16))
+            x = self.read_at(offset, min(todo, 1<<16))
             s.update(x)
             todo -= len(x)
+            offset += len(x)
         return s.digest()
 
+    def read_at(self, offset, size):
+        """Read part of the pack file.
+
+        :param offset: Offset to start reading at
+        :param size: Number of bytes to read
+        :return: The data, which is only shorter than size at the end of the
+            file
+        """
+        self._lock.acquire()
+        try:
+            f = self._get_file()
+            f.seek(offset)
+            return f.read(size)
+        finally:
+            self._lock.release()
+
     def resolve_object(self, offset, type, obj, get_ref, get_offset=None):
         """Resolve an object, possibly resolving deltas when necessary.
 
         :return: Tuple with object type and contents.
         """
+        instr = instrumentation.current
+        if instr is None:
+            return self._resolve_object(offset, type, obj, get_ref,
+                                        get_offset)[:2]
+        start = time.time()
+        type, chunks, chain_length = self._resolve_object(offset, type, obj,
+                                                          get_ref, get_offset)
+        instr.increment("pack.resolve_object")
+        instr.increment("pack.deltas_applied", chain_length)
+        instr.increment("pack.delta_chain_length.%d" % chain_length)
+        instr.report_timing("pack.resolve_object", start)
+        return type, chunks
+
+    def _resolve_object(self, offset, type, obj, get_ref, get_offset=None):
+        """See resolve_object.
+
+        :return: Tuple with object type, contents and the number of deltas
+            that were applied.
+        """
         if type not in (6, 7): # Not a delta
-            return type, obj
+            return type, obj, 0
 
         if get_offset is None:
             get_offset = self.get_object_at
@@ -598,11 +702,18 @@ class PackData(object):
             # Can't be a ofs delta, as we wouldn't know the base offset
             assert type != 6
             base_offset = None
-        type, base_chunks = self.resolve_object(base_offset, type, base_obj,
-                                                get_ref)
+        type, base_chunks, chain_length = self._resolve_object(
+            base_offset, type, base_obj, get_ref)
         if base_offset is not None:
-            self._offset_cache[base_offset] = type, base_chunks
-        return (type, apply_delta(base_chunks, delta))
+            # Only delta bases are cached. Deltas against an object follow
+            # it in the pack, so when objects are read in pack order the
+            # base of the next delta is usually still in the cache.
+            self._lock.acquire()
+            try:
+                self._offset_cache[base_offset] = type, base_chunks
+            finally:
+                self._lock.release()
+        return (type, apply_delta(base_chunks, delta), chain_length + 1)
 
     def iterobjects(self, progress=None):
 
@@ -612,7 +723,8 @@ class PackData(object):
                 self.i = 0
                 self.offset = pack._header_size
                 self.num = len(pack)
-                self.map = pack._file
+                self.pack = pack
+                self.lock = pack._lock
 
             def __iter__(self):
                 return self
@@ -623,10 +735,15 @@ class PackData(object):
             def next(self):
                 if self.i == self.num:
                     raise StopIteration
-                self.map.seek(self.offset)
-                (type, obj, total_size, unused) = unpack_object(self.map.read)
-                self.map.seek(self.offset)
-                crc32 = zlib.crc32(self.map.read(total_size)) & 0xffffffff
+                self.lock.acquire()
+                try:
+                    f = self.pack._get_file()
+                    f.seek(self.offset)
+                    (type, obj, total_size, unused) = unpack_object(f.read)
+                    f.seek(self.offset)
+                    crc32 = zlib.crc32(f.read(total_size)) & 0xffffffff
+                finally:
+                    self.lock.release()
                 ret = (self.offset, type, obj, crc32)
                 self.offset += total_size
                 if progress:
@@ -732,13 +849,37 @@ class PackData(object):
 
     def get_stored_checksum(self):
         """Return the expected checksum stored in this pack."""
-        self._file.seek(self._get_size()-20)
-        return self._file.read(20)
+        return self.read_at(self._get_size()-20, 20)
 
     def check(self):
         """Check the consistency of this pack."""
         return (self.calculate_checksum() == self.get_stored_checksum())
 
+    def get_object_size(self, offset):
+        """Return the size of the object at an offset, without unpacking it.
+
+        For deltas this is the size of the object the delta results in, which
+        is stored at the start of the delta.
+
+        :param offset: Offset of the object
+        :return: Uncompressed size of the object
+        """
+        read_size = 512
+        while True:
+            raw = self.read_at(offset, read_size)
+            type, size, delta_base, header_len = unpack_object_header(
+                StringIO(raw).read)
+            if type not in (6, 7):
+                return size
+            # The sizes are two variable length integers of at most 10 bytes
+            data = zlib.decompressobj().decompress(raw[header_len:], 20)
+            sizes = _parse_delta_sizes(data)
+            if sizes is not None:
+                return sizes[1]
+            if len(data) >= 20 or len(raw) < read_size:
+                raise ApplyDeltaError("Invalid delta header")
+            read_size *= 4
+
     def get_object_at(self, offset):
         """Given an offset in to the packfile return the object that is there.
 
@@ -746,13 +887,25 @@ class PackData(object):
         and then the packfile can be asked directly for that object using this
         function.
         """
-        if offset in self._offset_cache:
-            return self._offset_cache[offset]
+        instr = instrumentation.current
         assert isinstance(offset, long) or isinstance(offset, int),\
                 "offset was %r" % offset
         assert offset >= self._header_size
-        self._file.seek(offset)
-        return unpack_object(self._file.read)[:2]
+        self._lock.acquire()
+        try:
+            if offset in self._offset_cache:
+                if instr is not None:
+                    instr.increment("pack.offset_cache_hit")
+                return self._offset_cache[offset]
+            f = self._get_file()
+            f.seek(offset)
+            ret = unpack_object(f.read)[:2]
+        finally:
+            self._lock.release()
+        if instr is not None:
+            instr.increment("pack.offset_cache_miss")
+            instr.increment("pack.bytes_inflated", _compute_object_size(ret))
+        return ret
 
 
 class SHA1Reader(object):
@@ -805,40 +958,64 @@ class SHA1Writer(object):
         return self.f.tell()
 
 
-def write_pack_object(f, type, object):
-    """Write pack object to a file.
+def pack_object_header(type, delta_base, size):
+    """Create the header for an object in a pack.
 
-    :param f: File to write to
     :param type: Numeric type of the object
-    :param object: Object to write
-    :return: Tuple with offset at which the object was written, and crc32
+    :param delta_base: Relative offset of the base for offset deltas, binary
+        SHA1 of the base for ref deltas, None otherwise
+    :param size: Uncompressed size of the object (or delta)
+    :return: String with the encoded header
     """
-    offset = f.tell()
-    packed_data_hdr = ""
-    if type == 6: # offset delta
-        (delta_base_offset, object) = object
-    elif type == 7: # ref delta
-        (basename, object) = object
-    size = len(object)
+    header = ""
     c = (type << 4) | (size & 15)
     size >>= 4
     while size:
-        packed_data_hdr += (chr(c | 0x80))
+        header += (chr(c | 0x80))
         c = size & 0x7f
         size >>= 7
-    packed_data_hdr += chr(c)
+    header += chr(c)
     if type == 6: # offset delta
-        ret = [delta_base_offset & 0x7f]
-        delta_base_offset >>= 7
-        while delta_base_offset:
-            delta_base_offset -= 1
-            ret.insert(0, 0x80 | (delta_base_offset & 0x7f))
-            delta_base_offset >>= 7
-        packed_data_hdr += "".join([chr(x) for x in ret])
+        ret = [delta_base & 0x7f]
+        delta_base >>= 7
+        while delta_base:
+            delta_base -= 1
+            ret.insert(0, 0x80 | (delta_base & 0x7f))
+            delta_base >>= 7
+        header += "".join([chr(x) for x in ret])
     elif type == 7: # ref delta
-        assert len(basename) == 20
-        packed_data_hdr += basename
-    packed_data = packed_data_hdr + zlib.compress(object)
+        assert len(delta_base) == 20
+        header += delta_base
+    return header
+
+
+def write_pack_object(f, type, object):
+    """Write pack object to a file.
+
+    :param f: File to write to
+    :param type: Numeric type of the object
+    :param object: Object to write
+    :return: Tuple with offset at which the object was written, and crc32
+    """
+    delta_base = None
+    if type in (6, 7): # delta
+        (delta_base, object) = object
+    return write_pack_raw_object(f, type, delta_base, len(object),
+                                 zlib.compress(object))
+
+
+def write_pack_raw_object(f, type, delta_base, size, compressed):
+    """Write an already compressed pack object to a file.
+
+    :param f: File to write to
+    :param type: Numeric type of the object
+    :param delta_base: Delta base, as for pack_object_header
+    :param size: Uncompressed size of the object
+    :param compressed: zlib compressed contents of the object
+    :return: Tuple with offset at which the object was written, and crc32
+    """
+    offset = f.tell()
+    packed_data = pack_object_header(type, delta_base, size) + compressed
     f.write(packed_data)
     return (offset, (zlib.crc32(packed_data) & 0xffffffff))
 
@@ -932,9 +1109,39 @@ def write_pack_index_v1(filename, entries, pack_checksum):
         f.close()
 
 
+# Buffers whose lines are longer than this on average are matched byte by
+# byte in create_delta(), as are buffers that look binary
+DELTA_MAX_LINE_LENGTH = 200
+
+
+def _split_delta_lines(buf):
+    """Split a buffer for create_delta() into lines, if it is text.
+
+    :return: Tuple with the lines and their start offsets, followed by the
+        length of the buffer, or None if the buffer should be matched byte by
+        byte.
+    """
+    # The same check for binary data as git uses
+    if "\0" in buf[:8000]:
+        return None
+    lines = buf.splitlines(True)
+    if len(buf) > len(lines) * DELTA_MAX_LINE_LENGTH:
+        return None
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    return lines, offsets
+
+
 def create_delta(base_buf, target_buf):
     """Use python difflib to work out how to transform base_buf to target_buf.
 
+    Text is matched line by line, which finds long matches quickly; for
+    sequences of more than 200 elements SequenceMatcher ignores popular
+    elements, which for single bytes of text means it hardly finds any
+    matches at all. Binary data and buffers with few lines for their size
+    are matched byte by byte.
+
     :param base_buf: Base buffer
     :param target_buf: Target buffer
     """
@@ -955,14 +1162,28 @@ def create_delta(base_buf, target_buf):
     out_buf += encode_size(len(base_buf))
     out_buf += encode_size(len(target_buf))
     # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
+    base_split = _split_delta_lines(base_buf)
+    target_split = None
+    if base_split is not None:
+        target_split = _split_delta_lines(target_buf)
+    if target_split is None:
+        seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
+        opcodes = seq.get_opcodes()
+    else:
+        base_lines, base_offsets = base_split
+        target_lines, target_offsets = target_split
+        seq = difflib.SequenceMatcher(a=base_lines, b=target_lines)
+        opcodes = [(opcode, base_offsets[i1], base_offsets[i2],
+                    target_offsets[j1], target_offsets[j2])
+                   for opcode, i1, i2, j1, j2 in seq.get_opcodes()]
+    for opcode, i1, i2, j1, j2 in opcodes:
         # Git patch opcodes don't care about deletes!
         #if opcode == "replace" or opcode == "delete":
         #    pass
-        if opcode == "equal":
+        while opcode == "equal" and i1 < i2:
             # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
+            # Write out an opcode that says what range to use. A single
+            # copy can cover at most 0x10000 bytes.
             scratch = ""
             op = 0x80
             o = i1
@@ -970,13 +1191,14 @@ def create_delta(base_buf, target_buf):
                 if o & 0xff << i*8:
                     scratch += chr((o >> i*8) & 0xff)
                     op |= 1 << i
-            s = i2 - i1
+            s = min(i2 - i1, 0x10000)
             for i in range(2):
                 if s & 0xff << i*8:
                     scratch += chr((s >> i*8) & 0xff)
                     op |= 1 << (4+i)
             out_buf += chr(op)
             out_buf += scratch
+            i1 += s
         if opcode == "replace" or opcode == "insert":
             # If we are replacing a range or adding one, then we just
             # output it to the stream (prefixed by its size)
@@ -1098,8 +1320,10 @@ class Pack(object):
         self._basename = basename
         self._data_path = self._basename + ".pack"
         self._idx_path = self._basename + ".idx"
+        self._keep_path = self._basename + ".keep"
         self._data = None
         self._idx = None
+        self._lock = threading.Lock()
 
     @classmethod
     def from_objects(self, data, idx):
@@ -1117,13 +1341,21 @@ class Pack(object):
     def data(self):
         """The pack data object being used."""
         if self._data is None:
-            self._data = PackData(self._data_path)
-            assert len(self.index) == len(self._data)
-            idx_stored_checksum = self.index.get_pack_checksum()
-            data_stored_checksum = self._data.get_stored_checksum()
-            if idx_stored_checksum != data_stored_checksum:
-                raise ChecksumMismatch(sha_to_hex(idx_stored_checksum),
-                                       sha_to_hex(data_stored_checksum))
+            index = self.index
+            self._lock.acquire()
+            try:
+                if self._data is None:
+                    data = PackData(self._data_path)
+                    assert len(index) == len(data)
+                    idx_stored_checksum = index.get_pack_checksum()
+                    data_stored_checksum = data.get_stored_checksum()
+                    if idx_stored_checksum != data_stored_checksum:
+                        raise ChecksumMismatch(
+                            sha_to_hex(idx_stored_checksum),
+                            sha_to_hex(data_stored_checksum))
+                    self._data = data
+            finally:
+                self._lock.release()
         return self._data
 
     @property
@@ -1133,7 +1365,12 @@ class Pack(object):
         :note: This may be an in-memory index
         """
         if self._idx is None:
-            self._idx = load_pack_index(self._idx_path)
+            self._lock.acquire()
+            try:
+                if self._idx is None:
+                    self._idx = load_pack_index(self._idx_path)
+            finally:
+                self._lock.release()
         return self._idx
 
     def close(self):
@@ -1190,6 +1427,58 @@ class Pack(object):
         type, uncomp = self.get_raw(sha1)
         return ShaFile.from_raw_string(type, uncomp)
 
+    def get_object_size(self, sha1):
+        """Return the uncompressed size of an object, without unpacking it.
+
+        :param sha1: SHA1 of the object
+        :return: Size of the object
+        """
+        return self.data.get_object_size(self.index.object_index(sha1))
+
+    def iter_raw_entries(self):
+        """Iterate over the entries in this pack without decompressing them.
+
+        Entries are yielded in the order in which they appear in the pack.
+
+        :return: Iterator over tuples with binary SHA1, offset, numeric type,
+            delta base, uncompressed size, the compressed data and a flag
+            indicating whether the CRC32 checksum from the index matches. For
+            offset deltas, the delta base is the absolute offset of the base.
+        """
+        entries = sorted((offset, sha, crc32)
+                         for (sha, offset, crc32) in self.index.iterentries())
+        data = self.data
+        end = data._get_size() - 20
+        for i, (offset, sha, crc32) in enumerate(entries):
+            if i + 1 < len(entries):
+                next_offset = entries[i+1][0]
+            else:
+                next_offset = end
+            raw = data.read_at(offset, next_offset - offset)
+            crc_ok = (crc32 is None or
+                      (zlib.crc32(raw) & 0xffffffff) == crc32)
+            type, size, delta_base, header_len = unpack_object_header(
+                StringIO(raw).read)
+            if type == 6:
+                delta_base = offset - delta_base
+            yield (sha, offset, type, delta_base, size, raw[header_len:],
+                   crc_ok)
+
+    def keep(self, msg=""):
+        """Mark this pack as one that should not be repacked.
+
+        :param msg: Optional reason for keeping the pack
+        """
+        f = GitFile(self._keep_path, 'wb')
+        try:
+            f.write(msg)
+        finally:
+            f.close()
+
+    def is_kept(self):
+        """Check whether this pack is marked as one not to be repacked."""
+        return os.path.exists(self._keep_path)
+
     def iterobjects(self, get_raw=None):
         """Iterate over the objects in this pack."""
         if get_raw is None:
@@ -0,0 +1,212 @@
+# pack_cache.py -- On-disk cache of the packs sent to clients
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""On-disk cache of the packs generated for fetches.
+
+Clients that fetch the same refs on top of the same commits get the same
+pack, so a server that sees many identical fetches, such as the full clones
+of a build farm, can send a pack it generated before rather than counting
+and packing the objects again.
+
+The key of a pack includes the refs of the repository, so a pack is not
+reused once the refs have changed. The least recently used packs are removed
+when the cache grows beyond its maximum size.
+"""
+
+import errno
+import os
+import time
+
+from dulwich.file import GitFile
+from dulwich.misc import make_sha
+
+DEFAULT_PACK_CACHE_SIZE = 512 * 1024 * 1024
+
+
+def make_pack_cache_key(refs, wants, haves, capabilities, shallow=None,
+                        depth=None, filter_spec=None):
+    """Compute the key under which the pack for a fetch is cached.
+
+    :param refs: Dictionary with the refs of the repository
+    :param wants: SHA1s of the objects the client wants
+    :param haves: SHA1s of the commits the client has in common with the
+        repository
+    :param capabilities: Capabilities the client asked for
+    :param shallow: Optional SHA1s of the shallow commits of the client
+    :param depth: Optional depth the client asked for
+    :param filter_spec: Optional filter spec the client asked for
+    :return: Key as a hex string, which does not depend on the order of its
+        parts
+    """
+    key = make_sha()
+    for name, sha in sorted(refs.iteritems()):
+        key.update('ref %s %s\n' % (sha, name))
+    for sha in sorted(set(wants)):
+        key.update('want %s\n' % sha)
+    for sha in sorted(set(haves)):
+        key.update('have %s\n' % sha)
+    for sha in sorted(set(shallow or [])):
+        key.update('shallow %s\n' % sha)
+    if depth is not None:
+        key.update('deepen %d\n' % depth)
+    if filter_spec is not None:
+        key.update('filter %s\n' % filter_spec)
+    for capability in sorted(set(capabilities)):
+        key.update('capability %s\n' % capability)
+    return key.hexdigest()
+
+
+class PackCache(object):
+    """Directory of cached packs, grouped by repository.
+
+    :ivar path: Path of the directory
+    :ivar max_size: Number of bytes the cached packs may take up
+    """
+
+    # Number of seconds after which a lock file that is no longer written to
+    # is assumed to be left behind by a writer that died
+    stale_lock_age = 3600
+
+    def __init__(self, path, max_size=DEFAULT_PACK_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def _repo_dir(self, repo_name):
+        return os.path.join(self.path, make_sha(repo_name).hexdigest())
+
+    def _pack_path(self, repo_name, key):
+        return os.path.join(self._repo_dir(repo_name), '%s.pack' % key)
+
+    def open(self, repo_name, key):
+        """Open a cached pack.
+
+        :param repo_name: Name of the repository, as given by the client
+        :param key: Key of the pack, see make_pack_cache_key()
+        :return: File with the pack opened for reading, or None if the pack
+            is not in the cache
+        """
+        path = self._pack_path(repo_name, key)
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # Mark the pack as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def add(self, repo_name, key):
+        """Start adding a pack to the cache.
+
+        :param repo_name: Name of the repository, as given by the client
+        :param key: Key of the pack, see make_pack_cache_key()
+        :return: Tuple with a file to write the pack to, a function to call
+            once the whole pack is written and a function to call to discard
+            it instead, or None if the pack is already being added
+        """
+        repo_dir = self._repo_dir(repo_name)
+        try:
+            os.makedirs(repo_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            f = GitFile(self._pack_path(repo_name, key), 'wb')
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            return None
+        def commit():
+            f.close()
+            self.trim()
+        return f, commit, f.abort
+
+    def _iter_files(self, suffix):
+        try:
+            repo_dirs = os.listdir(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for repo_dir in repo_dirs:
+            repo_dir = os.path.join(self.path, repo_dir)
+            for name in os.listdir(repo_dir):
+                if name.endswith(suffix):
+                    yield os.path.join(repo_dir, name)
+
+    def _iter_packs(self):
+        return self._iter_files('.pack')
+
+    def trim(self):
+        """Remove the least recently used packs until the cache fits.
+
+        Stale lock files, which would keep their pack from ever being added
+        again, are removed as well.
+        """
+        now = time.time()
+        for path in self._iter_files('.lock'):
+            try:
+                if now - os.stat(path).st_mtime > self.stale_lock_age:
+                    self._remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        packs = []
+        total_size = 0
+        for path in self._iter_packs():
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            packs.append((st.st_mtime, path, st.st_size))
+            total_size += st.st_size
+        packs.sort()
+        for mtime, path, size in packs:
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def invalidate(self, repo_name):
+        """Remove the cached packs of a repository.
+
+        :param repo_name: Name of the repository, as given by the client
+        """
+        repo_dir = self._repo_dir(repo_name)
+        try:
+            names = os.listdir(repo_dir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            if name.endswith('.pack'):
+                self._remove(os.path.join(repo_dir, name))
@@ -36,6 +36,9 @@ SINGLE_ACK = 0
 MULTI_ACK = 1
 MULTI_ACK_DETAILED = 2
 
+# Packet that separates the sections of protocol version 2 messages
+DELIM_PKT = object()
+
 class ProtocolFile(object):
     """
     Some network ops are like file ops. The file ops expect to operate on
@@ -64,7 +67,8 @@ class Protocol(object):
         """
         Reads a 'pkt line' from the remote git process
 
-        :return: The next string from the stream
+        :return: The next string from the stream, None for a flush-pkt or
+            DELIM_PKT for a delim-pkt
         """
         try:
             sizestr = self.read(4)
@@ -75,6 +79,10 @@ class Protocol(object):
                 if self.report_activity:
                     self.report_activity(4, 'read')
                 return None
+            if size == 1:
+                if self.report_activity:
+                    self.report_activity(4, 'read')
+                return DELIM_PKT
             if self.report_activity:
                 self.report_activity(size, 'read')
             return self.read(size-4)
@@ -91,13 +99,18 @@ class Protocol(object):
         """
         Sends a 'pkt line' to the remote git process
 
-        :param line: A string containing the data to send
+        :param line: A string containing the data to send, None for a
+            flush-pkt or DELIM_PKT for a delim-pkt
         """
         try:
             if line is None:
                 self.write("0000")
                 if self.report_activity:
                     self.report_activity(4, 'write')
+            elif line is DELIM_PKT:
+                self.write("0001")
+                if self.report_activity:
+                    self.report_activity(4, 'write')
             else:
                 self.write("%04x%s" % (len(line)+4, line))
                 if self.report_activity:
@@ -299,6 +312,23 @@ def extract_want_line_capabilities(text):
     return (" ".join(split_text[:2]), split_text[2:])
 
 
+def protocol_version(parameters):
+    """Find the protocol version a client asked for.
+
+    :param parameters: Extra parameters sent by the client, such as the
+        colon separated parts of GIT_PROTOCOL
+    :return: The highest version asked for, or 0 if none was
+    """
+    version = 0
+    for parameter in parameters:
+        if parameter.startswith('version='):
+            try:
+                version = max(version, int(parameter[len('version='):]))
+            except ValueError:
+                pass
+    return version
+
+
 def ack_type(capabilities):
     """Extract the ack type from a capabilities list."""
     if 'multi_ack_detailed' in capabilities:
@@ -24,9 +24,9 @@
 
 import errno
 import os
+import time
 
 from dulwich.errors import (
-    MissingCommitError, 
     NoIndexPresent,
     NotBlobError, 
     NotCommitError, 
@@ -59,6 +59,8 @@ SYMREF = 'ref: '
 REFSDIR = 'refs'
 REFSDIR_TAGS = 'tags'
 REFSDIR_HEADS = 'heads'
+# Seconds within which changes to the refs may not change their stamp
+REFS_STAMP_RACY_INTERVAL = 2
 INDEX_FILENAME = "index"
 
 BASE_DIRECTORIES = [
@@ -148,6 +150,13 @@ class RefsContainer(object):
         """
         return None
 
+    def stamp(self):
+        """Return a value that changes whenever the refs change.
+
+        :return: Hashable value, or None if changes can not be detected
+        """
+        return None
+
     def import_refs(self, base, other):
         for name, value in other.iteritems():
             self["%s/%s" % (base, name)] = value
@@ -373,6 +382,35 @@ class DiskRefsContainer(RefsContainer):
             # Known not peelable
             return self[name]
 
+    def stamp(self):
+        """Return a value that changes whenever the refs change.
+
+        The stamp is made up of the modification times of HEAD, packed-refs
+        and the directories under refs. As refs are written by renaming a new
+        file into place, writing a loose ref updates its directory too.
+
+        :return: Tuple with the stamp, or None if the refs were changed too
+            recently for a change in the same clock tick to be noticed
+        """
+        paths = [self.refpath('HEAD'), os.path.join(self.path, 'packed-refs')]
+        for root, dirs, files in os.walk(self.refpath('refs')):
+            paths.append(root)
+        stamp = []
+        newest = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                stamp.append((path, None))
+                continue
+            stamp.append((path, st.st_mtime, st.st_ino, st.st_size))
+            newest = max(newest, st.st_mtime)
+        if time.time() - newest < REFS_STAMP_RACY_INTERVAL:
+            return None
+        return tuple(stamp)
+
     def read_loose_ref(self, name):
         """Read a reference file and return its contents.
 
@@ -669,7 +707,7 @@ class BaseRepo(object):
         return self.get_refs()
 
     def fetch_objects(self, determine_wants, graph_walker, progress,
-                      get_tagged=None):
+                      get_tagged=None, refs=None):
         """Fetch the missing objects required for a set of revisions.
 
         :param determine_wants: Function that takes a dictionary with heads 
@@ -681,20 +719,45 @@ class BaseRepo(object):
             updated progress strings.
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param refs: Optional dict with the refs to pass to determine_wants,
+            if the caller has read them already
         :return: iterator over objects, with __len__ implemented
         """
-        wants = determine_wants(self.get_refs())
+        if refs is None:
+            refs = self.get_refs()
+        wants = determine_wants(refs)
         if not wants:
             return []
         haves = self.object_store.find_common_revisions(graph_walker)
-        return self.object_store.iter_shas(
-            self.object_store.find_missing_objects(haves, wants, progress,
-                                                   get_tagged))
-
-    def get_graph_walker(self, heads=None):
+        # Commits whose parents the target doesn't have or won't get
+        shallow = getattr(graph_walker, 'shallow', None)
+        filter_spec = getattr(graph_walker, 'filter_spec', None)
+        # Only look for the objects once they are needed, so callers that
+        # have the pack cached don't have to
+        def find_missing_objects():
+            for entry in self.object_store.find_missing_objects(haves, wants,
+                    progress, get_tagged, shallow, filter_spec):
+                yield entry
+        return self.object_store.iter_shas(find_missing_objects())
+
+    def get_graph_walker(self, heads=None, skipping=False):
         if heads is None:
             heads = self.refs.as_dict('refs/heads').values()
-        return self.object_store.get_graph_walker(heads)
+        return self.object_store.get_graph_walker(heads, skipping,
+                                                  self.get_shallow())
+
+    def get_shallow(self):
+        """Get the commits whose parents are missing from a shallow clone.
+
+        :return: Set of SHA1s, empty unless the repository is shallow
+        """
+        f = self.get_named_file('shallow')
+        if f is None:
+            return set()
+        try:
+            return set(line.strip() for line in f if line.strip())
+        finally:
+            f.close()
 
     def ref(self, name):
         """Return the SHA1 a ref is pointing to."""
@@ -729,7 +792,7 @@ class BaseRepo(object):
         return self.object_store[sha]
 
     def get_parents(self, sha):
-        return self.commit(sha).parents
+        return self.object_store.get_parents(sha)
 
     def get_config(self):
         import ConfigParser
@@ -804,6 +867,49 @@ class BaseRepo(object):
             obj = self.get_object(sha)
         return obj.id
 
+    def get_walker(self, include=None, *args, **kwargs):
+        """Obtain a walker for this repository.
+
+        Unless told otherwise, the walker stops at the shallow commits of the
+        repository.
+
+        :param include: Iterable of SHAs of commits to include along with their
+            ancestors. Defaults to [HEAD]
+        :param args: Positional arguments for the Walker constructor
+        :param kwargs: Keyword arguments for the Walker constructor
+        :return: A `Walker` object
+        """
+        from dulwich.walk import Walker
+        if include is None:
+            include = [self.head()]
+        kwargs.setdefault('shallow', self.get_shallow())
+        return Walker(self.object_store, include, *args, **kwargs)
+
+    def find_merge_base(self, one, two):
+        """Find the best common ancestors of two commits.
+
+        :param one: SHA1 of a commit
+        :param two: SHA1 of another commit
+        :return: List of SHA1s of the merge bases, empty if the commits have
+            no common history
+        """
+        from dulwich.graph import find_merge_base
+        return find_merge_base(self.object_store, one, two)
+
+    def is_ancestor(self, ancestor, descendant):
+        """Check whether a commit is an ancestor of another commit.
+
+        This can be used to check whether updating a ref from ancestor to
+        descendant is a fast-forward.
+
+        :param ancestor: SHA1 of the possible ancestor
+        :param descendant: SHA1 of the possible descendant
+        :return: True if ancestor is reachable from descendant, or is the
+            same commit
+        """
+        from dulwich.graph import is_ancestor
+        return is_ancestor(self.object_store, ancestor, descendant)
+
     def revision_history(self, head):
         """Returns a list of the commits reachable from head.
 
@@ -812,32 +918,8 @@ class BaseRepo(object):
 
         Raises NotCommitError if any no commits are referenced, including if the
         head parameter isn't the sha of a commit.
-
-        XXX: work out how to handle merges.
         """
-        # We build the list backwards, as parents are more likely to be older
-        # than children
-        pending_commits = [head]
-        history = []
-        while pending_commits != []:
-            head = pending_commits.pop(0)
-            try:
-                commit = self[head]
-            except KeyError:
-                raise MissingCommitError(head)
-            if type(commit) != Commit:
-                raise NotCommitError(commit)
-            if commit in history:
-                continue
-            i = 0
-            for known_commit in history:
-                if known_commit.commit_time > commit.commit_time:
-                    break
-                i += 1
-            history.insert(i, commit)
-            pending_commits += commit.parents
-        history.reverse()
-        return history
+        return list(self.get_walker(include=[head]))
 
     def __getitem__(self, name):
         if len(name) in (20, 40):
@@ -959,6 +1041,26 @@ class Repo(BaseRepo):
                 return None
             raise
 
+    def update_shallow(self, new_shallow, new_unshallow):
+        """Update the shallow commits, as told by the server during a fetch.
+
+        :param new_shallow: SHA1s of commits that became shallow
+        :param new_unshallow: SHA1s of commits whose parents have been
+            fetched
+        """
+        shallow = self.get_shallow()
+        shallow.update(new_shallow)
+        shallow.difference_update(new_unshallow)
+        if shallow:
+            self._put_named_file('shallow',
+                ''.join('%s\n' % sha for sha in sorted(shallow)))
+        else:
+            try:
+                os.remove(os.path.join(self.controldir(), 'shallow'))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
     def index_path(self):
         """Return path to the index file."""
         return os.path.join(self.controldir(), INDEX_FILENAME)
@@ -26,20 +26,39 @@ Documentation/technical directory in the cgit distribution, and in particular:
 """
 
 
+import asyncore
 import collections
 from cStringIO import StringIO
+import errno
+import heapq
+import os
+import Queue
 import socket
 import SocketServer
+import sys
+import threading
+import time
+import traceback
 import zlib
 
 from dulwich.errors import (
     ApplyDeltaError,
     ChecksumMismatch,
     GitProtocolError,
+    HangupException,
+    )
+from dulwich.graph import (
+    find_shallow,
     )
 from dulwich.misc import (
     make_sha,
     )
+from dulwich.object_store import (
+    parse_filter_spec,
+    )
+from dulwich.pack_cache import (
+    make_pack_cache_key,
+    )
 from dulwich.objects import (
     hex_to_sha,
     sha_to_hex,
@@ -50,12 +69,14 @@ from dulwich.protocol import (
     ReceivableProtocol,
     TCP_GIT_PORT,
     ZERO_SHA,
+    DELIM_PKT,
     extract_capabilities,
     extract_want_line_capabilities,
     SINGLE_ACK,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
     ack_type,
+    protocol_version,
     )
 from dulwich.pack import (
     read_pack_header,
@@ -64,7 +85,15 @@ from dulwich.pack import (
     )
 
 class Backend(object):
-    """A backend for the Git smart server implementation."""
+    """A backend for the Git smart server implementation.
+
+    :ivar pack_cache: Optional PackCache for the packs sent to clients
+    :ivar ref_advertisement_cache: Optional RefAdvertisementCache for the
+        refs advertised to clients
+    """
+
+    pack_cache = None
+    ref_advertisement_cache = None
 
     def open_repository(self, path):
         """Open the repository at a path."""
@@ -101,13 +130,15 @@ class BackendRepo(object):
         return None
 
     def fetch_objects(self, determine_wants, graph_walker, progress,
-                      get_tagged=None):
+                      get_tagged=None, refs=None):
         """
         Yield the objects required for a list of commits.
 
         :param progress: is a callback to send progress messages to the client
         :param get_tagged: Function that returns a dict of pointed-to sha -> tag
             sha for including tags.
+        :param refs: Optional dict with the refs to pass to determine_wants,
+            if the caller has read them already
         """
         raise NotImplementedError
 
@@ -211,11 +242,83 @@ class PackStreamVerifier(object):
             raise ChecksumMismatch(pack_sha, calculated_sha)
 
 
+class RefAdvertisementCache(object):
+    """Cache of the ref advertisements sent to clients.
+
+    Advertising the refs of a repository means reading all of them and
+    peeling the tags among them, which is slow for repositories with many
+    refs. The refs, their peeled values and the serialized advertisement are
+    kept until the stamp of the refs changes.
+    """
+
+    def __init__(self):
+        self._refs = {}
+        self._advertisements = {}
+
+    def _get_stamp(self, repo):
+        refs_container = getattr(repo, 'refs', None)
+        if refs_container is None:
+            return None
+        stamp = refs_container.stamp()
+        if stamp is None:
+            return None
+        return refs_container.path, stamp
+
+    def _get_refs(self, repo, path, stamp):
+        entry = self._refs.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1], entry[2]
+        refs = repo.get_refs()
+        peeled = dict((name, repo.get_peeled(name)) for name in refs)
+        self._refs[path] = (stamp, refs, peeled)
+        return refs, peeled
+
+    def get_refs(self, repo):
+        """Get the refs of a repository and their peeled values.
+
+        :param repo: Repository whose refs are advertised
+        :return: Tuple with a dict with the refs and a dict with their peeled
+            values, or None if the refs of the repository can not be cached
+        """
+        path_stamp = self._get_stamp(repo)
+        if path_stamp is None:
+            return None
+        return self._get_refs(repo, *path_stamp)
+
+    def get(self, repo, key, write_advertisement):
+        """Get the refs of a repository and their serialized advertisement.
+
+        :param repo: Repository whose refs are advertised
+        :param key: String that tells apart the different advertisements of
+            a repository
+        :param write_advertisement: Function that takes a Protocol and a dict
+            with refs, and writes the advertisement of the refs to it
+        :return: Tuple with a dict with the refs and the advertisement, or
+            None if the refs of the repository can not be cached
+        """
+        path_stamp = self._get_stamp(repo)
+        if path_stamp is None:
+            return None
+        path, stamp = path_stamp
+        cache_key = (path, key)
+        entry = self._advertisements.get(cache_key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1], entry[2]
+        refs, peeled = self._get_refs(repo, path, stamp)
+        f = StringIO()
+        write_advertisement(Protocol(None, f.write), refs)
+        advertisement = f.getvalue()
+        self._advertisements[cache_key] = (stamp, refs, advertisement)
+        return refs, advertisement
+
+
 class DictBackend(Backend):
     """Trivial backend that looks up Git repositories in a dictionary."""
 
-    def __init__(self, repos):
+    def __init__(self, repos, pack_cache=None):
         self.repos = repos
+        self.pack_cache = pack_cache
+        self.ref_advertisement_cache = RefAdvertisementCache()
 
     def open_repository(self, path):
         # FIXME: What to do in case there is no repo ?
@@ -262,6 +365,37 @@ class Handler(object):
                                    'before asking client' % cap)
         return cap in self._client_capabilities
 
+    def get_ref_advertisement(self, write_advertisement):
+        """Get the cached ref advertisement of the repository.
+
+        :param write_advertisement: Function that takes a Protocol and a dict
+            with refs, and writes the advertisement of the refs to it
+        :return: Tuple with a dict with the refs and the advertisement, or
+            None if the backend has no cache for it
+        """
+        cache = getattr(self.backend, 'ref_advertisement_cache', None)
+        if cache is None:
+            return None
+        key = '%s %s' % (self.__class__.__name__, self.capability_line())
+        return cache.get(self.repo, key, write_advertisement)
+
+    def get_refs(self):
+        """Get the refs of the repository and a function to peel them.
+
+        While the refs don't change, they and their peeled values are served
+        from the ref advertisement cache of the backend, if it has one.
+
+        :return: Tuple with a dict with the refs, and a function that takes
+            the name of one of these refs and returns its peeled value
+        """
+        cache = getattr(self.backend, 'ref_advertisement_cache', None)
+        if cache is not None:
+            cached = cache.get_refs(self.repo)
+            if cached is not None:
+                refs, peeled = cached
+                return refs, peeled.__getitem__
+        return self.repo.get_refs(), self.repo.get_peeled
+
 
 class UploadPackHandler(Handler):
     """Protocol handler for uploading a pack to the server."""
@@ -270,13 +404,15 @@ class UploadPackHandler(Handler):
                  stateless_rpc=False, advertise_refs=False):
         Handler.__init__(self, backend, proto)
         self.repo = backend.open_repository(args[0])
+        self._repo_name = args[0]
         self._graph_walker = None
         self.stateless_rpc = stateless_rpc
         self.advertise_refs = advertise_refs
 
     def capabilities(self):
         return ("multi_ack_detailed", "multi_ack", "side-band-64k", "thin-pack",
-                "ofs-delta", "no-progress", "include-tag")
+                "ofs-delta", "no-progress", "include-tag", "shallow",
+                "filter")
 
     def required_capabilities(self):
         return ("side-band-64k", "thin-pack", "ofs-delta")
@@ -292,51 +428,199 @@ class UploadPackHandler(Handler):
         :param refs: dict of refname -> sha of possible tags; defaults to all of
             the backend's refs.
         :param repo: optional Repo instance for getting peeled refs; defaults to
-            the backend's repo, if available
+            the backend's repo, whose peeled refs may be cached
         :return: dict of peeled_sha -> tag_sha, where tag_sha is the sha of a
             tag whose peeled value is peeled_sha.
         """
         if not self.has_capability("include-tag"):
             return {}
-        if refs is None:
-            refs = self.repo.get_refs()
-        if repo is None:
-            repo = getattr(self.repo, "repo", None)
-            if repo is None:
-                # Bail if we don't have a Repo available; this is ok since
-                # clients must be able to handle if the server doesn't include
-                # all relevant tags.
-                # TODO: fix behavior when missing
-                return {}
+        if repo is not None:
+            get_peeled = repo.get_peeled
+            if refs is None:
+                refs = self.repo.get_refs()
+        elif refs is None:
+            refs, get_peeled = self.get_refs()
+        else:
+            get_peeled = self.repo.get_peeled
         tagged = {}
         for name, sha in refs.iteritems():
-            peeled_sha = repo.get_peeled(name)
-            if peeled_sha != sha:
+            peeled_sha = get_peeled(name)
+            # Tags that can't be peeled are left out; clients must be able
+            # to handle the server not including all relevant tags.
+            if peeled_sha is not None and peeled_sha != sha:
                 tagged[peeled_sha] = sha
         return tagged
 
     def handle(self):
-        write = lambda x: self.proto.write_sideband(1, x)
-
+        current_refs, get_peeled = self.get_refs()
         graph_walker = ProtocolGraphWalker(self, self.repo.object_store,
-            self.repo.get_peeled)
-        objects_iter = self.repo.fetch_objects(
-          graph_walker.determine_wants, graph_walker, self.progress,
-          get_tagged=self.get_tagged)
+            get_peeled)
+        refs = {}
+        wants = []
+        def determine_wants(heads):
+            refs.update(heads)
+            wants.extend(graph_walker.determine_wants(heads))
+            return wants
+        try:
+            objects_iter = self.repo.fetch_objects(
+              determine_wants, graph_walker, self.progress,
+              get_tagged=self.get_tagged, refs=current_refs)
+        except HangupException:
+            if not self.stateless_rpc or graph_walker.depth is None:
+                raise
+            # Stateless clients ask for the shallow commits for a depth in a
+            # request of its own, which ends after the wants.
+            return
+        if not wants:
+            return
+        self._send_pack(graph_walker, refs, wants, objects_iter)
+
+    def _send_pack(self, graph_walker, refs, wants, objects_iter,
+                   send_empty=False):
+        """Send the pack for a fetch on the side-band.
+
+        :param graph_walker: Graph walker with the haves, shallow commits,
+            depth and filter spec of the fetch
+        :param refs: Dictionary with the refs of the repository
+        :param wants: SHA1s of the objects the client wants
+        :param objects_iter: Iterator over the objects to send
+        :param send_empty: Whether to send a pack without objects, rather
+            than nothing at all
+        """
+        write = lambda x: self.proto.write_sideband(1, x)
+        pack_cache = getattr(self.backend, 'pack_cache', None)
+        cache_entry = None
+        if pack_cache is not None:
+            key = make_pack_cache_key(refs, wants, graph_walker.haves,
+                self._client_capabilities, graph_walker.shallow,
+                graph_walker.depth, graph_walker.filter_spec)
+            f = pack_cache.open(self._repo_name, key)
+            if f is not None:
+                try:
+                    self.progress("reusing cached pack\n")
+                    for data in iter(lambda: f.read(65515), ''):
+                        write(data)
+                finally:
+                    f.close()
+                self.proto.write("0000")
+                return
 
         # Do they want any objects?
-        if len(objects_iter) == 0:
+        if len(objects_iter) == 0 and not send_empty:
             return
 
-        self.progress("dul-daemon says what\n")
-        self.progress("counting objects: %d, done.\n" % len(objects_iter))
-        write_pack_data(ProtocolFile(None, write), objects_iter, 
-                        len(objects_iter))
+        if pack_cache is not None:
+            cache_entry = pack_cache.add(self._repo_name, key)
+        if cache_entry is not None:
+            cache_file, commit, abort = cache_entry
+            def write(data):
+                self.proto.write_sideband(1, data)
+                cache_file.write(data)
+        try:
+            self.progress("dul-daemon says what\n")
+            self.progress("counting objects: %d, done.\n" % len(objects_iter))
+            write_pack_data(ProtocolFile(None, write), objects_iter, 
+                            len(objects_iter))
+        except:
+            if cache_entry is not None:
+                abort()
+            raise
+        if cache_entry is not None:
+            commit()
         self.progress("how was that, then?\n")
         # we are done
         self.proto.write("0000")
 
 
+def _find_shallow_updates(store, wants, depth, client_shallow):
+    """Find how the shallow commits of a client change for a depth.
+
+    :param store: Object store to look up the commits in
+    :param wants: SHA1s requested by the client
+    :param depth: Number of commits the client wants on each line of history
+    :param client_shallow: Set of the client's current shallow commits
+    :return: Tuple with the set of commits that are shallow at the depth, and
+        the set of the client's shallow commits that no longer are
+    """
+    heads = []
+    for sha in wants:
+        obj = store[sha]
+        while obj.type_name == "tag":
+            obj = store[obj.object[1]]
+        if obj.type_name == "commit":
+            heads.append(obj.id)
+    new_shallow, not_shallow = find_shallow(store, heads, depth)
+    return new_shallow, client_shallow & not_shallow
+
+
+class _WantReachability(object):
+    """Incrementally computed reachability from a set of wants.
+
+    Commits are painted with a bit for each want they are reachable from,
+    walking from the wants towards older commits. The walk only goes as far
+    back as the oldest have asked about so far, and every commit is painted
+    once per want, so a whole negotiation costs about as much as a single walk
+    of the history between the wants and the oldest have.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._bits = {}
+        self._masks = {}
+        self._propagated = {}
+        self._queue = []
+        self._counter = 0
+
+    def _push(self, sha):
+        self._counter += 1
+        heapq.heappush(self._queue,
+                       (-self.store.get_commit_time(sha), self._counter, sha))
+
+    def _paint(self, sha, mask):
+        old = self._masks.get(sha, 0)
+        if old | mask != old:
+            self._masks[sha] = old | mask
+            self._push(sha)
+
+    def want_bit(self, want):
+        """Return the bit for a want, or 0 if it is not a commit."""
+        try:
+            return self._bits[want]
+        except KeyError:
+            pass
+        if self.store[want].type_name != "commit":
+            # non-commit wants have no history to search
+            bit = 0
+        else:
+            bit = 1 << len(self._bits)
+            # The parents of the wants are searched whatever their age
+            self._masks[want] = self._masks.get(want, 0) | bit
+            self._propagated[want] = self._propagated.get(want, 0) | bit
+            for parent in self.store.get_parents(want):
+                self._paint(parent, bit)
+        self._bits[want] = bit
+        return bit
+
+    def walk_until(self, earliest):
+        """Paint all commits that are not older than a timestamp."""
+        while self._queue and -self._queue[0][0] >= earliest:
+            _, _, sha = heapq.heappop(self._queue)
+            new = self._masks[sha] & ~self._propagated.get(sha, 0)
+            if not new:
+                continue
+            self._propagated[sha] = self._masks[sha]
+            for parent in self.store.get_parents(sha):
+                self._paint(parent, new)
+
+    def wants_reaching(self, sha):
+        """Return the bits of the wants a commit is known to be reachable from.
+
+        :note: Only commits not older than the timestamp last passed to
+            walk_until() are guaranteed to have been painted.
+        """
+        return self._masks.get(sha, 0)
+
+
 class ProtocolGraphWalker(object):
     """A graph walker that knows the git protocol.
 
@@ -358,6 +642,14 @@ class ProtocolGraphWalker(object):
         self.stateless_rpc = handler.stateless_rpc
         self.advertise_refs = handler.advertise_refs
         self._wants = []
+        # Commits whose parents the client doesn't have or won't be sent
+        self.shallow = set()
+        self.depth = None
+        # SHA1s the client has that are in the repository
+        self.haves = []
+        # Filter spec for a partial clone, if the client asked for one
+        self.filter_spec = None
+        self._reachability = _WantReachability(object_store)
         self._cached = False
         self._cache = []
         self._cache_index = 0
@@ -371,28 +663,33 @@ class ProtocolGraphWalker(object):
         same regardless of ack type, and in fact is used to set the ack type of
         the ProtocolGraphWalker.
 
+        A shallow client also lists its shallow commits, and may ask for the
+        history to be cut off at a certain depth; the commits where it is cut
+        off are then sent to the client, and kept in the shallow attribute
+        along with the client's own shallow commits.
+
+        A client doing a partial clone adds a filter spec, which is kept in
+        the filter_spec attribute.
+
         :param heads: a dict of refname->SHA1 to advertise
-        :return: a list of SHA1s requested by the client
+        :return: a list of SHA1s requested by the client, including the
+            parents of commits that are no longer shallow
         """
         if not heads:
             raise GitProtocolError('No heads found')
-        values = set(heads.itervalues())
         if self.advertise_refs or not self.stateless_rpc:
-            for i, (ref, sha) in enumerate(heads.iteritems()):
-                line = "%s %s" % (sha, ref)
-                if not i:
-                    line = "%s\x00%s" % (line, self.handler.capability_line())
-                self.proto.write_pkt_line("%s\n" % line)
-                peeled_sha = self.get_peeled(ref)
-                if peeled_sha != sha:
-                    self.proto.write_pkt_line('%s %s^{}\n' %
-                                              (peeled_sha, ref))
-
-            # i'm done..
-            self.proto.write_pkt_line(None)
+            advertisement = self.handler.get_ref_advertisement(
+                self._write_advertisement)
+            if advertisement is None:
+                self._write_advertisement(self.proto, heads)
+            else:
+                # Check the wants against the refs that were advertised
+                heads, data = advertisement
+                self.proto.write(data)
 
             if self.advertise_refs:
                 return []
+        values = set(heads.itervalues())
 
         # Now client will sending want want want commands
         want = self.proto.read_pkt_line()
@@ -404,20 +701,71 @@ class ProtocolGraphWalker(object):
         command, sha = self._split_proto_line(line)
 
         want_revs = []
+        client_shallow = set()
+        depth = None
+        filter_spec = None
         while command != None:
-            if command != 'want':
+            if command == 'want':
+                if sha not in values:
+                    raise GitProtocolError(
+                        'Client wants invalid object %s' % sha)
+                want_revs.append(sha)
+            elif command == 'shallow':
+                client_shallow.add(sha)
+            elif command == 'deepen':
+                depth = sha
+            elif command == 'filter':
+                filter_spec = sha
+            else:
                 raise GitProtocolError(
                     'Protocol got unexpected command %s' % command)
-            if sha not in values:
-                raise GitProtocolError(
-                    'Client wants invalid object %s' % sha)
-            want_revs.append(sha)
             command, sha = self.read_proto_line()
 
         self.set_wants(want_revs)
+        self.shallow = set(client_shallow)
+        self.depth = depth
+        self.filter_spec = filter_spec
+        if depth is not None:
+            return want_revs + self._deepen(want_revs, depth, client_shallow)
         return want_revs
 
+    def _write_advertisement(self, proto, heads):
+        for i, (ref, sha) in enumerate(heads.iteritems()):
+            line = "%s %s" % (sha, ref)
+            if not i:
+                line = "%s\x00%s" % (line, self.handler.capability_line())
+            proto.write_pkt_line("%s\n" % line)
+            peeled_sha = self.get_peeled(ref)
+            if peeled_sha != sha:
+                proto.write_pkt_line('%s %s^{}\n' % (peeled_sha, ref))
+
+        # i'm done..
+        proto.write_pkt_line(None)
+
+    def _deepen(self, wants, depth, client_shallow):
+        """Send the client the changes to its shallow commits for a depth.
+
+        :param wants: SHA1s requested by the client
+        :param depth: Number of commits the client wants on each line of
+            history
+        :param client_shallow: Set of the client's current shallow commits
+        :return: List of SHA1s of the parents of commits that are no longer
+            shallow, which have to be sent in addition to the wants
+        """
+        new_shallow, unshallow = _find_shallow_updates(self.store, wants,
+                                                       depth, client_shallow)
+        for sha in sorted(new_shallow - client_shallow):
+            self.proto.write_pkt_line('shallow %s\n' % sha)
+        extra_wants = []
+        for sha in sorted(unshallow):
+            self.proto.write_pkt_line('unshallow %s\n' % sha)
+            extra_wants.extend(self.store.get_parents(sha))
+        self.proto.write_pkt_line(None)
+        self.shallow.update(new_shallow)
+        return extra_wants
+
     def ack(self, have_ref):
+        self.haves.append(have_ref)
         return self._impl.ack(have_ref)
 
     def reset(self):
@@ -438,7 +786,21 @@ class ProtocolGraphWalker(object):
         fields = line.rstrip('\n').split(' ', 1)
         if len(fields) == 1 and fields[0] == 'done':
             return ('done', None)
-        elif len(fields) == 2 and fields[0] in ('want', 'have'):
+        elif len(fields) == 2 and fields[0] == 'deepen':
+            try:
+                depth = int(fields[1])
+            except ValueError:
+                depth = 0
+            if depth < 1:
+                raise GitProtocolError('Invalid depth %s' % fields[1])
+            return ('deepen', depth)
+        elif len(fields) == 2 and fields[0] == 'filter':
+            try:
+                parse_filter_spec(fields[1])
+            except ValueError, e:
+                raise GitProtocolError(e)
+            return tuple(fields)
+        elif len(fields) == 2 and fields[0] in ('want', 'have', 'shallow'):
             try:
                 hex_to_sha(fields[1])
                 return tuple(fields)
@@ -452,6 +814,9 @@ class ProtocolGraphWalker(object):
         :return: a tuple having one of the following forms:
             ('want', obj_id)
             ('have', obj_id)
+            ('shallow', obj_id)
+            ('deepen', depth)
+            ('filter', filter_spec)
             ('done', None)
             (None, None)  (for a flush-pkt)
 
@@ -486,35 +851,47 @@ class ProtocolGraphWalker(object):
             terminated, presumably because we're searching too far down the
             wrong branch.
         """
-        o = self.store[want]
-        pending = collections.deque([o])
-        while pending:
-            commit = pending.popleft()
-            if commit.id in haves:
+        if want in haves:
+            return True
+        bit = self._reachability.want_bit(want)
+        if not bit:
+            return False
+        self._reachability.walk_until(earliest)
+        for have in haves:
+            if self._reachability.wants_reaching(have) & bit:
                 return True
-            if commit.type_name != "commit":
-                # non-commit wants are assumed to be satisfied
-                continue
-            for parent in commit.parents:
-                parent_obj = self.store[parent]
-                # TODO: handle parents with later commit times than children
-                if parent_obj.commit_time >= earliest:
-                    pending.append(parent_obj)
         return False
 
     def all_wants_satisfied(self, haves):
         """Check whether all the current wants are satisfied by a set of haves.
 
+        What is learned about the history is kept between calls, so each
+        commit is only visited once during a negotiation.
+
         :param haves: A set of commits we know the client has.
         :note: Wants are specified with set_wants rather than passed in since
             in the current interface they are determined outside this class.
         """
         haves = set(haves)
-        earliest = min([self.store[h].commit_time for h in haves])
+        needed = 0
         for want in self._wants:
-            if not self._is_satisfied(haves, want, earliest):
+            if want in haves:
+                continue
+            bit = self._reachability.want_bit(want)
+            if not bit:
                 return False
-        return True
+            needed |= bit
+        if not needed:
+            return True
+        if not haves:
+            return False
+        earliest = min([self.store.get_commit_time(h) for h in haves])
+        self._reachability.walk_until(earliest)
+        for have in haves:
+            needed &= ~self._reachability.wants_reaching(have)
+            if not needed:
+                return True
+        return False
 
     def set_ack_type(self, ack_type):
         impl_classes = {
@@ -634,6 +1011,7 @@ class ReceivePackHandler(Handler):
                  stateless_rpc=False, advertise_refs=False):
         Handler.__init__(self, backend, proto)
         self.repo = backend.open_repository(args[0])
+        self._repo_name = args[0]
         self.stateless_rpc = stateless_rpc
         self.advertise_refs = advertise_refs
 
@@ -685,24 +1063,36 @@ class ReceivePackHandler(Handler):
             else:
                 status.append((ref, 'ok'))
 
+        pack_cache = getattr(self.backend, 'pack_cache', None)
+        if pack_cache is not None:
+            # The cached packs would not be used again anyway, as their keys
+            # include the refs
+            pack_cache.invalidate(self._repo_name)
         return status
 
-    def handle(self):
-        refs = self.repo.get_refs().items()
+    def _write_advertisement(self, proto, refs):
+        refs = refs.items()
+        if refs:
+            proto.write_pkt_line(
+              "%s %s\x00%s\n" % (refs[0][1], refs[0][0],
+                                 self.capability_line()))
+            for i in range(1, len(refs)):
+                ref = refs[i]
+                proto.write_pkt_line("%s %s\n" % (ref[1], ref[0]))
+        else:
+            proto.write_pkt_line("%s capabilities^{} %s" % (
+              ZERO_SHA, self.capability_line()))
+
+        proto.write("0000")
 
+    def handle(self):
         if self.advertise_refs or not self.stateless_rpc:
-            if refs:
-                self.proto.write_pkt_line(
-                  "%s %s\x00%s\n" % (refs[0][1], refs[0][0],
-                                     self.capability_line()))
-                for i in range(1, len(refs)):
-                    ref = refs[i]
-                    self.proto.write_pkt_line("%s %s\n" % (ref[1], ref[0]))
+            advertisement = self.get_ref_advertisement(
+                self._write_advertisement)
+            if advertisement is None:
+                self._write_advertisement(self.proto, self.repo.get_refs())
             else:
-                self.proto.write_pkt_line("%s capabilities^{} %s" % (
-                  ZERO_SHA, self.capability_line()))
-
-            self.proto.write("0000")
+                self.proto.write(advertisement[1])
             if self.advertise_refs:
                 return
 
@@ -737,29 +1127,975 @@ class ReceivePackHandler(Handler):
             self.proto.write_pkt_line(None)
 
 
+class _FetchRequestGraphWalker(object):
+    """Graph walker over the haves of a protocol version 2 fetch request."""
+
+    def __init__(self, haves, shallow, depth, filter_spec):
+        self._pending = list(haves)
+        # SHA1s the client has that are in the repository
+        self.haves = []
+        self.shallow = shallow
+        self.depth = depth
+        self.filter_spec = filter_spec
+
+    def next(self):
+        if not self._pending:
+            return None
+        return self._pending.pop(0)
+
+    def ack(self, have_ref):
+        self.haves.append(have_ref)
+
+
+class UploadPackV2Handler(UploadPackHandler):
+    """Protocol handler for uploading a pack with protocol version 2.
+
+    Rather than advertising all of its refs, the server only advertises its
+    capabilities. The client then sends commands, each in a request of its
+    own: ls-refs to list the refs it is interested in, and fetch to
+    negotiate the objects it needs and get the pack.
+    """
+
+    def capabilities(self):
+        return ("ls-refs", "fetch=shallow filter")
+
+    def required_capabilities(self):
+        return ()
+
+    def handle(self):
+        if self.advertise_refs or not self.stateless_rpc:
+            self.proto.write_pkt_line("version 2\n")
+            for capability in self.capabilities():
+                self.proto.write_pkt_line("%s\n" % capability)
+            self.proto.write_pkt_line(None)
+            if self.advertise_refs:
+                return
+        while True:
+            request = self._read_command()
+            if request is None:
+                return
+            command, args = request
+            if command == "ls-refs":
+                self._ls_refs(args)
+            elif command == "fetch":
+                self._fetch(args)
+            else:
+                raise GitProtocolError("Unknown command %s" % command)
+            if self.stateless_rpc:
+                return
+
+    def _read_command(self):
+        """Read a command request from the client.
+
+        :return: Tuple with the command and its arguments, or None if the
+            client has no more commands
+        """
+        try:
+            pkt = self.proto.read_pkt_line()
+        except HangupException:
+            return None
+        if pkt is None:
+            return None
+        if pkt is DELIM_PKT or not pkt.startswith("command="):
+            raise GitProtocolError("Expected a command, got %r" % pkt)
+        command = pkt.rstrip("\n")[len("command="):]
+        # Skip the capabilities of the client, such as its agent
+        pkt = self.proto.read_pkt_line()
+        while pkt is not None and pkt is not DELIM_PKT:
+            pkt = self.proto.read_pkt_line()
+        args = []
+        if pkt is DELIM_PKT:
+            for pkt in self.proto.read_pkt_seq():
+                if pkt is DELIM_PKT:
+                    raise GitProtocolError("Unexpected delim-pkt in the "
+                                           "arguments of %s" % command)
+                args.append(pkt.rstrip("\n"))
+        return command, args
+
+    def _list_refs(self, prefixes):
+        """List the refs with any of a list of prefixes.
+
+        Only the refs under the directories of the prefixes are read.
+
+        :param prefixes: List of prefixes, or an empty list for all refs
+        :return: Dictionary mapping the names of the refs to tuples with
+            their SHA1 and, for symbolic refs, the name of the ref they point
+            at
+        """
+        refs_container = getattr(self.repo, "refs", None)
+        if refs_container is None:
+            return dict((name, (sha, None)) for name, sha in
+                        self.repo.get_refs().iteritems()
+                        if not prefixes or
+                        [p for p in prefixes if name.startswith(p)])
+        if prefixes:
+            names = set()
+            for prefix in prefixes:
+                if "/" in prefix:
+                    base = prefix[:prefix.rindex("/")]
+                    keys = ["%s/%s" % (base, key)
+                            for key in refs_container.keys(base)]
+                else:
+                    keys = []
+                    if "HEAD".startswith(prefix):
+                        keys.append("HEAD")
+                    if "refs/".startswith(prefix):
+                        keys.extend("refs/%s" % key
+                                    for key in refs_container.keys("refs"))
+                names.update(key for key in keys if key.startswith(prefix))
+        else:
+            names = refs_container.keys()
+        refs = {}
+        for name in names:
+            target, sha = refs_container._follow(name)
+            if sha is None:
+                # Broken symbolic ref
+                continue
+            if target == name:
+                target = None
+            refs[name] = (sha, target)
+        return refs
+
+    def _ls_refs(self, args):
+        peel = False
+        symrefs = False
+        prefixes = []
+        for arg in args:
+            if arg == "peel":
+                peel = True
+            elif arg == "symrefs":
+                symrefs = True
+            elif arg.startswith("ref-prefix "):
+                prefixes.append(arg[len("ref-prefix "):])
+            else:
+                raise GitProtocolError("Unexpected ls-refs argument %s" % arg)
+        refs = self._list_refs(prefixes)
+        if peel:
+            current_refs, get_peeled = self.get_refs()
+        for name, (sha, target) in sorted(refs.iteritems()):
+            line = "%s %s" % (sha, name)
+            if symrefs and target is not None:
+                line += " symref-target:%s" % target
+            if peel:
+                if current_refs.get(name) == sha:
+                    peeled_sha = get_peeled(name)
+                else:
+                    peeled_sha = self.repo.get_peeled(name)
+                if peeled_sha != sha:
+                    line += " peeled:%s" % peeled_sha
+            self.proto.write_pkt_line("%s\n" % line)
+        self.proto.write_pkt_line(None)
+
+    def _fetch(self, args):
+        refs, get_peeled = self.get_refs()
+        walker = ProtocolGraphWalker(self, self.repo.object_store,
+                                     get_peeled)
+        wants = []
+        haves = []
+        client_shallow = set()
+        depth = None
+        deepen_relative = False
+        filter_spec = None
+        done = False
+        capabilities = []
+        for arg in args:
+            if arg in self.innocuous_capabilities():
+                capabilities.append(arg)
+                continue
+            if arg == "deepen-relative":
+                deepen_relative = True
+                continue
+            command, value = walker._split_proto_line(arg)
+            if command == "want":
+                wants.append(value)
+            elif command == "have":
+                haves.append(value)
+            elif command == "shallow":
+                client_shallow.add(value)
+            elif command == "deepen":
+                depth = value
+            elif command == "filter":
+                filter_spec = value
+            elif command == "done":
+                done = True
+        self._client_capabilities = set(capabilities)
+        values = set(refs.itervalues())
+        for sha in wants:
+            if sha not in values:
+                raise GitProtocolError("Client wants invalid object %s" % sha)
+        if not wants:
+            raise GitProtocolError("Fetch without wants")
+        store = self.repo.object_store
+        common = [sha for sha in haves if sha in store]
+
+        if not done:
+            # The client is still negotiating; tell it which of its commits
+            # are known, and send the pack if they are enough
+            self.proto.write_pkt_line("acknowledgments\n")
+            for sha in common:
+                self.proto.write_pkt_line("ACK %s\n" % sha)
+            if not common:
+                self.proto.write_pkt_line("NAK\n")
+            walker.set_wants(wants)
+            if not common or not walker.all_wants_satisfied(common):
+                self.proto.write_pkt_line(None)
+                return
+            self.proto.write_pkt_line("ready\n")
+            self.proto.write_pkt_line(DELIM_PKT)
+
+        shallow = set(client_shallow)
+        extra_wants = []
+        if depth is not None:
+            if deepen_relative:
+                # The depth counts from the current shallow commits
+                heads = [sha for sha in client_shallow if sha in store]
+                new_shallow, unshallow = _find_shallow_updates(
+                    store, heads, depth + 1, client_shallow)
+            else:
+                new_shallow, unshallow = _find_shallow_updates(
+                    store, wants, depth, client_shallow)
+            self.proto.write_pkt_line("shallow-info\n")
+            for sha in sorted(new_shallow - client_shallow):
+                self.proto.write_pkt_line("shallow %s\n" % sha)
+            for sha in sorted(unshallow):
+                self.proto.write_pkt_line("unshallow %s\n" % sha)
+                extra_wants.extend(store.get_parents(sha))
+            self.proto.write_pkt_line(DELIM_PKT)
+            shallow.update(new_shallow)
+
+        graph_walker = _FetchRequestGraphWalker(common, shallow, depth,
+                                                filter_spec)
+        objects_iter = self.repo.fetch_objects(
+            lambda heads: wants + extra_wants, graph_walker, self.progress,
+            get_tagged=self.get_tagged, refs=refs)
+        self.proto.write_pkt_line("packfile\n")
+        self._send_pack(graph_walker, refs, wants, objects_iter,
+                        send_empty=True)
+
+
+# Handlers for the commands that git:// clients can send
+DEFAULT_HANDLERS = {
+    'git-upload-pack': UploadPackHandler,
+    'git-receive-pack': ReceivePackHandler,
+    }
+
+# Handlers for the commands of clients that asked for protocol version 2
+PROTOCOL_V2_HANDLERS = {
+    'git-upload-pack': UploadPackV2Handler,
+    }
+
+
+def get_handler_class(command, args):
+    """Find the handler for a command sent by a git:// client.
+
+    :param command: Name of the command
+    :param args: Arguments of the command; after the path and host, extra
+        parameters such as the protocol version follow an empty argument
+    :return: Handler class, or None if the command is unknown
+    """
+    if "" in args:
+        extra_parameters = args[args.index("") + 1:]
+        if protocol_version(extra_parameters) == 2:
+            cls = PROTOCOL_V2_HANDLERS.get(command)
+            if cls is not None:
+                return cls
+    return DEFAULT_HANDLERS.get(command)
+
+
 class TCPGitRequestHandler(SocketServer.StreamRequestHandler):
 
+    def setup(self):
+        self.request.settimeout(self.server.connection_timeout)
+        SocketServer.StreamRequestHandler.setup(self)
+
     def handle(self):
+        # Connections that stall for longer than the timeout are dropped
+        try:
+            self._handle()
+        except socket.timeout:
+            pass
+        except GitProtocolError, e:
+            # Protocol wraps the socket errors it runs into
+            if not (e.args and isinstance(e.args[0], socket.timeout)):
+                raise
+
+    def _handle(self):
         proto = ReceivableProtocol(self.connection.recv, self.wfile.write)
         command, args = proto.read_cmd()
 
-        # switch case to handle the specific git command
-        if command == 'git-upload-pack':
-            cls = UploadPackHandler
-        elif command == 'git-receive-pack':
-            cls = ReceivePackHandler
-        else:
+        cls = get_handler_class(command, args)
+        if cls is None:
             return
 
         h = cls(self.server.backend, args, proto)
         h.handle()
 
 
+# Same as the default of git daemon --max-connections
+DEFAULT_MAX_CONNECTIONS = 32
+
+
 class TCPGitServer(SocketServer.TCPServer):
+    """Git daemon that serves one connection at a time.
+
+    :ivar connection_timeout: Number of seconds a connection may stall before
+        it is dropped, or None to wait forever
+    """
 
     allow_reuse_address = True
+    # Clients wait in the listen queue while all connections are busy
+    request_queue_size = 128
+    # Seconds between checks for shutdown while all connections are busy
+    busy_poll_interval = 0.05
     serve = SocketServer.TCPServer.serve_forever
 
-    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT):
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 connection_timeout=None):
         self.backend = backend
+        self.connection_timeout = connection_timeout
         SocketServer.TCPServer.__init__(self, (listen_addr, port), TCPGitRequestHandler)
+
+    def wait_for_connections(self, timeout=None):
+        """Wait for the connections that are being served to finish.
+
+        :param timeout: Optional number of seconds to wait
+        :return: True if all connections have finished
+        """
+        return True
+
+    def _shutdown_requested(self):
+        return self._BaseServer__shutdown_request
+
+    def _stop_serving(self):
+        # Exceptions raised while a request is being processed are reported
+        # and then ignored by serve_forever(), so a KeyboardInterrupt raised
+        # by a signal handler stops it the way shutdown() does instead
+        self._BaseServer__shutdown_request = True
+
+    def shutdown_gracefully(self, timeout=None):
+        """Stop accepting connections and let the current ones finish.
+
+        This must be called while serve() is running in another thread.
+
+        :param timeout: Optional number of seconds to wait for the current
+            connections
+        :return: True if all connections have finished
+        """
+        self.shutdown()
+        self.server_close()
+        return self.wait_for_connections(timeout)
+
+
+class ThreadedTCPGitServer(SocketServer.ThreadingMixIn, TCPGitServer):
+    """Git daemon that serves each connection in a separate thread.
+
+    At most max_connections connections are served at once; further clients
+    wait in the listen queue until a connection finishes, or are disconnected
+    if the server is shut down first. The connections share the repositories
+    of the backend, and so their packs, which can be read from several
+    threads at once.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 connection_timeout=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._active = 0
+        self._active_changed = threading.Condition()
+        TCPGitServer.__init__(self, backend, listen_addr, port,
+                              connection_timeout)
+
+    def _connection_finished(self):
+        self._active_changed.acquire()
+        try:
+            self._active -= 1
+            self._active_changed.notifyAll()
+        finally:
+            self._active_changed.release()
+
+    def _start_connection(self):
+        """Wait until a connection can be served, and count it as active.
+
+        :return: False if the server was shut down while waiting
+        """
+        self._active_changed.acquire()
+        try:
+            while self._active >= self.max_connections:
+                if self._shutdown_requested():
+                    return False
+                # Unlike a plain wait(), this also lets signal handlers run
+                self._active_changed.wait(self.busy_poll_interval)
+            self._active += 1
+            return True
+        finally:
+            self._active_changed.release()
+
+    def process_request(self, request, client_address):
+        try:
+            started = self._start_connection()
+        except KeyboardInterrupt:
+            self._stop_serving()
+            started = False
+        if not started:
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+        except:
+            self._connection_finished()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self._connection_finished()
+
+    def wait_for_connections(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._active_changed.acquire()
+        try:
+            while self._active:
+                if timeout is None:
+                    self._active_changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._active_changed.wait(remaining)
+            return True
+        finally:
+            self._active_changed.release()
+
+
+class ForkingTCPGitServer(SocketServer.ForkingMixIn, TCPGitServer):
+    """Git daemon that serves each connection in a child process.
+
+    At most max_connections connections are served at once; further clients
+    wait in the listen queue until a child process exits, or are disconnected
+    if the server is shut down first.
+    """
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 connection_timeout=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.max_children = max_connections
+        TCPGitServer.__init__(self, backend, listen_addr, port,
+                              connection_timeout)
+
+    def finish_request(self, request, client_address):
+        # Only called in the child process, which should not keep the
+        # listening socket open once the server is closed
+        self.socket.close()
+        TCPGitServer.finish_request(self, request, client_address)
+
+    def _reap_children(self):
+        # collect_children() blocks while there are too many children
+        for pid in list(self.active_children or []):
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                finished = pid
+            if finished:
+                self.active_children.remove(pid)
+
+    def _wait_for_child(self):
+        """Wait until fewer than max_connections children are running.
+
+        :return: False if the server was shut down while waiting
+        """
+        while True:
+            self._reap_children()
+            if len(self.active_children or []) < self.max_children:
+                return True
+            if self._shutdown_requested():
+                return False
+            time.sleep(self.busy_poll_interval)
+
+    def process_request(self, request, client_address):
+        try:
+            free = self._wait_for_child()
+        except KeyboardInterrupt:
+            self._stop_serving()
+            free = False
+        if not free:
+            self.shutdown_request(request)
+            return
+        SocketServer.ForkingMixIn.process_request(self, request,
+                                                  client_address)
+
+    def wait_for_connections(self, timeout=None, poll_interval=0.05):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            self._reap_children()
+            if not self.active_children:
+                return True
+            if timeout is not None and time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+
+class _PoolWakeUp(asyncore.dispatcher):
+    """Socket pair that wakes up the event loop of an PooledTCPGitServer.
+
+    A loopback connection is used rather than a pipe, which would not work
+    with select() on Windows.
+    """
+
+    def __init__(self, map):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self._sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sender.connect(listener.getsockname())
+            receiver, _ = listener.accept()
+        finally:
+            listener.close()
+        self._sender.setblocking(0)
+        asyncore.dispatcher.__init__(self, receiver, map)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.socket.recv(4096)
+        except socket.error:
+            pass
+
+    def wake(self):
+        try:
+            self._sender.send('x')
+        except socket.error, e:
+            # If the buffer is full the loop will wake up anyway, and once
+            # the server is shut down there is nothing left to wake up
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._sender.close()
+
+
+class _PooledGitConnection(asyncore.dispatcher):
+    """Connection of an PooledTCPGitServer.
+
+    The event loop does all the socket I/O and buffers the data. Once the
+    client has sent its request, a worker thread runs the handler, which
+    reads and writes through the buffers with recv_data() and write_data().
+    These block the worker while the handler waits for the client to send
+    more data, or to receive the data already buffered.
+    """
+
+    def __init__(self, server, sock, client_address, map):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.server = server
+        self.client_address = client_address
+        self._cond = threading.Condition()
+        self._in = []
+        self._in_len = 0
+        self._out = collections.deque()
+        self._out_len = 0
+        self._eof = False
+        self.closed = False
+        self.started = False
+        self.finished = False
+        # Whether the handler is waiting for the client
+        self.waiting = False
+        self.last_activity = time.time()
+
+    def __hash__(self):
+        # asyncore.dispatcher would look this up on the socket
+        return id(self)
+
+    def readable(self):
+        return (not self._eof and not self.closed and
+                self._in_len < self.server.buffer_size)
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.handle_close()
+            return
+        self._cond.acquire()
+        try:
+            self.last_activity = time.time()
+            if data:
+                self._in.append(data)
+                self._in_len += len(data)
+            else:
+                self._eof = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if not self.started:
+            if self._eof:
+                self.handle_close()
+            else:
+                self._start_request()
+
+    def _start_request(self):
+        data = ''.join(self._in)
+        if len(data) < 4:
+            return
+        try:
+            size = int(data[:4], 16)
+        except ValueError:
+            size = 0
+        if size <= 4:
+            self.handle_close()
+            return
+        if len(data) < size:
+            return
+        line = data[4:size]
+        if len(data) > size:
+            self._in = [data[size:]]
+        else:
+            self._in = []
+        self._in_len = len(data) - size
+        splice_at = line.find(" ")
+        if splice_at == -1 or not line.endswith("\x00"):
+            self.handle_close()
+            return
+        command, args = line[:splice_at], line[splice_at+1:-1].split("\x00")
+        self.started = True
+        self.server.run_handler(self, command, args)
+
+    def handle_write(self):
+        self._cond.acquire()
+        try:
+            try:
+                sent = self.socket.send(self._out[0])
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                sent = None
+            if sent is not None:
+                self.last_activity = time.time()
+                if sent < len(self._out[0]):
+                    self._out[0] = self._out[0][sent:]
+                else:
+                    self._out.popleft()
+                self._out_len -= sent
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if sent is None or (self.finished and not self._out):
+            self.handle_close()
+
+    def handle_close(self):
+        self._cond.acquire()
+        try:
+            self.closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self.close()
+
+    def handle_error(self):
+        self.server.handle_error(self)
+        self.handle_close()
+
+    def _wait(self):
+        self.waiting = True
+        self.last_activity = time.time()
+        try:
+            self._cond.wait()
+        finally:
+            self.waiting = False
+
+    def recv_data(self, size):
+        """Read up to size bytes from the client, as socket.recv() does.
+
+        Called by the handler thread; blocks until data is available.
+        """
+        self._cond.acquire()
+        try:
+            while not self._in_len and not self._eof and not self.closed:
+                self._wait()
+            if not self._in_len:
+                return ''
+            was_full = self._in_len >= self.server.buffer_size
+            data = self._in[0]
+            if len(data) > size:
+                self._in[0] = data[size:]
+                data = data[:size]
+            else:
+                del self._in[0]
+            self._in_len -= len(data)
+        finally:
+            self._cond.release()
+        if was_full:
+            self.server.wake()
+        return data
+
+    def write_data(self, data):
+        """Send data to the client.
+
+        Called by the handler thread; blocks while too much data is waiting
+        to be sent.
+        """
+        self._cond.acquire()
+        try:
+            while (self._out_len >= self.server.buffer_size and
+                   not self.closed):
+                self._wait()
+            if self.closed:
+                raise socket.error(errno.EPIPE, 'Connection closed')
+            was_empty = not self._out
+            self._out.append(data)
+            self._out_len += len(data)
+        finally:
+            self._cond.release()
+        if was_empty:
+            self.server.wake()
+
+    def finish(self):
+        """Mark the handler as done, so the connection is closed."""
+        self.finished = True
+        self.server.wake()
+
+
+class PooledTCPGitServer(asyncore.dispatcher):
+    """Git daemon that serves requests in a bounded pool of worker threads.
+
+    A single event loop accepts the connections and buffers the data sent
+    in both directions. Connections only cost a socket and their buffers
+    until the client has sent its request, so clients that connect and stay
+    idle do not hold up the others. Each request is then handled from start
+    to finish by one of max_workers threads; requests wait in the event loop
+    for a free worker.
+
+    A worker stays busy while its handler waits for the client, for
+    instance during negotiation or when the client reads the pack slowly.
+    At most max_workers requests are served at once, so max_workers slow
+    clients can still hold up the others, until connection_timeout drops
+    them.
+
+    :ivar connection_timeout: Number of seconds a connection may stall before
+        it is dropped, or None to wait forever
+    """
+
+    request_queue_size = 128
+    # Maximum number of bytes buffered in each direction of a connection
+    buffer_size = 256 * 1024
+
+    def __init__(self, backend, listen_addr, port=TCP_GIT_PORT,
+                 connection_timeout=None, max_workers=DEFAULT_MAX_CONNECTIONS):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.backend = backend
+        self.connection_timeout = connection_timeout
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((listen_addr, port))
+        self.listen(self.request_queue_size)
+        self._wake_up = _PoolWakeUp(self._map)
+        self._connections = set()
+        self._listening = True
+        self._closing = False
+        self._serving = False
+        self._stop = False
+        self._is_shut_down = threading.Event()
+        self._idle = threading.Condition()
+        self._requests = Queue.Queue()
+        self._workers = []
+        for i in range(max_workers):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def wake(self):
+        """Wake up the event loop, from any thread."""
+        self._wake_up.wake()
+
+    def readable(self):
+        return self._listening
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, client_address = pair
+        self._connections.add(
+            _PooledGitConnection(self, sock, client_address, self._map))
+
+    def handle_error(self, connection=None):
+        """Report an exception, like SocketServer.BaseServer.handle_error.
+
+        The report is written to sys.stderr.
+        """
+        sys.stderr.write('-' * 40 + '\n')
+        if connection is not None:
+            sys.stderr.write('Exception happened during processing of '
+                             'request from %s\n' %
+                             (connection.client_address,))
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('-' * 40 + '\n')
+
+    def run_handler(self, connection, command, args):
+        """Queue the handler for a request, to run in a worker thread."""
+        self._requests.put((connection, command, args))
+
+    def _work(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            connection, command, args = request
+            try:
+                cls = get_handler_class(command, args)
+                if cls is not None:
+                    proto = ReceivableProtocol(connection.recv_data,
+                                               connection.write_data)
+                    cls(self.backend, args, proto).handle()
+            except Exception:
+                # Errors caused by dropping the connection are expected
+                if not connection.closed:
+                    self.handle_error(connection)
+            connection.finish()
+
+    def _check_connections(self):
+        if self._closing and self._listening:
+            self._listening = False
+            self.close()
+        now = time.time()
+        for conn in list(self._connections):
+            if conn.closed:
+                self._connections.remove(conn)
+            elif conn.finished and not conn.writable():
+                conn.handle_close()
+                self._connections.remove(conn)
+            elif (self.connection_timeout is not None and
+                  (not conn.started or conn.waiting) and
+                  now - conn.last_activity > self.connection_timeout):
+                conn.handle_close()
+                self._connections.remove(conn)
+        if not self._connections:
+            self._idle.acquire()
+            try:
+                self._idle.notifyAll()
+            finally:
+                self._idle.release()
+
+    def _run_loop(self, poll_interval, stop):
+        while not stop():
+            asyncore.loop(poll_interval, map=self._map, count=1)
+            self._check_connections()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Run the event loop until shutdown() is called."""
+        self._serving = True
+        self._stop = False
+        self._is_shut_down.clear()
+        try:
+            self._run_loop(poll_interval, lambda: self._stop)
+        finally:
+            self._serving = False
+            self._is_shut_down.set()
+
+    serve = serve_forever
+
+    def shutdown(self):
+        """Stop the event loop, which must be running in another thread.
+
+        The connections are left alone; see shutdown_gracefully().
+        """
+        self._stop = True
+        self.wake()
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        """Stop accepting connections."""
+        self._closing = True
+        if self._serving:
+            self.wake()
+        else:
+            self._check_connections()
+
+    def wait_for_connections(self, timeout=None, poll_interval=0.05):
+        """Wait for the connections that are being served to finish.
+
+        If the event loop is not running, it is run until then. Once the
+        server is closed and all its connections are done, the worker
+        threads are stopped.
+
+        :param timeout: Optional number of seconds to wait
+        :return: True if all connections have finished
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if not self._serving:
+            if timeout is None:
+                stop = lambda: not self._connections
+            else:
+                stop = lambda: (not self._connections or
+                                time.time() >= deadline)
+            self._run_loop(poll_interval, stop)
+        else:
+            self._idle.acquire()
+            try:
+                while self._connections:
+                    if timeout is None:
+                        self._idle.wait(poll_interval)
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._idle.wait(min(remaining, poll_interval))
+            finally:
+                self._idle.release()
+        if self._connections:
+            return False
+        if self._closing:
+            self._stop_workers(True)
+        return True
+
+    def _stop_workers(self, wait):
+        for t in self._workers:
+            self._requests.put(None)
+        if wait:
+            for t in self._workers:
+                t.join()
+        self._workers = []
+
+    def shutdown_gracefully(self, timeout=None):
+        """Stop accepting connections and let the current ones finish.
+
+        This must be called while serve() is running in another thread.
+        Connections that are still open after the timeout are dropped.
+
+        :param timeout: Optional number of seconds to wait for the current
+            connections
+        :return: True if all connections have finished
+        """
+        self.server_close()
+        done = self.wait_for_connections(timeout)
+        self.shutdown()
+        if not done:
+            for conn in list(self._connections):
+                conn.handle_close()
+            self._connections.clear()
+            # Workers that are still busy exit once their handler fails
+            self._stop_workers(False)
+        self._wake_up.close()
+        return done
@@ -29,17 +29,22 @@ from nose import SkipTest as TestSkipped
 def test_suite():
     names = [
         'client',
+        'commit_graph',
         'fastexport',
         'file',
+        'graph',
         'index',
+        'instrumentation',
         'lru_cache',
         'objects',
         'object_store',
         'pack',
+        'pack_cache',
         'patch',
         'protocol',
         'repository',
         'server',
+        'walk',
         'web',
         ]
     module_names = ['dulwich.tests.test_' + name for name in names]
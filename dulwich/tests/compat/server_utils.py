@@ -21,15 +21,20 @@
 
 
 import select
+import shutil
 import socket
+import tempfile
 import threading
 
+from dulwich.repo import Repo
 from dulwich.tests.utils import (
     tear_down_repo,
     )
 from utils import (
     import_repo,
+    require_git_version,
     run_git,
+    run_git_or_fail,
     )
 
 
@@ -75,20 +80,76 @@ class ServerTests(object):
         self.assertEqual(0, returncode)
         self.assertReposEqual(self._old_repo, self._new_repo)
 
-    def test_fetch_from_dulwich(self):
+    def test_fetch_from_dulwich(self, protocol_version=None):
         self.assertReposNotEqual(self._old_repo, self._new_repo)
         port = self._start_server(self._new_repo)
 
         all_branches = ['master', 'branch']
         branch_args = ['%s:%s' % (b, b) for b in all_branches]
         url = '%s://localhost:%s/' % (self.protocol, port)
-        returncode, _ = run_git(['fetch', url] + branch_args,
-                                cwd=self._old_repo.path)
+        args = ['fetch', url] + branch_args
+        if protocol_version is not None:
+            args = ['-c', 'protocol.version=%d' % protocol_version] + args
+        returncode, _ = run_git(args, cwd=self._old_repo.path)
         # flush the pack cache so any new packs are picked up
         self._old_repo.object_store._pack_cache = None
         self.assertEqual(0, returncode)
         self.assertReposEqual(self._old_repo, self._new_repo)
 
+    def test_fetch_from_dulwich_v0(self):
+        self.test_fetch_from_dulwich(0)
+
+    def test_fetch_from_dulwich_v2(self):
+        require_git_version((2, 18, 0))
+        self.test_fetch_from_dulwich(2)
+
+    def test_ls_remote_v2(self):
+        require_git_version((2, 18, 0))
+        port = self._start_server(self._new_repo)
+        url = '%s://localhost:%s/' % (self.protocol, port)
+        output = run_git_or_fail(['-c', 'protocol.version=2', 'ls-remote',
+                                  '--heads', url])
+        heads = dict((name, sha) for sha, name in
+                     (line.split('\t') for line in output.splitlines()))
+        self.assertEqual(self._new_repo.refs.as_dict('refs/heads'),
+                         dict((name[len('refs/heads/'):], sha)
+                              for name, sha in heads.iteritems()))
+
+    def test_shallow_clone_from_dulwich(self):
+        port = self._start_server(self._new_repo)
+        url = '%s://localhost:%s/' % (self.protocol, port)
+        clone_dir = tempfile.mkdtemp()
+        try:
+            run_git_or_fail(['clone', '-q', '--depth', '1', url, clone_dir])
+            clone = Repo(clone_dir)
+            self.assertEqual(set([self._new_repo.head()]), clone.get_shallow())
+            self.assertEqual([self._new_repo.head()],
+                             [c.id for c in clone.get_walker()])
+            run_git_or_fail(['fetch', '-q', '--unshallow', 'origin'],
+                            cwd=clone_dir)
+            self.assertEqual(set(), clone.get_shallow())
+            run_git_or_fail(['fsck'], cwd=clone_dir)
+        finally:
+            shutil.rmtree(clone_dir)
+
+    def test_partial_clone_from_dulwich(self):
+        require_git_version((2, 19, 0))
+        port = self._start_server(self._new_repo)
+        url = '%s://localhost:%s/' % (self.protocol, port)
+        clone_dir = tempfile.mkdtemp()
+        try:
+            run_git_or_fail(['clone', '-q', '--no-checkout',
+                             '--filter=blob:none', url, clone_dir])
+            output = run_git_or_fail(['rev-list', '--objects', '--all',
+                                      '--missing=print'], cwd=clone_dir)
+            missing = [line[1:] for line in output.splitlines()
+                       if line.startswith('?')]
+            self.assertNotEqual([], missing)
+            for sha in missing:
+                self.assertEqual('blob', self._new_repo[sha].type_name)
+        finally:
+            shutil.rmtree(clone_dir)
+
 
 class ShutdownServerMixIn:
     """Mixin that allows serve_forever to be shut down.
@@ -0,0 +1,84 @@
+# test_commit_graph.py -- Compatibility tests for commit-graph files.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for commit-graph files."""
+
+import os
+import shutil
+
+from dulwich.commit_graph import load_commit_graph
+from dulwich.repo import Repo
+from utils import (
+    CompatTestCase,
+    import_repo,
+    run_git_or_fail,
+    )
+
+
+class CommitGraphTests(CompatTestCase):
+    """Tests for reading and writing commit-graph files."""
+
+    min_git_version = (2, 18, 0)
+
+    def setUp(self):
+        CompatTestCase.setUp(self)
+        self._repo = import_repo('server_new.export')
+
+    def tearDown(self):
+        CompatTestCase.tearDown(self)
+        shutil.rmtree(os.path.dirname(self._repo.path))
+
+    def test_write(self):
+        heads = self._repo.refs.as_dict('refs/heads').values()
+        self._repo.object_store.write_commit_graph(heads)
+        run_git_or_fail(['commit-graph', 'verify'], cwd=self._repo.path)
+
+    def test_read(self):
+        run_git_or_fail(['-c', 'commitGraph.generationVersion=1',
+                         'commit-graph', 'write', '--reachable'],
+                        cwd=self._repo.path)
+        repo = Repo(self._repo.path)
+        graph = repo.object_store.commit_graph
+        self.assertNotEquals(None, graph)
+        for sha in graph:
+            commit = repo[sha]
+            self.assertEquals(commit.parents, graph.get_parents(sha))
+            self.assertEquals(commit.tree, graph.get_tree(sha))
+            self.assertEquals(commit.commit_time, graph.get_commit_time(sha))
+
+    def test_changed_paths(self):
+        graph_path = os.path.join(self._repo.path, 'objects', 'info',
+                                  'commit-graph')
+        run_git_or_fail(['-c', 'commitGraph.changedPathsVersion=1',
+                         'commit-graph', 'write', '--reachable',
+                         '--changed-paths'], cwd=self._repo.path)
+        git_graph = load_commit_graph(graph_path)
+        try:
+            git_filters = dict((sha, git_graph.get_bloom_filter(sha))
+                               for sha in git_graph)
+        finally:
+            git_graph.close()
+        heads = self._repo.refs.as_dict('refs/heads').values()
+        self._repo.object_store.write_commit_graph(heads, changed_paths=True)
+        graph = load_commit_graph(graph_path)
+        try:
+            self.assertEquals(git_filters,
+                dict((sha, graph.get_bloom_filter(sha)) for sha in graph))
+        finally:
+            graph.close()
@@ -24,11 +24,17 @@ tests, deadlocks may freeze the test process such that it cannot be Ctrl-C'ed.
 On *nix, you can kill the tests with Ctrl-Z, "kill %".
 """
 
+import shutil
+import tempfile
 import threading
 
+from dulwich.repo import Repo
 from dulwich.server import (
+    PooledTCPGitServer,
     DictBackend,
+    ForkingTCPGitServer,
     TCPGitServer,
+    ThreadedTCPGitServer,
     )
 from dulwich.tests import (
     TestSkipped,
@@ -39,6 +45,7 @@ from server_utils import (
     )
 from utils import (
     CompatTestCase,
+    run_git,
     )
 
 
@@ -60,6 +67,8 @@ class GitServerTestCase(ServerTests, CompatTestCase):
     """Tests for client/server compatibility."""
 
     protocol = 'git'
+    server_class = TCPGitServer
+    server_kwargs = {}
 
     def setUp(self):
         ServerTests.setUp(self)
@@ -71,7 +80,8 @@ class GitServerTestCase(ServerTests, CompatTestCase):
 
     def _start_server(self, repo):
         backend = DictBackend({'/': repo})
-        dul_server = TCPGitServer(backend, 'localhost', 0)
+        dul_server = self.server_class(backend, 'localhost', 0,
+                                       **self.server_kwargs)
         threading.Thread(target=dul_server.serve).start()
         self._server = dul_server
         _, port = self._server.socket.getsockname()
@@ -80,3 +90,60 @@ class GitServerTestCase(ServerTests, CompatTestCase):
     def test_push_to_dulwich(self):
         # TODO(dborowitz): enable after merging thin pack fixes.
         raise TestSkipped('Skipping push test due to known deadlock bug.')
+
+
+class ConcurrentServerTests(object):
+    """Load tests for servers that serve several connections at once."""
+
+    num_clones = 20
+
+    def test_concurrent_clones(self):
+        port = self._start_server(self._new_repo)
+        url = 'git://localhost:%s/' % port
+        clone_dirs = [tempfile.mkdtemp() for i in range(self.num_clones)]
+        returncodes = []
+
+        def clone(clone_dir):
+            returncode, _ = run_git(['clone', '-q', '--bare', url, clone_dir],
+                                    capture_stdout=True)
+            returncodes.append(returncode)
+
+        threads = [threading.Thread(target=clone, args=(d,))
+                   for d in clone_dirs]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([0] * self.num_clones, returncodes)
+            for clone_dir in clone_dirs:
+                clone = Repo(clone_dir)
+                self.assertEqual(self._new_repo.refs.as_dict('refs/heads'),
+                                 clone.refs.as_dict('refs/heads'))
+                self.assertEqual(set(self._new_repo.object_store),
+                                 set(clone.object_store))
+        finally:
+            for clone_dir in clone_dirs:
+                shutil.rmtree(clone_dir)
+
+
+class ThreadedGitServerTestCase(ConcurrentServerTests, GitServerTestCase):
+    """Tests for client/server compatibility with a threaded server."""
+
+    server_class = ThreadedTCPGitServer
+    # Fewer slots than clients, so that some of them have to wait
+    server_kwargs = {'max_connections': 4, 'connection_timeout': 30}
+
+
+class ForkingGitServerTestCase(ConcurrentServerTests, GitServerTestCase):
+    """Tests for client/server compatibility with a forking server."""
+
+    server_class = ForkingTCPGitServer
+    server_kwargs = {'max_connections': 4, 'connection_timeout': 30}
+
+
+class PooledGitServerTestCase(ConcurrentServerTests, GitServerTestCase):
+    """Tests for client/server compatibility with an event loop server."""
+
+    server_class = PooledTCPGitServer
+    server_kwargs = {'max_workers': 4, 'connection_timeout': 30}
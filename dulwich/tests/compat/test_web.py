@@ -24,15 +24,23 @@ tests, deadlocks may freeze the test process such that it cannot be Ctrl-C'ed.
 On *nix, you can kill the tests with Ctrl-Z, "kill %".
 """
 
+import os
 import threading
 from wsgiref import simple_server
 
+from dulwich.objects import (
+    Blob,
+    Tree,
+    )
 from dulwich.server import (
     DictBackend,
     )
 from dulwich.tests import (
     TestSkipped,
     )
+from dulwich.tests.utils import (
+    make_commit,
+    )
 from dulwich.web import (
     HTTPGitApplication,
     )
@@ -43,6 +51,7 @@ from server_utils import (
     )
 from utils import (
     CompatTestCase,
+    run_git_or_fail,
     )
 
 
@@ -96,9 +105,21 @@ class SmartWebTestCase(WebTests, CompatTestCase):
     def _make_app(self, backend):
         return HTTPGitApplication(backend)
 
-    def test_push_to_dulwich(self):
-        # TODO(dborowitz): enable after merging thin pack fixes.
-        raise TestSkipped('Skipping push test due to known pack bug.')
+    def test_push_chunked_to_dulwich(self):
+        # Requests larger than http.postBuffer are sent with chunked encoding
+        blob = Blob.from_string(os.urandom(200000))
+        tree = Tree()
+        tree.add(0100644, 'random', blob.id)
+        commit = make_commit(tree=tree.id, parents=[self._new_repo.head()])
+        for obj in (blob, tree, commit):
+            self._new_repo.object_store.add_object(obj)
+        self._new_repo.refs['refs/heads/master'] = commit.id
+        port = self._start_server(self._old_repo)
+        url = '%s://localhost:%s/' % (self.protocol, port)
+        run_git_or_fail(['-c', 'http.postBuffer=65536', 'push', url,
+                         'master:master'], cwd=self._new_repo.path)
+        self.assertEqual(commit.id, self._old_repo.refs['refs/heads/master'])
+        self.assertEqual(blob.data, self._old_repo[blob.id].data)
 
 
 class DumbWebTestCase(WebTests, CompatTestCase):
@@ -118,3 +139,9 @@ class DumbWebTestCase(WebTests, CompatTestCase):
     def test_push_to_dulwich(self):
         # Note: remove this if dumb pushing is supported
         raise TestSkipped('Dumb web pushing not supported.')
+
+    def test_shallow_clone_from_dulwich(self):
+        raise TestSkipped('Shallow clones need the smart protocol.')
+
+    def test_partial_clone_from_dulwich(self):
+        raise TestSkipped('Partial clones need the smart protocol.')
@@ -22,6 +22,35 @@ from unittest import TestCase
 from dulwich.client import (
     GitClient,
     )
+from dulwich.errors import (
+    GitProtocolError,
+    HangupException,
+    )
+from dulwich.protocol import (
+    DELIM_PKT,
+    Protocol,
+    )
+
+
+class DummyGraphWalker(object):
+
+    def __init__(self, shas):
+        self.shas = list(shas)
+        self.acks = []
+        self.shallow = set()
+
+    def next(self):
+        if not self.shas:
+            return None
+        return self.shas.pop(0)
+
+    def ack(self, sha):
+        self.acks.append(sha)
+
+    def update_shallow(self, new_shallow, new_unshallow):
+        self.shallow.update(new_shallow)
+        self.shallow.difference_update(new_unshallow)
+
 
 class GitClientTests(TestCase):
 
@@ -41,3 +70,196 @@ class GitClientTests(TestCase):
         self.rin.seek(0)
         self.client.fetch_pack("bla", lambda heads: [], None, None, None)
         self.assertEquals(self.rout.getvalue(), "0000")
+
+    def write_server_lines(self, caps, lines):
+        proto = Protocol(None, self.rin.write)
+        proto.write_pkt_line(
+            "55dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7 HEAD\x00%s\n" % caps)
+        proto.write_pkt_line(None)
+        for line in lines:
+            proto.write_pkt_line(line)
+        self.rin.seek(0)
+
+    def fetch(self, graph_walker, depth=None, filter_spec=None):
+        self.client.fetch_pack("bla",
+            lambda refs: ["55dcc6bf963f922e1ed5c4bbaaefcfacef57b1d7"],
+            graph_walker, None, None, depth, filter_spec)
+        proto = Protocol(StringIO(self.rout.getvalue()).read, None)
+        return list(iter(proto.read_pkt_line, "done\n"))
+
+    def test_fetch_pack_ready(self):
+        haves = ["%040d" % i for i in range(100)]
+        self.write_server_lines(
+            "multi_ack_detailed multi_ack side-band-64k ofs-delta thin-pack",
+            ["ACK %s common\n" % haves[3], "ACK %s ready\n" % haves[3],
+             "NAK\n", "NAK\n", "ACK %s\n" % haves[3], None])
+        walker = DummyGraphWalker(haves)
+        sent = self.fetch(walker)
+        self.assertTrue(sent[0].startswith("want "))
+        self.assertTrue("multi_ack_detailed" in sent[0])
+        # Two windows were sent before the answer to the first was read
+        self.assertEquals(["have %s\n" % h for h in haves[:16]] + [None] +
+                          ["have %s\n" % h for h in haves[16:32]] + [None],
+                          sent[2:])
+        self.assertEquals([haves[3]] * 3, walker.acks)
+        self.assertEquals("", self.rin.read())
+
+    def test_fetch_pack_nothing_in_common(self):
+        haves = ["%040d" % i for i in range(20)]
+        self.write_server_lines("multi_ack side-band-64k ofs-delta",
+                                ["NAK\n", "NAK\n", None])
+        walker = DummyGraphWalker(haves)
+        sent = self.fetch(walker)
+        self.assertFalse("multi_ack_detailed" in sent[0])
+        self.assertEquals(["have %s\n" % h for h in haves[:16]] + [None] +
+                          ["have %s\n" % h for h in haves[16:]], sent[2:])
+        self.assertEquals([], walker.acks)
+        self.assertEquals("", self.rin.read())
+
+    def test_fetch_pack_single_ack(self):
+        haves = ["%040d" % i for i in range(40)]
+        self.write_server_lines("side-band-64k ofs-delta",
+                                ["ACK %s\n" % haves[1], None])
+        walker = DummyGraphWalker(haves)
+        sent = self.fetch(walker)
+        # The want and two windows of haves
+        self.assertEquals(2 + 17 + 17, len(sent))
+        self.assertEquals([haves[1]], walker.acks)
+        self.assertEquals("", self.rin.read())
+
+    def test_fetch_pack_depth(self):
+        self.write_server_lines("multi_ack side-band-64k ofs-delta shallow",
+            ["shallow %s\n" % ("2" * 40), "unshallow %s\n" % ("1" * 40),
+             None, "NAK\n", None])
+        walker = DummyGraphWalker([])
+        walker.shallow = set(["1" * 40, "3" * 40])
+        sent = self.fetch(walker, depth=2)
+        self.assertTrue(" shallow" in sent[0])
+        self.assertEquals(["shallow %s\n" % ("1" * 40),
+                           "shallow %s\n" % ("3" * 40), "deepen 2\n", None],
+                          sent[1:])
+        self.assertEquals(set(["2" * 40, "3" * 40]), walker.shallow)
+        self.assertEquals("", self.rin.read())
+
+    def test_fetch_pack_depth_unsupported(self):
+        self.write_server_lines("multi_ack side-band-64k ofs-delta", [])
+        self.assertRaises(GitProtocolError, self.fetch, DummyGraphWalker([]),
+                          1)
+
+    def test_fetch_pack_filter(self):
+        self.write_server_lines("multi_ack side-band-64k ofs-delta filter",
+                                ["NAK\n", None])
+        sent = self.fetch(DummyGraphWalker([]), filter_spec="blob:none")
+        self.assertTrue(" filter" in sent[0])
+        self.assertEquals(["filter blob:none\n", None], sent[1:])
+
+    def test_fetch_pack_filter_unsupported(self):
+        # Like git, the filter is dropped if the server can't apply it
+        self.write_server_lines("multi_ack side-band-64k ofs-delta",
+                                ["NAK\n", None])
+        sent = self.fetch(DummyGraphWalker([]), filter_spec="blob:none")
+        self.assertFalse("filter" in sent[0])
+        self.assertEquals([None], sent[1:])
+
+
+class ProtocolV2ClientTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.rout = StringIO()
+        self.rin = StringIO()
+        self.client = GitClient(lambda x: True, self.rin.read,
+            self.rout.write, protocol_version=2)
+        self.pack = []
+
+    def write_server_lines(self, lines):
+        proto = Protocol(None, self.rin.write)
+        for line in ["version 2\n", "ls-refs\n", "fetch=shallow filter\n",
+                     None, "%s refs/heads/master\n" % ("1" * 40),
+                     "%s refs/tags/foo peeled:%s\n" % ("2" * 40, "1" * 40),
+                     None] + lines:
+            proto.write_pkt_line(line)
+        self.rin.seek(0)
+
+    def fetch(self, graph_walker, wants, depth=None, ref_prefix=None):
+        refs = self.client.fetch_pack("bla", lambda refs: wants, graph_walker,
+            self.pack.append, None, depth, None, ref_prefix)
+        self.assertEquals("", self.rin.read())
+        return refs
+
+    def sent_requests(self):
+        """Split what the client sent into requests."""
+        proto = Protocol(StringIO(self.rout.getvalue()).read, None)
+        requests = [[]]
+        while True:
+            try:
+                pkt = proto.read_pkt_line()
+            except HangupException:
+                return requests[:-1]
+            requests[-1].append(pkt)
+            if pkt is None:
+                requests.append([])
+
+    def test_ls_refs(self):
+        self.write_server_lines([])
+        refs = self.fetch(DummyGraphWalker([]), [],
+                          ref_prefix=["refs/heads/", "refs/tags/"])
+        self.assertEquals({"refs/heads/master": "1" * 40,
+                           "refs/tags/foo": "2" * 40,
+                           "refs/tags/foo^{}": "1" * 40}, refs)
+        self.assertEquals(
+            [["command=ls-refs\n", DELIM_PKT, "peel\n",
+              "ref-prefix refs/heads/\n", "ref-prefix refs/tags/\n", None],
+             [None]], self.sent_requests())
+
+    def test_fetch_done(self):
+        self.write_server_lines(["packfile\n", "\x01PACK", "\x01data", None])
+        self.fetch(DummyGraphWalker([]), ["1" * 40])
+        self.assertEquals(["PACK", "data"], self.pack)
+        requests = self.sent_requests()
+        self.assertEquals(
+            ["command=fetch\n", DELIM_PKT, "thin-pack\n", "ofs-delta\n",
+             "want %s\n" % ("1" * 40), "done\n", None], requests[1])
+        # The session is ended after the pack
+        self.assertEquals([[None]], requests[2:])
+
+    def test_fetch_negotiation(self):
+        haves = ["%040d" % i for i in range(100)]
+        self.write_server_lines(
+            ["acknowledgments\n", "ACK %s\n" % haves[3], None,
+             "acknowledgments\n", "ACK %s\n" % haves[20], "ready\n",
+             DELIM_PKT, "packfile\n", "\x01PACK", None])
+        walker = DummyGraphWalker(haves)
+        self.fetch(walker, ["1" * 40])
+        self.assertEquals(["PACK"], self.pack)
+        self.assertEquals([haves[3], haves[20]], walker.acks)
+        requests = self.sent_requests()
+        self.assertEquals(4, len(requests))
+        self.assertEquals(["have %s\n" % h for h in haves[:16]] + [None],
+                          requests[1][5:])
+        # The server keeps no state, so the common commit is sent again
+        self.assertEquals(["have %s\n" % h for h in [haves[3]] + haves[16:48]]
+                          + [None], requests[2][5:])
+
+    def test_fetch_depth(self):
+        self.write_server_lines(
+            ["shallow-info\n", "shallow %s\n" % ("3" * 40),
+             "unshallow %s\n" % ("4" * 40), DELIM_PKT, "packfile\n",
+             "\x01PACK", None])
+        walker = DummyGraphWalker([])
+        walker.shallow = set(["4" * 40])
+        self.fetch(walker, ["1" * 40], depth=2)
+        self.assertEquals(set(["3" * 40]), walker.shallow)
+        self.assertEquals(["shallow %s\n" % ("4" * 40), "deepen 2\n",
+                           "done\n", None], self.sent_requests()[1][5:])
+
+    def test_fallback(self):
+        # Servers that don't know version 2 send their refs right away
+        proto = Protocol(None, self.rin.write)
+        proto.write_pkt_line("%s HEAD\x00multi_ack side-band-64k ofs-delta\n"
+                             % ("1" * 40))
+        proto.write_pkt_line(None)
+        self.rin.seek(0)
+        refs = self.fetch(DummyGraphWalker([]), [])
+        self.assertEquals({"HEAD": "1" * 40}, refs)
+        self.assertEquals("0000", self.rout.getvalue())
@@ -0,0 +1,246 @@
+# test_commit_graph.py -- Tests for reading and writing commit-graph files
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for commit-graph files."""
+
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dulwich.commit_graph import (
+    CommitGraph,
+    bloom_filter_contains,
+    bloom_key,
+    make_bloom_filter,
+    murmur3_32,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    MissingCommitError,
+    )
+from dulwich.file import GitFile
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    Tag,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+
+    def write_and_read(self, heads):
+        f = StringIO()
+        count = write_commit_graph(f, self.store, heads)
+        contents = f.getvalue()
+        graph = CommitGraph("commit-graph", StringIO(contents), contents,
+                            len(contents))
+        self.assertEquals(count, len(graph))
+        return graph
+
+    def test_linear(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 2]])
+        graph = self.write_and_read([c3.id])
+        self.assertEquals(sorted([c1.id, c2.id, c3.id]), list(graph))
+        self.assertEquals([], graph.get_parents(c1.id))
+        self.assertEquals([c1.id], graph.get_parents(c2.id))
+        self.assertEquals([c2.id], graph.get_parents(c3.id))
+        self.assertEquals([1, 2, 3],
+                          [graph.get_generation(c.id) for c in (c1, c2, c3)])
+        self.assertEquals([0, 100, 200],
+                          [graph.get_commit_time(c.id) for c in (c1, c2, c3)])
+        self.assertEquals(c3.tree, graph.get_tree(c3.id))
+
+    def test_binary_sha(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        graph = self.write_and_read([c2.id])
+        self.assertTrue(c2.sha().digest() in graph)
+        self.assertEquals([c1.id], graph.get_parents(c2.sha().digest()))
+
+    def test_missing(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        graph = self.write_and_read([c1.id])
+        self.assertFalse(c2.id in graph)
+        self.assertFalse("\0" * 20 in graph)
+        self.assertRaises(KeyError, graph.get_parents, c2.id)
+        self.assertRaises(KeyError, graph.get_commit_time, c2.id)
+
+    def test_merges(self):
+        c1, c2, c3, c4, c5 = build_commit_graph(self.store,
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5, 1, 2, 3, 4]])
+        graph = self.write_and_read([c5.id])
+        self.assertEquals([c2.id, c3.id], graph.get_parents(c4.id))
+        self.assertEquals([c1.id, c2.id, c3.id, c4.id],
+                          graph.get_parents(c5.id))
+        self.assertEquals(3, graph.get_generation(c4.id))
+        self.assertEquals(4, graph.get_generation(c5.id))
+
+    def test_large_commit_time(self):
+        c1, = build_commit_graph(self.store, [[1]],
+                                 attrs={1: {'commit_time': 2**33 + 5}})
+        graph = self.write_and_read([c1.id])
+        self.assertEquals(2**33 + 5, graph.get_commit_time(c1.id))
+
+    def test_tag(self):
+        c1, = build_commit_graph(self.store, [[1]])
+        tag = make_object(Tag, tagger='Test Tagger <test@nodomain.com>',
+                          message='Test tag.', name='tag', tag_time=0,
+                          tag_timezone=0, object=(c1.__class__, c1.id))
+        self.store.add_object(tag)
+        graph = self.write_and_read([tag.id])
+        self.assertEquals([c1.id], list(graph))
+
+    def test_missing_parent(self):
+        # As in a shallow clone
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        del self.store._data[c1.id]
+        self.assertRaises(MissingCommitError, write_commit_graph, StringIO(),
+                          self.store, [c2.id])
+
+
+class BloomFilterTests(TestCase):
+
+    def test_murmur3(self):
+        self.assertEquals(0, murmur3_32(0, ""))
+        self.assertEquals(0x627b0c2c, murmur3_32(0, "Hello world!"))
+        self.assertEquals(0x2e4ff723, murmur3_32(0,
+            "The quick brown fox jumps over the lazy dog"))
+
+    def test_contains(self):
+        data = make_bloom_filter(["a/b/c", "d"])
+        # 4 paths, including directories, of 10 bits
+        self.assertEquals(5, len(data))
+        for path in ("a/b/c", "a/b", "a", "d"):
+            self.assertTrue(bloom_filter_contains(data, bloom_key(path)))
+
+    def test_empty(self):
+        self.assertEquals("\0", make_bloom_filter([]))
+        self.assertFalse(bloom_filter_contains("\0", bloom_key("a")))
+
+    def test_too_many_paths(self):
+        data = make_bloom_filter(["%d" % i for i in range(513)])
+        self.assertEquals("\xff", data)
+        self.assertTrue(bloom_filter_contains(data, bloom_key("foo")))
+
+
+class ChangedPathsTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+        self.blob_a = make_object(Blob, data="a")
+        self.blob_b = make_object(Blob, data="b")
+        self.c1, self.c2 = build_commit_graph(self.store, [[1], [2, 1]],
+            trees={1: [("x/a", self.blob_a), ("y", self.blob_a)],
+                   2: [("x/a", self.blob_b), ("y", self.blob_a)]})
+
+    def write_and_read(self, changed_paths):
+        f = StringIO()
+        write_commit_graph(f, self.store, [self.c2.id], changed_paths)
+        contents = f.getvalue()
+        return CommitGraph("commit-graph", StringIO(contents), contents,
+                           len(contents))
+
+    def test_no_filters(self):
+        graph = self.write_and_read(False)
+        self.assertFalse(graph.has_bloom_filters())
+        self.assertEquals(None, graph.get_bloom_filter(self.c2.id))
+        self.assertTrue(graph.path_maybe_changed(self.c2.id, "y"))
+
+    def test_filters(self):
+        graph = self.write_and_read(True)
+        self.assertTrue(graph.has_bloom_filters())
+        self.assertTrue(graph.path_maybe_changed(self.c2.id, "x/a"))
+        self.assertTrue(graph.path_maybe_changed(self.c2.id, "x"))
+        self.assertFalse(graph.path_maybe_changed(self.c2.id, "y"))
+        self.assertFalse(graph.path_maybe_changed(self.c2.id, "z/a"))
+        self.assertTrue(graph.path_maybe_changed(self.c1.id, "y"))
+        self.assertTrue(graph.path_maybe_changed("a" * 40, "y"))
+
+
+class DiskObjectStoreCommitGraphTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def test_no_commit_graph(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.assertEquals(None, self.store.commit_graph)
+        self.assertEquals([c1.id], self.store.get_parents(c2.id))
+        self.assertEquals(100, self.store.get_commit_time(c2.id))
+
+    def test_get_parents_uses_commit_graph(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.assertEquals(2, self.store.write_commit_graph([c2.id]))
+        # The commit itself is no longer needed
+        os.remove(os.path.join(self.store_dir, c2.id[:2], c2.id[2:]))
+        self.assertEquals([c1.id], self.store.get_parents(c2.id))
+        self.assertEquals(100, self.store.get_commit_time(c2.id))
+
+    def test_commits_not_in_graph(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.store.write_commit_graph([c1.id])
+        self.assertEquals([c1.id], self.store.get_parents(c2.id))
+
+    def test_missing_objects_uses_commit_graph(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.store.write_commit_graph([c2.id])
+        expected = set([c1.id, c2.id, c1.tree])
+        self.assertEquals(expected, set(sha for sha, path in
+            self.store.find_missing_objects([], [c2.id])))
+
+    def test_missing_parent(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        os.remove(os.path.join(self.store_dir, c1.id[:2], c1.id[2:]))
+        self.assertRaises(MissingCommitError, self.store.write_commit_graph,
+                          [c2.id])
+        self.assertEquals([], os.listdir(os.path.join(self.store_dir, "info")))
+        self.assertEquals(None, self.store.commit_graph)
+
+    def test_reload(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.store.write_commit_graph([c1.id])
+        self.assertFalse(c2.id in self.store.commit_graph)
+        # Replaced by another program
+        f = GitFile(os.path.join(self.store_dir, "info", "commit-graph"),
+                    'wb')
+        try:
+            write_commit_graph(f, self.store, [c2.id])
+        finally:
+            f.close()
+        self.assertTrue(c2.id in self.store.commit_graph)
+        os.remove(os.path.join(self.store_dir, "info", "commit-graph"))
+        self.assertEquals(None, self.store.commit_graph)
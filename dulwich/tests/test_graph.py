@@ -0,0 +1,185 @@
+# test_graph.py -- Tests for merge base and ancestry queries.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for merge base and ancestry queries."""
+
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dulwich.graph import (
+    find_merge_base,
+    find_shallow,
+    is_ancestor,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+
+class GraphTest(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+
+    def make_commits(self, commit_spec, **kwargs):
+        return build_commit_graph(self.store, commit_spec, **kwargs)
+
+    def count_parent_lookups(self):
+        """Make the store count the commits whose parents are looked up."""
+        lookups = []
+        get_parents = self.store.get_parents
+        def counting_get_parents(sha):
+            lookups.append(sha)
+            return get_parents(sha)
+        self.store.get_parents = counting_get_parents
+        return lookups
+
+    def assertMergeBase(self, expected, one, two):
+        self.assertEquals(sorted(c.id for c in expected),
+                          sorted(find_merge_base(self.store, one.id, two.id)))
+
+    def test_linear(self):
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 2]])
+        self.assertMergeBase([c1], c1, c3)
+        self.assertMergeBase([c1], c3, c1)
+        self.assertMergeBase([c2], c2, c3)
+        self.assertMergeBase([c3], c3, c3)
+        self.assertTrue(is_ancestor(self.store, c1.id, c3.id))
+        self.assertTrue(is_ancestor(self.store, c3.id, c3.id))
+        self.assertFalse(is_ancestor(self.store, c3.id, c1.id))
+
+    def test_branch(self):
+        c1, x2, x3, y4 = self.make_commits([[1], [2, 1], [3, 2], [4, 1]])
+        self.assertMergeBase([c1], x3, y4)
+        self.assertMergeBase([c1], y4, x2)
+        self.assertFalse(is_ancestor(self.store, x2.id, y4.id))
+        self.assertFalse(is_ancestor(self.store, y4.id, x3.id))
+        self.assertTrue(is_ancestor(self.store, c1.id, y4.id))
+
+    def test_merge(self):
+        c1, c2, c3, c4, c5 = self.make_commits(
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5, 3]])
+        self.assertMergeBase([c3], c4, c5)
+        self.assertMergeBase([c2], c2, c4)
+        self.assertTrue(is_ancestor(self.store, c3.id, c4.id))
+        self.assertTrue(is_ancestor(self.store, c2.id, c4.id))
+        self.assertFalse(is_ancestor(self.store, c2.id, c5.id))
+
+    def test_criss_cross(self):
+        c1, x2, y3, x4, y5 = self.make_commits(
+            [[1], [2, 1], [3, 1], [4, 2, 3], [5, 3, 2]])
+        self.assertMergeBase([x2, y3], x4, y5)
+
+    def test_unrelated(self):
+        x1, y2 = self.make_commits([[1], [2]])
+        self.assertMergeBase([], x1, y2)
+        self.assertFalse(is_ancestor(self.store, x1.id, y2.id))
+
+    def test_out_of_order_times(self):
+        # Commit 3 claims to be older than the merge base
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 2], [4, 2]],
+                                           attrs={3: {'commit_time': 50}})
+        self.assertMergeBase([c2], c3, c4)
+        self.assertTrue(is_ancestor(self.store, c2.id, c3.id))
+
+    def test_redundant_base(self):
+        # Commit 2 is found before its descendant 3 because of its timestamp
+        c1, c2, c3, c4, c5 = self.make_commits(
+            [[1], [2, 1], [3, 2], [4, 1, 3], [5, 1, 3]],
+            attrs={2: {'commit_time': 1000}})
+        self.assertMergeBase([c3], c4, c5)
+
+    def test_deep_history(self):
+        commits = self.make_commits(
+            [[1]] + [[i, i - 1] for i in range(2, 201)] +
+            [[201, 199], [202, 200]])
+        lookups = self.count_parent_lookups()
+        self.assertMergeBase([commits[198]], commits[200], commits[201])
+        # Only the commits since the merge base are visited
+        self.assertTrue(len(set(lookups)) <= 5, lookups)
+        del lookups[:]
+        self.assertTrue(is_ancestor(self.store, commits[190].id,
+                                    commits[201].id))
+        self.assertTrue(len(set(lookups)) <= 15, lookups)
+
+
+class FindShallowTest(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+
+    def assertShallow(self, expected_shallow, expected_not_shallow, heads,
+                      depth):
+        shallow, not_shallow = find_shallow(self.store,
+                                            [c.id for c in heads], depth)
+        self.assertEquals(set(c.id for c in expected_shallow), shallow)
+        self.assertEquals(set(c.id for c in expected_not_shallow),
+                          not_shallow)
+
+    def test_linear(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 2]])
+        self.assertShallow([c3], [], [c3], 1)
+        self.assertShallow([c2], [c3], [c3], 2)
+        self.assertShallow([c1], [c2, c3], [c3], 3)
+        self.assertShallow([], [c1, c2, c3], [c3], 4)
+
+    def test_multiple_heads(self):
+        c1, x2, x3, y4 = build_commit_graph(self.store,
+                                            [[1], [2, 1], [3, 2], [4, 1]])
+        self.assertShallow([x2, c1], [x3, y4], [x3, y4], 2)
+
+    def test_shortest_path(self):
+        # 1 is both the parent of the merge and further down the other side
+        c1, c2, c3, m4 = build_commit_graph(self.store,
+                                            [[1], [2, 1], [3, 2], [4, 3, 1]])
+        self.assertShallow([c3, c1], [m4], [m4], 2)
+        self.assertShallow([c2], [m4, c3, c1], [m4], 3)
+
+
+class CommitGraphGraphTest(GraphTest):
+    """Runs the graph tests against a store with a commit-graph."""
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def make_commits(self, commit_spec, **kwargs):
+        commits = build_commit_graph(self.store, commit_spec, **kwargs)
+        self.store.write_commit_graph([c.id for c in commits])
+        return commits
+
+    def test_generation_cutoff(self):
+        commits = self.make_commits([[1]] +
+            [[i, i - 1] for i in range(2, 51)] + [[51, 1]])
+        lookups = self.count_parent_lookups()
+        # Commits with a lower generation than commit 50 are not visited
+        self.assertFalse(is_ancestor(self.store, commits[49].id,
+                                     commits[50].id))
+        self.assertEquals([commits[49].id], lookups)
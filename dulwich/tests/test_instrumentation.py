@@ -0,0 +1,140 @@
+# test_instrumentation.py -- Tests for the instrumentation module
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the instrumentation of object stores and packs."""
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from dulwich import instrumentation
+from dulwich.objects import Blob
+from dulwich.object_store import DiskObjectStore
+from dulwich.tests.utils import make_object
+
+
+class InstrumentationTests(TestCase):
+
+    def test_increment(self):
+        instr = instrumentation.Instrumentation()
+        instr.increment("foo")
+        instr.increment("foo", 4)
+        self.assertEquals({"foo": 5}, instr.snapshot())
+
+    def test_increment_threads(self):
+        instr = instrumentation.Instrumentation()
+        def increment():
+            for i in xrange(10000):
+                instr.increment("foo")
+                instr.report_timing("op", 0)
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(40000, instr.snapshot()["foo"])
+
+    def test_timing(self):
+        instr = instrumentation.Instrumentation()
+        reported = []
+        instr.add_timing_callback(
+            lambda name, seconds: reported.append(name))
+        instr.report_timing("op", 0)
+        instr.report_timing("op", 0)
+        self.assertEquals(["op", "op"], reported)
+        self.assertEquals(["op.seconds"], instr.snapshot().keys())
+
+    def test_reset(self):
+        instr = instrumentation.Instrumentation()
+        instr.increment("foo")
+        instr.report_timing("op", 0)
+        instr.reset()
+        self.assertEquals({}, instr.snapshot())
+
+    def test_enable_disable(self):
+        instr = instrumentation.enable()
+        try:
+            self.assertTrue(instrumentation.current is instr)
+        finally:
+            instrumentation.disable()
+        self.assertEquals(None, instrumentation.current)
+
+
+class ObjectStoreInstrumentationTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+        self.instr = instrumentation.enable()
+
+    def tearDown(self):
+        instrumentation.disable()
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def test_loose(self):
+        blob = make_object(Blob, data="loose")
+        self.store.add_object(blob)
+        self.store[blob.id]
+        self.assertRaises(KeyError, self.store.get_raw, "a" * 40)
+        counters = self.instr.snapshot()
+        self.assertEquals(2, counters["object_store.get_raw"])
+        self.assertEquals(1, counters["object_store.loose_hit"])
+        self.assertEquals(1, counters["object_store.loose_miss"])
+        self.assertTrue("object_store.get_raw.seconds" in counters)
+
+    def test_packed(self):
+        blob = make_object(Blob, data="packed")
+        self.store.add_objects([(blob, None)])
+        pack_name = os.path.basename(self.store.packs[0]._basename)
+        self.instr.reset()
+        self.store[blob.id]
+        self.assertRaises(KeyError, self.store.get_raw, "a" * 40)
+        counters = self.instr.snapshot()
+        self.assertEquals(1, counters["object_store.pack_hit"])
+        self.assertEquals(1, counters["object_store.pack_miss"])
+        self.assertEquals(1,
+            counters["object_store.pack_miss.%s" % pack_name])
+        self.assertEquals(2, counters["pack_index.lookup"])
+        self.assertEquals(1, counters["pack_index.miss"])
+        self.assertEquals(1, counters["pack.resolve_object"])
+        self.assertEquals(1, counters["pack.delta_chain_length.0"])
+        self.assertEquals(len("packed"), counters["pack.bytes_inflated"])
+
+    def test_bulk_insert(self):
+        blob = make_object(Blob, data="pending")
+        inserter = self.store.bulk_insert()
+        try:
+            inserter.add_object(blob)
+            self.store[blob.id]
+        finally:
+            inserter.abort()
+        counters = self.instr.snapshot()
+        self.assertEquals(1, counters["object_store.bulk_insert_hit"])
+        self.assertFalse("object_store.loose_miss" in counters)
+        self.assertTrue("object_store.get_raw.seconds" in counters)
+
+    def test_disabled(self):
+        instrumentation.disable()
+        blob = make_object(Blob, data="packed")
+        self.store.add_objects([(blob, None)])
+        self.store[blob.id]
+        self.assertEquals({}, self.instr.snapshot())
@@ -24,14 +24,33 @@ from unittest import TestCase
 
 from dulwich.objects import (
     Blob,
+    Tag,
+    Tree,
     )
+from dulwich import object_store
 from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
+    parse_filter_spec,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    create_delta,
+    write_pack_object,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_commit,
+    make_object,
     )
 import os
+import random
 import shutil
+import struct
+import sys
 import tempfile
+import threading
+import time
 
 
 testobject = Blob()
@@ -55,6 +74,290 @@ class SpecificDiskObjectStoreTests(TestCase):
         self.assertEquals([], o.packs)
 
 
+class AlternatesTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.upstream_dir = tempfile.mkdtemp()
+        self.fork_dir = tempfile.mkdtemp()
+        self.upstream = DiskObjectStore.init(self.upstream_dir)
+        self.fork = DiskObjectStore.init(self.fork_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.upstream_dir)
+        shutil.rmtree(self.fork_dir)
+
+    def test_no_alternates(self):
+        self.assertEquals([], self.fork.alternates)
+
+    def test_add_alternate_path(self):
+        self.fork.add_alternate_path(self.upstream_dir)
+        self.fork.add_alternate_path("/some/other/path")
+        self.assertEquals([self.upstream_dir, "/some/other/path"],
+                          [s.path for s in self.fork.alternates])
+
+    def test_relative_path(self):
+        f = open(os.path.join(self.fork_dir, "info", "alternates"), 'w')
+        try:
+            f.write("# comment\n\n../upstream/objects\n")
+        finally:
+            f.close()
+        self.assertEquals(
+            [os.path.join(os.path.dirname(self.fork_dir), "upstream",
+                          "objects")],
+            [s.path for s in self.fork.alternates])
+
+    def test_loose_object(self):
+        self.upstream.add_object(testobject)
+        self.assertFalse(testobject.id in self.fork)
+        self.fork.add_alternate_path(self.upstream_dir)
+        self.assertTrue(testobject.id in self.fork)
+        self.assertFalse(self.fork.contains_loose(testobject.id))
+        self.assertEquals(testobject, self.fork[testobject.id])
+
+    def test_packed_object(self):
+        self.upstream.add_objects([(testobject, None)])
+        self.fork.add_alternate_path(self.upstream_dir)
+        self.assertTrue(testobject.id in self.fork)
+        self.assertEquals(testobject, self.fork[testobject.id])
+        self.assertRaises(KeyError, self.fork.__getitem__, "a" * 40)
+
+    def test_nested_cycle(self):
+        self.upstream.add_object(testobject)
+        self.fork.add_alternate_path(self.upstream_dir)
+        self.upstream.add_alternate_path(self.fork_dir)
+        self.assertEquals(testobject, self.fork[testobject.id])
+        self.assertFalse("a" * 40 in self.fork)
+
+    def test_shared_packs(self):
+        self.upstream.add_objects([(testobject, None)])
+        self.fork.add_alternate_path(self.upstream_dir)
+        other_fork = DiskObjectStore(self.fork_dir)
+        self.assertTrue(self.upstream.packs[0] is
+                        self.fork.alternates[0].packs[0])
+        self.assertTrue(self.upstream.packs[0] is
+                        other_fork.alternates[0].packs[0])
+
+    def test_shared_pack_removed(self):
+        self.upstream.add_objects([(testobject, None)])
+        pack = self.upstream.packs[0]
+        key = os.path.realpath(pack._basename)
+        self.assertTrue(key in object_store._shared_packs)
+        os.remove(pack._data_path)
+        os.remove(pack._idx_path)
+        os.utime(self.upstream.pack_dir, (time.time() + 10,) * 2)
+        self.assertEquals([], self.upstream.packs)
+        self.assertFalse(key in object_store._shared_packs)
+
+
+class PackInserterTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def _make_blob(self, data):
+        b = Blob()
+        b.data = data
+        return b
+
+    def test_commit(self):
+        blobs = [self._make_blob("blob %d" % i) for i in range(10)]
+        inserter = self.store.bulk_insert()
+        for b in blobs:
+            self.store.add_object(b)
+        pack = inserter.commit()
+        self.assertEquals(10, len(pack))
+        self.assertTrue(pack.check())
+        self.assertEquals([pack], self.store.packs)
+        self.assertEquals([], list(self.store._iter_loose_objects()))
+        for b in blobs:
+            self.assertTrue(self.store.contains_packed(b.id))
+            self.assertEquals(b, self.store[b.id])
+
+    def test_read_before_commit(self):
+        inserter = self.store.bulk_insert()
+        inserter.add_object(testobject)
+        self.assertTrue(testobject.id in self.store)
+        self.assertEquals(testobject, self.store[testobject.id])
+        other = self._make_blob("other data")
+        inserter.add_object(other)
+        self.assertEquals(other, self.store[other.id])
+        self.assertEquals(testobject, self.store[testobject.id])
+        inserter.commit()
+        self.assertEquals(testobject, self.store[testobject.id])
+
+    def test_duplicates(self):
+        self.store.add_object(testobject)
+        inserter = self.store.bulk_insert()
+        inserter.add_object(testobject)
+        other = self._make_blob("other data")
+        inserter.add_object(other)
+        inserter.add_object(other)
+        self.assertEquals(1, len(inserter))
+        self.assertEquals(1, len(inserter.commit()))
+
+    def test_commit_empty(self):
+        inserter = self.store.bulk_insert()
+        self.assertEquals(None, inserter.commit())
+        self.assertEquals([], os.listdir(self.store.pack_dir))
+
+    def test_abort(self):
+        inserter = self.store.bulk_insert()
+        inserter.add_object(testobject)
+        inserter.__exit__(ValueError, ValueError(), None)
+        self.assertFalse(testobject.id in self.store)
+        self.assertEquals([], os.listdir(self.store.pack_dir))
+        # objects are written loose again after the bulk insert is finished
+        self.store.add_object(testobject)
+        self.assertTrue(self.store.contains_loose(testobject.id))
+
+
+class RepackTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def _make_history(self, contents):
+        """Create a linear history with one file changing in each commit."""
+        commits = []
+        objects = []
+        for i, data in enumerate(contents):
+            blob = make_object(Blob, data=data)
+            tree = Tree()
+            tree.add(0100644, "file", blob.id)
+            commit = make_commit(tree=tree.id, commit_time=i,
+                                 parents=[c.id for c in commits[-1:]])
+            commits.append(commit)
+            objects.extend([blob, tree, commit])
+        return commits, objects
+
+    def test_repack_loose_and_packs(self):
+        commits, objects = self._make_history(
+            ["line %d\n" % i * 100 for i in range(4)])
+        self.store.add_objects([(o, None) for o in objects[:6]])
+        self.store.add_objects([(o, None) for o in objects[6:9]])
+        for o in objects[9:]:
+            self.store.add_object(o)
+        self.assertEquals(2, len(self.store.packs))
+        pack = self.store.repack([commits[-1].id])
+        self.assertEquals([pack], self.store.packs)
+        self.assertEquals(len(objects), len(pack))
+        self.assertTrue(pack.check())
+        self.assertEquals([], list(self.store._iter_loose_objects()))
+        for o in objects:
+            self.assertEquals(o, self.store[o.id])
+
+    def test_repack_unreachable(self):
+        commits, objects = self._make_history(["a", "b"])
+        self.store.add_objects([(o, None) for o in objects[:3]])
+        loose = make_object(Blob, data="loose and unreachable")
+        self.store.add_object(loose)
+        packed = make_object(Blob, data="packed and unreachable")
+        self.store.add_objects([(packed, None)] +
+                               [(o, None) for o in objects[3:]])
+        pack = self.store.repack([commits[0].id])
+        self.assertEquals(3, len(pack))
+        self.assertFalse(packed.id in self.store)
+        self.assertFalse(commits[1].id in self.store)
+        # unreachable loose objects are left for a separate prune
+        self.assertTrue(self.store.contains_loose(loose.id))
+
+    def test_prune(self):
+        commits, objects = self._make_history(["a", "b"])
+        for o in objects:
+            self.store.add_object(o)
+        old = make_object(Blob, data="old and unreachable")
+        self.store.add_object(old)
+        fresh = make_object(Blob, data="fresh and unreachable")
+        self.store.add_object(fresh)
+        then = time.time() - self.store.prune_expire - 60
+        for o in objects[:3] + [old]:
+            os.utime(self.store._get_shafile_path(o.id), (then, then))
+        self.assertEquals([old.id], self.store.prune([commits[0].id]))
+        self.assertFalse(old.id in self.store)
+        self.assertTrue(self.store.contains_loose(fresh.id))
+        for o in objects[:3]:
+            self.assertTrue(self.store.contains_loose(o.id))
+        self.assertEquals(set([o.id for o in objects[3:]] + [fresh.id]),
+                          set(self.store.prune([commits[0].id], expire=0)))
+        self.assertFalse(self.store.contains_loose(fresh.id))
+
+    def test_repack_all(self):
+        self.store.add_object(testobject)
+        other = make_object(Blob, data="other data")
+        self.store.add_objects([(other, None)])
+        pack = self.store.repack()
+        self.assertEquals(2, len(pack))
+        self.assertEquals([pack], self.store.packs)
+        self.assertFalse(self.store.contains_loose(testobject.id))
+
+    def test_repack_keep(self):
+        commits, objects = self._make_history(["a", "b"])
+        self.store.add_objects([(o, None) for o in objects[:3]])
+        kept = self.store.packs[0]
+        kept.keep("important")
+        self.store.add_objects([(o, None) for o in objects[3:]])
+        pack = self.store.repack([commits[-1].id])
+        self.assertEquals(3, len(pack))
+        self.assertEquals(set([kept.name(), pack.name()]),
+                          set([p.name() for p in self.store.packs]))
+        self.assertTrue(kept.is_kept())
+        for o in objects:
+            self.assertEquals(o, self.store[o.id])
+
+    def test_repack_same_objects(self):
+        self.store.add_objects([(testobject, None)])
+        pack = self.store.packs[0]
+        self.assertEquals(pack, self.store.repack())
+        self.assertEquals([pack], self.store.packs)
+        self.assertEquals(testobject, self.store[testobject.id])
+
+    def test_repack_reuses_deltas(self):
+        base = make_object(Blob, data="a" * 1000 + "b" * 1000)
+        target = make_object(Blob, data="a" * 1000 + "c" * 1000)
+        path = os.path.join(self.store_dir, "delta.pack")
+        f = SHA1Writer(open(path, 'wb'))
+        f.write("PACK")
+        f.write(struct.pack(">L", 2))
+        f.write(struct.pack(">L", 2))
+        base_offset, _ = write_pack_object(f, base.type_num, base.data)
+        offset = f.tell()
+        write_pack_object(f, 6, (offset - base_offset,
+                                 create_delta(base.data, target.data)))
+        f.close()
+        self.store.move_in_pack(path)
+        pack = self.store.repack()
+        self.assertEquals(target, self.store[target.id])
+        types = dict((sha, type_num) for (sha, _, type_num, _, _, _, _)
+                     in pack.iter_raw_entries())
+        self.assertEquals(6, types[target.sha().digest()])
+
+    def test_repack_deltifies(self):
+        contents = ["".join("line %d\n" % i for i in range(j, j + 200))
+                    for j in range(3)]
+        blobs = [make_object(Blob, data=data) for data in contents]
+        for blob in blobs:
+            self.store.add_object(blob)
+        pack = self.store.repack()
+        types = [type_num for (_, _, type_num, _, _, _, _)
+                 in pack.iter_raw_entries()]
+        self.assertEquals([3, 6, 6], types)
+        for blob in blobs:
+            self.assertEquals(blob, self.store[blob.id])
+
 
 class ObjectStoreTests(object):
 
@@ -98,6 +401,37 @@ class MemoryObjectStoreTests(ObjectStoreTests,TestCase):
         self.store = MemoryObjectStore()
 
 
+class CompactMemoryObjectStoreTests(ObjectStoreTests,TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore(compact=True)
+
+    def test_get_raw(self):
+        self.store.add_object(testobject)
+        self.assertEquals((3, "yummy data"),
+                          self.store.get_raw(testobject.id))
+        self.assertEquals((3, "yummy data"),
+                          self.store.get_raw(testobject.sha().digest()))
+
+    def test_memory_usage(self):
+        blob = make_object(Blob, data="line\n" * 10000)
+        parsed = MemoryObjectStore()
+        parsed.add_object(blob)
+        self.store.add_object(blob)
+        self.assertTrue(self.store.memory_usage() < parsed.memory_usage())
+
+    def test_memory_usage_parsed(self):
+        # The parsed fields are counted, not just the raw contents
+        commit = make_commit(message="x" * 1000)
+        store = MemoryObjectStore()
+        store.add_object(commit)
+        raw = commit.as_raw_string()
+        commit.message
+        self.assertTrue(store.memory_usage() >
+                        sys.getsizeof(raw) + sys.getsizeof(commit.message))
+
+
 class DiskObjectStoreTests(ObjectStoreTests,TestCase):
 
     def setUp(self):
@@ -109,5 +443,350 @@ class DiskObjectStoreTests(ObjectStoreTests,TestCase):
         TestCase.tearDown(self)
         shutil.rmtree(self.store_dir)
 
+    def test_sort_by_location(self):
+        blobs = [make_object(Blob, data=str(i)) for i in range(5)]
+        self.store.add_objects([(b, None) for b in blobs])
+        loose = make_object(Blob, data="loose")
+        self.store.add_object(loose)
+        pack = self.store.packs[0]
+        shas = sorted([b.id for b in blobs], key=pack.index.object_index)
+        entries = [(loose.id, "l")] + [(sha, None) for sha in reversed(shas)]
+        self.assertEquals(shas + [loose.id],
+            [sha for sha, path in self.store.sort_by_location(entries)])
+
+    def test_offset_cache_bases(self):
+        # Only the delta bases are cached, not every object that is read
+        blobs = [make_object(Blob, data="".join("line %d\n" % j
+                                                for j in range(i, 300)))
+                 for i in range(10)]
+        for blob in blobs:
+            self.store.add_object(blob)
+        pack = self.store.repack()
+        bases = set()
+        for (sha, offset, type_num, delta_base, size, compressed,
+             crc_ok) in pack.iter_raw_entries():
+            if type_num == 6:
+                bases.add(delta_base)
+        self.assertNotEquals(set(), bases)
+        entries = self.store.sort_by_location([(b.id, None) for b in blobs])
+        for sha, path in entries:
+            self.store[sha]
+        self.assertEquals(bases, set(pack.data._offset_cache.keys()))
+
+    def test_concurrent_reads(self):
+        # Threads share the Pack, with its file and cache of objects
+        blobs = []
+        for i in range(100):
+            data = "".join("line %d of blob %d\n" % (j, i // 10)
+                           for j in range(200 + i))
+            blobs.append(make_object(Blob, data=data))
+        self.store.add_objects([(b, None) for b in blobs])
+        # Read most objects from the file rather than the cache
+        self.store.packs[0].data._offset_cache.resize(1000)
+        errors = []
+        def read(seed):
+            order = list(blobs)
+            random.Random(seed).shuffle(order)
+            try:
+                for blob in order * 20:
+                    if self.store[blob.id].data != blob.data:
+                        errors.append(blob.id)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=read, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals([], errors)
+
+    def test_get_object_size(self):
+        contents = ["".join("line %d\n" % i for i in range(j, j + 200))
+                    for j in range(3)]
+        blobs = [make_object(Blob, data=data) for data in contents]
+        for blob in blobs:
+            self.store.add_object(blob)
+        loose = make_object(Blob, data="x" * 5000)
+        self.store.add_object(loose)
+        for blob in blobs + [loose]:
+            self.assertEquals(len(blob.data),
+                              self.store.get_object_size(blob.id))
+        # Packed objects, some of which are deltas
+        pack = self.store.repack()
+        self.assertTrue(6 in [type_num for (_, _, type_num, _, _, _, _)
+                              in pack.iter_raw_entries()])
+        for blob in blobs + [loose]:
+            self.assertEquals(len(blob.data),
+                              self.store.get_object_size(blob.id))
+            self.assertEquals(len(blob.data),
+                self.store.get_object_size(blob.sha().digest()))
+        self.assertRaises(KeyError, self.store.get_object_size, "a" * 40)
+
+    def test_get_object_size_new_style(self):
+        blob = make_object(Blob, data="new style " * 100)
+        path = os.path.join(self.store_dir, blob.id[:2], blob.id[2:])
+        os.mkdir(os.path.dirname(path))
+        f = open(path, 'wb')
+        try:
+            # New style loose objects have the same format as pack entries
+            write_pack_object(f, blob.type_num, blob.data)
+        finally:
+            f.close()
+        self.assertEquals(blob, self.store[blob.id])
+        self.assertEquals(len(blob.data), self.store.get_object_size(blob.id))
+
+    def test_open_legacy_loose_object(self):
+        blob = make_object(Blob, data="loose")
+        self.store.add_object(blob)
+        f = self.store.open_legacy_loose_object(blob.id)
+        try:
+            self.assertEquals(blob.as_legacy_object(), f.read())
+        finally:
+            f.close()
+        self.assertEquals(None, self.store.open_legacy_loose_object("a" * 40))
+
+
+class MissingObjectFinderTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+        self.blob_a1 = make_object(Blob, data='a1')
+        self.blob_a2 = make_object(Blob, data='a2')
+        self.blob_b = make_object(Blob, data='b')
+
+    def assertMissing(self, expected, haves, wants):
+        self.assertEquals(sorted(expected), sorted(sha for sha, path in
+            self.store.find_missing_objects(haves, wants)))
+
+    def test_all(self):
+        c1, = build_commit_graph(self.store, [[1]],
+                                 trees={1: [('a', self.blob_a1)]})
+        self.assertMissing([c1.id, c1.tree, self.blob_a1.id], [], [c1.id])
+
+    def test_same_object_in_several_places(self):
+        c1, = build_commit_graph(self.store, [[1]],
+            trees={1: [('a', self.blob_a1), ('x/a', self.blob_a1),
+                       ('y/a', self.blob_a1)]})
+        tree = self.store[c1.tree]
+        self.assertEquals(tree['x'], tree['y'])
+        self.assertMissing([c1.id, c1.tree, tree['x'][1], self.blob_a1.id],
+                           [], [c1.id])
+
+    def test_nothing_missing(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]])
+        self.assertMissing([], [c2.id], [c2.id])
+        self.assertMissing([], [c2.id], [c1.id])
+
+    def test_unchanged_trees(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]],
+            trees={1: [('a', self.blob_a1), ('x/b', self.blob_b)],
+                   2: [('a', self.blob_a2), ('x/b', self.blob_b)]})
+        self.assertMissing([c2.id, c2.tree, self.blob_a2.id],
+                           [c1.id], [c2.id])
+
+    def test_excludes_ancestors_of_haves(self):
+        c1, c2, c3, c4 = build_commit_graph(self.store,
+            [[1], [2, 1], [3, 1], [4, 2, 3]],
+            trees={1: [('a', self.blob_a1)],
+                   2: [('a', self.blob_a1), ('b', self.blob_b)],
+                   3: [('a', self.blob_a2)],
+                   4: [('a', self.blob_a2), ('b', self.blob_b)]})
+        self.assertMissing([c3.id, c3.tree, self.blob_a2.id, c4.id, c4.tree],
+                           [c2.id], [c4.id])
+
+    def test_unknown_haves(self):
+        c1, = build_commit_graph(self.store, [[1]],
+                                 trees={1: [('a', self.blob_a1)]})
+        self.assertMissing([c1.id, c1.tree, self.blob_a1.id],
+                           ['1' * 40], [c1.id])
+
+    def test_tag(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]],
+            trees={1: [('a', self.blob_a1)], 2: [('a', self.blob_a2)]})
+        tag = make_object(Tag, tagger='Test Tagger <test@nodomain.com>',
+                          message='Test tag.', name='tag', tag_time=0,
+                          tag_timezone=0, object=(c2.__class__, c2.id))
+        self.store.add_object(tag)
+        self.assertMissing([tag.id, c2.id, c2.tree, self.blob_a2.id],
+                           [c1.id], [tag.id])
+        self.assertMissing([], [tag.id], [c1.id])
+
+    def test_shallow(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 2]],
+            trees={1: [('a', self.blob_a1)],
+                   2: [('a', self.blob_a1), ('b', self.blob_b)],
+                   3: [('a', self.blob_a2), ('b', self.blob_b)]})
+        # The parents of shallow commits are not assumed to be present
+        self.assertEquals(sorted([c2.id, c2.tree, self.blob_a1.id,
+                                  self.blob_b.id, c3.id, c3.tree,
+                                  self.blob_a2.id]),
+                          sorted(sha for sha, path in
+                                 self.store.find_missing_objects(
+                                     [], [c3.id], shallow=[c2.id])))
+        # A have beyond the cut-off is not used to exclude anything
+        self.assertEquals(sorted([c3.id, c3.tree, self.blob_a2.id,
+                                  self.blob_b.id]),
+                          sorted(sha for sha, path in
+                                 self.store.find_missing_objects(
+                                     [c1.id], [c3.id], shallow=[c3.id])))
+
+    def assertFiltered(self, expected, wants, filter_spec, haves=[]):
+        self.assertEquals(sorted(expected), sorted(sha for sha, path in
+            self.store.find_missing_objects(haves, wants,
+                                            filter_spec=filter_spec)))
+
+    def test_filter_blob_none(self):
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]],
+            trees={1: [('a', self.blob_a1)],
+                   2: [('a', self.blob_a2), ('x/b', self.blob_b)]})
+        tree_x = self.store[c2.tree]['x'][1]
+        self.assertFiltered([c1.id, c1.tree, c2.id, c2.tree, tree_x],
+                            [c2.id], 'blob:none')
+        # Blobs that are wanted explicitly are sent anyway
+        self.assertFiltered([c2.id, c2.tree, tree_x, self.blob_b.id],
+                            [c2.id, self.blob_b.id], 'blob:none', [c1.id])
+
+    def test_filter_blob_limit(self):
+        big = make_object(Blob, data='x' * 2048)
+        c1, = build_commit_graph(self.store, [[1]],
+            trees={1: [('a', self.blob_a1), ('big', big)]})
+        self.assertFiltered([c1.id, c1.tree, self.blob_a1.id], [c1.id],
+                            'blob:limit=2k')
+        self.assertFiltered([c1.id, c1.tree, self.blob_a1.id, big.id],
+                            [c1.id], 'blob:limit=2049')
+        self.assertFiltered([c1.id, c1.tree], [c1.id], 'blob:limit=2')
+
+    def test_filter_tree_depth(self):
+        c1, = build_commit_graph(self.store, [[1]],
+            trees={1: [('a', self.blob_a1), ('x/b', self.blob_b),
+                       ('x/y/c', self.blob_a2)]})
+        tree_x = self.store[c1.tree]['x'][1]
+        tree_y = self.store[tree_x]['y'][1]
+        self.assertFiltered([c1.id], [c1.id], 'tree:0')
+        self.assertFiltered([c1.id, c1.tree], [c1.id], 'tree:1')
+        self.assertFiltered([c1.id, c1.tree, self.blob_a1.id, tree_x],
+                            [c1.id], 'tree:2')
+        self.assertFiltered([c1.id, c1.tree, self.blob_a1.id, tree_x,
+                             self.blob_b.id, tree_y], [c1.id], 'tree:3')
+
+    def test_filter_tree_smallest_depth(self):
+        # The same tree is both at the top and further down
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]],
+            trees={1: [('x/y/b', self.blob_b)],
+                   2: [('x/y/b', self.blob_b), ('y/b', self.blob_b)]})
+        tree_x = self.store[c1.tree]['x'][1]
+        tree_y = self.store[tree_x]['y'][1]
+        self.assertEquals(tree_y, self.store[c2.tree]['y'][1])
+        self.assertFiltered([c1.id, c1.tree, c2.id, c2.tree, tree_x, tree_y,
+                             self.blob_b.id], [c2.id], 'tree:3')
+
+    def test_filter_invalid(self):
+        c1, = build_commit_graph(self.store, [[1]])
+        self.assertRaises(ValueError, self.store.find_missing_objects, [],
+                          [c1.id], filter_spec='sparse:oid=foo')
+
+
+class ParseFilterSpecTests(TestCase):
+
+    def test_valid(self):
+        self.assertEquals((0, None), parse_filter_spec('blob:none'))
+        self.assertEquals((100, None), parse_filter_spec('blob:limit=100'))
+        self.assertEquals((2048, None), parse_filter_spec('blob:limit=2k'))
+        self.assertEquals((3 * 1024 ** 2, None),
+                          parse_filter_spec('blob:limit=3M'))
+        self.assertEquals((None, 0), parse_filter_spec('tree:0'))
+        self.assertEquals((None, 2), parse_filter_spec('tree:2'))
+
+    def test_invalid(self):
+        for spec in ('blob:limit=', 'blob:limit=k', 'blob:limit=1t',
+                     'tree:', 'tree:-1', 'object:type=blob', 'combine:'):
+            self.assertRaises(ValueError, parse_filter_spec, spec)
+
+
+class ObjectStoreGraphWalkerTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
 
-# TODO: MissingObjectFinderTests
+    def make_linear_commits(self, num_commits):
+        commit_spec = [[1]] + [[i, i - 1] for i in range(2, num_commits + 1)]
+        return build_commit_graph(self.store, commit_spec)
+
+    def walk(self, walker, common=()):
+        offered = []
+        sha = walker.next()
+        while sha:
+            offered.append(sha)
+            if sha in common:
+                walker.ack(sha)
+            sha = walker.next()
+        return offered
+
+    def test_linear(self):
+        commits = self.make_linear_commits(5)
+        walker = self.store.get_graph_walker([commits[-1].id])
+        self.assertEquals([c.id for c in reversed(commits)], self.walk(walker))
+
+    def test_ack(self):
+        commits = self.make_linear_commits(5)
+        walker = self.store.get_graph_walker([commits[-1].id])
+        self.assertEquals([commits[4].id, commits[3].id],
+                          self.walk(walker, [commits[3].id]))
+
+    def test_newest_first(self):
+        c1, x2, y3, x4 = build_commit_graph(self.store,
+                                            [[1], [2, 1], [3, 1], [4, 2]])
+        walker = self.store.get_graph_walker([x4.id, y3.id])
+        self.assertEquals([x4.id, y3.id, x2.id, c1.id], self.walk(walker))
+
+    def test_ack_merge(self):
+        c1, x2, y3, m4 = build_commit_graph(self.store,
+                                            [[1], [2, 1], [3, 1], [4, 2, 3]])
+        walker = self.store.get_graph_walker([m4.id])
+        # Acking one parent does not make the other common
+        self.assertEquals([m4.id, y3.id, x2.id],
+                          self.walk(walker, [y3.id, x2.id]))
+
+    def test_skipping(self):
+        commits = self.make_linear_commits(100)
+        walker = self.store.get_graph_walker([commits[-1].id], skipping=True)
+        offered = self.walk(walker)
+        # Gaps of 1, 2, 4, 7, 11, ... commits
+        self.assertEquals([commits[i].id for i in (99, 97, 94, 89, 81, 69)],
+                          offered[:6])
+        self.assertEquals(commits[0].id, offered[-1])
+        self.assertTrue(len(offered) < 15, len(offered))
+
+    def test_skipping_ack(self):
+        commits = self.make_linear_commits(100)
+        walker = self.store.get_graph_walker([commits[-1].id], skipping=True)
+        offered = self.walk(walker, [commits[89].id])
+        self.assertEquals([commits[i].id for i in (99, 97, 94, 89)], offered)
+
+    def test_shallow(self):
+        commits = self.make_linear_commits(5)
+        walker = self.store.get_graph_walker([commits[-1].id],
+                                             shallow=[commits[2].id])
+        self.assertEquals([c.id for c in reversed(commits[2:])],
+                          self.walk(walker))
+
+    def test_update_shallow(self):
+        commits = self.make_linear_commits(5)
+        walker = self.store.get_graph_walker([commits[-1].id],
+                                             shallow=[commits[2].id])
+        walker.update_shallow([commits[3].id], [commits[2].id])
+        self.assertEquals(set([commits[3].id]), walker.shallow)
+        self.assertEquals([commits[4].id, commits[3].id], self.walk(walker))
+
+    def test_unshallow(self):
+        commits = self.make_linear_commits(5)
+        walker = self.store.get_graph_walker([commits[-1].id],
+                                             shallow=[commits[2].id])
+        walker.update_shallow([], [commits[2].id])
+        self.assertEquals(set(), walker.shallow)
+        # The parents are only there once the pack has been fetched
+        self.assertEquals([c.id for c in reversed(commits[2:])],
+                          self.walk(walker))
@@ -23,6 +23,7 @@
 
 from cStringIO import StringIO
 import os
+import random
 import unittest
 import zlib
 
@@ -42,6 +43,9 @@ from dulwich.pack import (
     write_pack_index_v2,
     write_pack,
     )
+from dulwich.tests import (
+    TestSkipped,
+    )
 
 pack1_sha = 'bc63ddad95e7321ee734ea11a7a62d314e0d7481'
 
@@ -124,6 +128,22 @@ class TestPackDeltas(unittest.TestCase):
     def test_overflow(self):
         self._test_roundtrip(self.test_string_empty, self.test_string_big)
 
+    def test_binary(self):
+        # Binary data with few newlines is still matched byte by byte
+        rand = random.Random(42)
+        base = "".join(chr(rand.randrange(256)) for i in range(4000))
+        target = base[:1000] + "\0changed\0" + base[1010:]
+        delta = create_delta(base, target)
+        self.assertEquals(target, "".join(apply_delta(base, delta)))
+        self.assertTrue(len(delta) < 100)
+
+    def test_lines(self):
+        base = "".join("line %d\n" % i for i in range(1000))
+        target = base.replace("line 500\n", "changed\n")
+        delta = create_delta(base, target)
+        self.assertEquals(target, "".join(apply_delta(base, delta)))
+        self.assertTrue(len(delta) < 100)
+
 
 class TestPackData(PackTests):
     """Tests getting the data from the packfile."""
@@ -161,6 +181,25 @@ class TestPackData(PackTests):
         idx2 = self.get_pack_index(pack1_sha)
         self.assertEquals(idx1, idx2)
 
+    def test_fork(self):
+        if not getattr(os, 'fork', None):
+            raise TestSkipped('os.fork() is not available')
+        p = self.get_pack_data(pack1_sha)
+        f = p._get_file()
+        f.seek(0)
+        pid = os.fork()
+        if pid == 0:
+            # The child reads from a file of its own
+            status = 1
+            try:
+                if p.get_object_at(178) == (3, ['test 1\n']):
+                    status = 0
+            finally:
+                os._exit(status)
+        self.assertEquals(0, os.waitpid(pid, 0)[1])
+        # The offset of the file of the parent did not move
+        self.assertEquals(0, os.lseek(f.fileno(), 0, os.SEEK_CUR))
+
 
 class TestPack(PackTests):
 
@@ -220,6 +259,13 @@ class TestPack(PackTests):
         p = self.get_pack(pack1_sha)
         self.assertEquals(pack1_sha, p.name())
 
+    def test_get_object_size(self):
+        p = self.get_pack(pack1_sha)
+        for sha in [a_sha, tree_sha, commit_sha]:
+            self.assertEquals(len(p[sha].as_raw_string()),
+                              p.get_object_size(hex_to_sha(sha)))
+        self.assertRaises(KeyError, p.get_object_size, "\0" * 20)
+
 
 class TestHexToSha(unittest.TestCase):
 
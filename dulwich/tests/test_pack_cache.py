@@ -0,0 +1,168 @@
+# test_pack_cache.py -- Tests for the on-disk pack cache
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for the on-disk pack cache."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dulwich.pack_cache import (
+    PackCache,
+    make_pack_cache_key,
+    )
+
+ONE = '1' * 40
+TWO = '2' * 40
+THREE = '3' * 40
+
+
+class MakePackCacheKeyTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.refs = {'refs/heads/master': ONE, 'refs/heads/foo': TWO}
+
+    def test_order(self):
+        self.assertEquals(
+            make_pack_cache_key(self.refs, [ONE, TWO], [THREE],
+                                ['side-band-64k', 'ofs-delta']),
+            make_pack_cache_key(dict(self.refs), [TWO, ONE, TWO], [THREE],
+                                ['ofs-delta', 'side-band-64k']))
+
+    def test_differs(self):
+        key = make_pack_cache_key(self.refs, [ONE], [], ['ofs-delta'])
+        refs = dict(self.refs)
+        refs['refs/heads/master'] = THREE
+        self.assertNotEquals(key,
+            make_pack_cache_key(refs, [ONE], [], ['ofs-delta']))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [TWO], [], ['ofs-delta']))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [ONE], [TWO], ['ofs-delta']))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [ONE], [], []))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [ONE], [], ['ofs-delta'],
+                                depth=1))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [ONE], [], ['ofs-delta'],
+                                shallow=[TWO]))
+        self.assertNotEquals(key,
+            make_pack_cache_key(self.refs, [ONE], [], ['ofs-delta'],
+                                filter_spec='blob:none'))
+
+
+class PackCacheTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = PackCache(os.path.join(self.tempdir, 'cache'), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        TestCase.tearDown(self)
+
+    def add(self, repo_name, key, data):
+        f, commit, abort = self.cache.add(repo_name, key)
+        f.write(data)
+        commit()
+
+    def read(self, repo_name, key):
+        f = self.cache.open(repo_name, key)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set_used(self, repo_name, key, when):
+        path = self.cache._pack_path(repo_name, key)
+        os.utime(path, (when, when))
+
+    def test_missing(self):
+        self.assertEquals(None, self.read('/', ONE))
+
+    def test_add(self):
+        self.add('/', ONE, 'PACK1')
+        self.add('/other', ONE, 'PACK2')
+        self.assertEquals('PACK1', self.read('/', ONE))
+        self.assertEquals('PACK2', self.read('/other', ONE))
+        self.assertEquals(None, self.read('/', TWO))
+
+    def test_abort(self):
+        f, commit, abort = self.cache.add('/', ONE)
+        f.write('PA')
+        abort()
+        self.assertEquals(None, self.read('/', ONE))
+        # The pack can be added again
+        self.add('/', ONE, 'PACK')
+        self.assertEquals('PACK', self.read('/', ONE))
+
+    def test_add_concurrent(self):
+        f, commit, abort = self.cache.add('/', ONE)
+        self.assertEquals(None, self.cache.add('/', ONE))
+        # Nothing is read before the pack is complete
+        self.assertEquals(None, self.read('/', ONE))
+        f.write('PACK')
+        commit()
+        self.assertEquals('PACK', self.read('/', ONE))
+
+    def test_trim(self):
+        self.add('/', ONE, 'a' * 40)
+        self.set_used('/', ONE, 1000)
+        self.add('/other', TWO, 'b' * 40)
+        self.set_used('/other', TWO, 2000)
+        self.assertEquals('a' * 40, self.read('/', ONE))
+        # Reading the first pack made the second one least recently used
+        self.add('/', THREE, 'c' * 40)
+        self.assertEquals('a' * 40, self.read('/', ONE))
+        self.assertEquals(None, self.read('/other', TWO))
+        self.assertEquals('c' * 40, self.read('/', THREE))
+
+    def test_trim_stale_lock(self):
+        # A writer died while adding the pack, leaving its lock file behind
+        f, commit, abort = self.cache.add('/', ONE)
+        f.write('PA')
+        lock_path = self.cache._pack_path('/', ONE) + '.lock'
+        self.assertEquals(None, self.cache.add('/', ONE))
+        # A lock that is still being written to is kept
+        self.cache.trim()
+        self.assertEquals(None, self.cache.add('/', ONE))
+        os.utime(lock_path, (1000, 1000))
+        self.cache.trim()
+        self.add('/', ONE, 'PACK')
+        self.assertEquals('PACK', self.read('/', ONE))
+
+    def test_trim_too_large(self):
+        self.add('/', ONE, 'a' * 101)
+        self.assertEquals(None, self.read('/', ONE))
+
+    def test_invalidate(self):
+        self.add('/', ONE, 'PACK1')
+        self.add('/', TWO, 'PACK2')
+        self.add('/other', ONE, 'PACK3')
+        self.cache.invalidate('/')
+        self.assertEquals(None, self.read('/', ONE))
+        self.assertEquals(None, self.read('/', TWO))
+        self.assertEquals('PACK3', self.read('/other', ONE))
+        # Repositories that were never cached are fine
+        self.cache.invalidate('/unknown')
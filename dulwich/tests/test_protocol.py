@@ -24,11 +24,13 @@ from StringIO import StringIO
 from unittest import TestCase
 
 from dulwich.protocol import (
+    DELIM_PKT,
     Protocol,
     ReceivableProtocol,
     extract_capabilities,
     extract_want_line_capabilities,
     ack_type,
+    protocol_version,
     SINGLE_ACK,
     MULTI_ACK,
     MULTI_ACK_DETAILED,
@@ -59,6 +61,16 @@ class BaseProtocolTests(object):
         self.rin.seek(0)
         self.assertEquals(None, self.proto.read_pkt_line())
 
+    def test_write_pkt_line_delim(self):
+        self.proto.write_pkt_line(DELIM_PKT)
+        self.assertEquals(self.rout.getvalue(), "0001")
+
+    def test_read_pkt_line_delim(self):
+        self.rin.write("00010000")
+        self.rin.seek(0)
+        self.assertEquals(DELIM_PKT, self.proto.read_pkt_line())
+        self.assertEquals(None, self.proto.read_pkt_line())
+
     def test_write_sideband(self):
         self.proto.write_sideband(3, "bloe")
         self.assertEquals(self.rout.getvalue(), "0009\x03bloe")
@@ -192,3 +204,9 @@ class CapabilitiesTestCase(TestCase):
         self.assertEquals(MULTI_ACK_DETAILED,
                           ack_type(['foo', 'bar', 'multi_ack',
                                     'multi_ack_detailed']))
+
+    def test_protocol_version(self):
+        self.assertEquals(0, protocol_version([]))
+        self.assertEquals(0, protocol_version(['host=foo', 'version=x']))
+        self.assertEquals(2, protocol_version(['version=2']))
+        self.assertEquals(2, protocol_version(['version=1', 'version=2']))
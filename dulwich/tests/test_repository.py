@@ -29,6 +29,7 @@ import warnings
 
 from dulwich import errors
 from dulwich import objects
+import dulwich.repo
 from dulwich.repo import (
     check_ref_format,
     Repo,
@@ -38,6 +39,7 @@ from dulwich.repo import (
     _split_ref_line,
     )
 from dulwich.tests.utils import (
+    backdate_refs,
     open_repo,
     tear_down_repo,
     )
@@ -233,6 +235,37 @@ class RepositoryTests(unittest.TestCase):
                                 'fb5b0425c7ce46959bec94d54b9a157645e114f5',
                                 'f9e39b120c68182a4ba35349f832d0e4e61f485c'])
   
+    def test_find_merge_base(self):
+        r = self._repo = open_repo('simple_merge.git')
+        self.assertEquals(['60dacdc733de308bb77bb76ce0fb0f9b44c9769e'],
+            r.find_merge_base('ab64bbdcc51b170d21588e5c5d391ee5c0c96dfd',
+                              '4cffe90e0a41ad3f5190079d7c8f036bde29cbe6'))
+
+    def test_is_ancestor(self):
+        r = self._repo = open_repo('simple_merge.git')
+        self.assertTrue(r.is_ancestor(
+            '4cffe90e0a41ad3f5190079d7c8f036bde29cbe6', r.head()))
+        self.assertFalse(r.is_ancestor(
+            'ab64bbdcc51b170d21588e5c5d391ee5c0c96dfd',
+            '4cffe90e0a41ad3f5190079d7c8f036bde29cbe6'))
+
+    def test_shallow(self):
+        r = self._repo = open_repo('simple_merge.git')
+        self.assertEquals(set(), r.get_shallow())
+        shallow = '60dacdc733de308bb77bb76ce0fb0f9b44c9769e'
+        r.update_shallow([shallow], [])
+        self.assertEquals(set([shallow]), r.get_shallow())
+        self.assertEquals(set([shallow]), r.get_graph_walker().shallow)
+        self.assertEquals(['5dac377bdded4c9aeb8dff595f0faeebcc8498cc',
+                           'ab64bbdcc51b170d21588e5c5d391ee5c0c96dfd',
+                           '4cffe90e0a41ad3f5190079d7c8f036bde29cbe6',
+                           shallow],
+                          [c.id for c in r.get_walker()])
+        r.update_shallow([], [shallow])
+        self.assertEquals(set(), r.get_shallow())
+        self.assertFalse(os.path.exists(
+            os.path.join(r.controldir(), 'shallow')))
+
     def test_get_tags_empty(self):
         r = self._repo = open_repo('ooo_merge.git')
         self.assertEqual({}, r.refs.as_dict('refs/tags'))
@@ -557,6 +590,31 @@ class RefsContainerTests(unittest.TestCase):
             'df6800012397fb85c56e7418dd4eb9405dee075c'))
         self.assertRaises(KeyError, lambda: self._refs['refs/tags/refs-0.1'])
 
+    def test_stamp(self):
+        # Changes right after the refs were changed may go unnoticed
+        backdate_refs(self._repo, 0)
+        self.assertEqual(None, self._refs.stamp())
+        backdate_refs(self._repo, 100)
+        stamp = self._refs.stamp()
+        self.assertNotEqual(None, stamp)
+        self.assertEqual(stamp, self._refs.stamp())
+
+    def test_stamp_changes(self):
+        backdate_refs(self._repo, 100)
+        racy_interval = dulwich.repo.REFS_STAMP_RACY_INTERVAL
+        dulwich.repo.REFS_STAMP_RACY_INTERVAL = -1
+        try:
+            stamps = [self._refs.stamp()]
+            self._refs['refs/heads/new'] = self._refs['refs/heads/master']
+            stamps.append(self._refs.stamp())
+            del self._refs['refs/heads/new']
+            stamps.append(self._refs.stamp())
+            self._refs.set_symbolic_ref('HEAD', 'refs/heads/packed')
+            stamps.append(self._refs.stamp())
+        finally:
+            dulwich.repo.REFS_STAMP_RACY_INTERVAL = racy_interval
+        self.assertEqual(len(stamps), len(set(stamps)))
+
     def test_read_ref(self):
         self.assertEqual('ref: refs/heads/master', self._refs.read_ref("HEAD"))
         self.assertEqual('42d06bd4b77fed026b154d16493e5deab78f02ec', 
@@ -20,21 +20,71 @@
 """Tests for the smart protocol server."""
 
 
+from cStringIO import StringIO
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
 from unittest import TestCase
 
+from dulwich.client import (
+    TCPGitClient,
+    )
 from dulwich.errors import (
     GitProtocolError,
+    HangupException,
+    )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.object_store import (
+    ObjectStoreGraphWalker,
+    )
+from dulwich.pack import (
+    write_pack_data,
+    )
+from dulwich.pack_cache import (
+    PackCache,
+    )
+from dulwich.protocol import (
+    DELIM_PKT,
+    Protocol,
+    ReceivableProtocol,
+    ZERO_SHA,
+    )
+from dulwich.repo import (
+    Repo,
     )
 from dulwich.server import (
+    PooledTCPGitServer,
     Backend,
     DictBackend,
     BackendRepo,
+    ForkingTCPGitServer,
     Handler,
     MultiAckGraphWalkerImpl,
     MultiAckDetailedGraphWalkerImpl,
     ProtocolGraphWalker,
+    ReceivePackHandler,
+    RefAdvertisementCache,
     SingleAckGraphWalkerImpl,
+    ThreadedTCPGitServer,
     UploadPackHandler,
+    UploadPackV2Handler,
+    get_handler_class,
+    )
+from dulwich.tests import (
+    TestSkipped,
+    )
+from dulwich.tests.utils import (
+    backdate_refs,
+    build_commit_graph,
+    make_object,
+    open_repo,
+    tear_down_repo,
     )
 
 
@@ -183,6 +233,16 @@ class TestCommit(object):
         return '%s(%s)' % (self.__class__.__name__, self._sha)
 
 
+class TestObjectStore(dict):
+    """Dictionary of TestCommits that can be used as an object store."""
+
+    def get_parents(self, sha):
+        return self[sha].parents
+
+    def get_commit_time(self, sha):
+        return self[sha].commit_time
+
+
 class TestRepo(object):
     def __init__(self):
         self.peeled = {}
@@ -217,13 +277,13 @@ class ProtocolGraphWalkerTestCase(TestCase):
         #   3---5
         #  /
         # 1---2---4
-        self._objects = {
+        self._objects = TestObjectStore({
             ONE: TestCommit(ONE, [], 111),
             TWO: TestCommit(TWO, [ONE], 222),
             THREE: TestCommit(THREE, [ONE], 333),
             FOUR: TestCommit(FOUR, [TWO], 444),
             FIVE: TestCommit(FIVE, [THREE], 555),
-            }
+            })
 
         self._walker = ProtocolGraphWalker(
             TestUploadPackHandler(self._objects, TestProto()),
@@ -254,6 +314,30 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self.assertFalse(self._walker.all_wants_satisfied([THREE]))
         self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
 
+    def test_all_wants_satisfied_no_haves(self):
+        self._walker.set_wants([FOUR])
+        self.assertFalse(self._walker.all_wants_satisfied([]))
+
+    def test_all_wants_satisfied_walks_once(self):
+        lookups = []
+        get_parents = self._objects.get_parents
+        def counting_get_parents(sha):
+            lookups.append(sha)
+            return get_parents(sha)
+        self._objects.get_parents = counting_get_parents
+        self._walker.set_wants([FOUR, FIVE])
+        self.assertFalse(self._walker.all_wants_satisfied([TWO]))
+        self.assertTrue(self._walker.all_wants_satisfied([TWO, THREE]))
+        self.assertTrue(self._walker.all_wants_satisfied([ONE]))
+        self.assertEquals(sorted([ONE, TWO, THREE, FOUR, FIVE]),
+                          sorted(lookups))
+
+    def test_all_wants_satisfied_parent_newer(self):
+        # 2 claims to be newer than its child 4
+        self._objects[TWO].commit_time = 999
+        self._walker.set_wants([FOUR])
+        self.assertTrue(self._walker.all_wants_satisfied([TWO]))
+
     def test_read_proto_line(self):
         self._walker.proto.set_output([
             'want %s' % ONE,
@@ -294,6 +378,86 @@ class ProtocolGraphWalkerTestCase(TestCase):
         self._walker.proto.set_output(['want %s multi_ack' % FOUR])
         self.assertRaises(GitProtocolError, self._walker.determine_wants, heads)
 
+    def read_received_lines(self):
+        lines = []
+        while True:
+            line = self._walker.proto.get_received_line()
+            if line is None:
+                return lines
+            lines.append(line.rstrip())
+
+    def test_determine_wants_deepen(self):
+        heads = {'ref4': FOUR, 'ref5': FIVE}
+        self._walker.advertise_refs = False
+        self._walker.stateless_rpc = True
+        self._walker.proto.set_output([
+            'want %s multi_ack' % FOUR,
+            'want %s' % FIVE,
+            'deepen 2',
+            ])
+        self.assertEquals([FOUR, FIVE], self._walker.determine_wants(heads))
+        self.assertEquals(['shallow %s' % TWO, 'shallow %s' % THREE, 'None'],
+                          self.read_received_lines())
+        self.assertEquals(set([TWO, THREE]), self._walker.shallow)
+
+    def test_determine_wants_unshallow(self):
+        heads = {'ref4': FOUR, 'ref5': FIVE}
+        self._walker.advertise_refs = False
+        self._walker.stateless_rpc = True
+        self._walker.proto.set_output([
+            'want %s multi_ack' % FOUR,
+            'shallow %s' % FOUR,
+            'shallow %s' % FIVE,
+            'deepen 2',
+            ])
+        # The parents of the commit that is no longer shallow are needed
+        self.assertEquals([FOUR, TWO], self._walker.determine_wants(heads))
+        self.assertEquals(['shallow %s' % TWO, 'unshallow %s' % FOUR, 'None'],
+                          self.read_received_lines())
+        self.assertEquals(set([TWO, FOUR, FIVE]), self._walker.shallow)
+
+    def test_determine_wants_shallow_client(self):
+        heads = {'ref4': FOUR}
+        self._walker.advertise_refs = False
+        self._walker.stateless_rpc = True
+        self._walker.proto.set_output([
+            'want %s multi_ack' % FOUR,
+            'shallow %s' % TWO,
+            ])
+        self.assertEquals([FOUR], self._walker.determine_wants(heads))
+        self.assertEquals([], self.read_received_lines())
+        self.assertEquals(set([TWO]), self._walker.shallow)
+
+    def test_determine_wants_invalid_depth(self):
+        heads = {'ref4': FOUR}
+        self._walker.advertise_refs = False
+        self._walker.stateless_rpc = True
+        for depth in ('0', '-1', 'foo'):
+            self._walker.proto.set_output([
+                'want %s multi_ack' % FOUR,
+                'deepen %s' % depth,
+                ])
+            self.assertRaises(GitProtocolError, self._walker.determine_wants,
+                              heads)
+
+    def test_determine_wants_filter(self):
+        heads = {'ref4': FOUR}
+        self._walker.proto.set_output([
+            'want %s multi_ack' % FOUR,
+            'filter blob:none',
+            ])
+        self._walker.advertise_refs = False
+        self._walker.stateless_rpc = True
+        self.assertEquals([FOUR], self._walker.determine_wants(heads))
+        self.assertEquals('blob:none', self._walker.filter_spec)
+
+        self._walker.proto.set_output([
+            'want %s multi_ack' % FOUR,
+            'filter sparse:oid=%s' % FOUR,
+            ])
+        self.assertRaises(GitProtocolError, self._walker.determine_wants,
+                          heads)
+
     def test_determine_wants_advertisement(self):
         self._walker.proto.set_output([])
         # advertise branch tips plus tag
@@ -636,3 +800,604 @@ class MultiAckDetailedGraphWalkerImplTestCase(AckGraphWalkerImplTestCase):
 
         self.assertNextEquals(None)
         self.assertNak()
+
+
+class PackCacheHandlerTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._repo = open_repo('a.git')
+        self._cache_dir = tempfile.mkdtemp()
+        self._backend = DictBackend({'/': self._repo},
+                                    PackCache(self._cache_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_dir)
+        tear_down_repo(self._repo)
+        TestCase.tearDown(self)
+
+    def run_handler(self, cls, lines, data=''):
+        """Run a handler on a scripted request.
+
+        :return: The data the handler wrote
+        """
+        input = StringIO()
+        client = Protocol(None, input.write)
+        for line in lines:
+            client.write_pkt_line(line)
+        input.write(data)
+        input.seek(0)
+        output = StringIO()
+        proto = ReceivableProtocol(input.read, output.write)
+        cls(self._backend, ['/'], proto).handle()
+        return output.getvalue()
+
+    def fetch(self):
+        head = self._repo.refs['refs/heads/master']
+        return self.run_handler(UploadPackHandler,
+            ['want %s side-band-64k thin-pack ofs-delta\n' % head, None,
+             'done\n'])
+
+    def get_pack(self, output):
+        proto = Protocol(StringIO(output).read, None)
+        list(proto.read_pkt_seq())
+        self.assertEquals('NAK\n', proto.read_pkt_line())
+        pack = []
+        for pkt in proto.read_pkt_seq():
+            if pkt[0] == '\x01':
+                pack.append(pkt[1:])
+        return ''.join(pack)
+
+    def test_upload_pack(self):
+        pack = self.get_pack(self.fetch())
+        self.assertTrue(pack.startswith('PACK'))
+        # The pack is sent from the cache, without looking for the objects
+        def find_missing_objects(*args, **kwargs):
+            self.fail('objects are looked up')
+        self._repo.object_store.find_missing_objects = find_missing_objects
+        self.assertEquals(pack, self.get_pack(self.fetch()))
+
+    def test_receive_pack_invalidates(self):
+        self.fetch()
+        self.assertEquals(1, len(list(self._backend.pack_cache._iter_packs())))
+        os.mkdir(self._repo.object_store.pack_dir)
+        head = self._repo.refs['refs/heads/master']
+        pack = StringIO()
+        write_pack_data(pack, [(self._repo[head], None)], 1)
+        self.run_handler(ReceivePackHandler,
+            ['%s %s refs/heads/new\x00report-status' % (ZERO_SHA, head),
+             None], pack.getvalue())
+        self.assertEquals(head, self._repo.refs['refs/heads/new'])
+        self.assertEquals([], list(self._backend.pack_cache._iter_packs()))
+
+
+class RefAdvertisementCacheTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._repo = open_repo('a.git')
+        backdate_refs(self._repo, 100)
+        self._cache = RefAdvertisementCache()
+        self._written = []
+
+    def tearDown(self):
+        tear_down_repo(self._repo)
+        TestCase.tearDown(self)
+
+    def write_advertisement(self, proto, refs):
+        self._written.append(refs)
+        for name, sha in sorted(refs.iteritems()):
+            proto.write_pkt_line('%s %s\n' % (sha, name))
+        proto.write_pkt_line(None)
+
+    def get(self, key='key'):
+        return self._cache.get(self._repo, key, self.write_advertisement)
+
+    def test_get(self):
+        refs, advertisement = self.get()
+        self.assertEquals(self._repo.get_refs(), refs)
+        self.assertEquals([refs], self._written)
+        proto = Protocol(StringIO(advertisement).read, None)
+        self.assertEquals(len(refs), len(list(proto.read_pkt_seq())))
+        self.assertEquals((refs, advertisement), self.get())
+        self.assertEquals(1, len(self._written))
+        # Advertisements with other keys are cached separately
+        self.assertEquals((refs, advertisement), self.get('other'))
+        self.assertEquals(2, len(self._written))
+
+    def test_refs_changed(self):
+        refs, advertisement = self.get()
+        self._repo.refs['refs/heads/new'] = self._repo.refs['refs/heads/master']
+        # Not cached while changes might go unnoticed
+        self.assertEquals(None, self.get())
+        backdate_refs(self._repo, 50)
+        new_refs, new_advertisement = self.get()
+        self.assertEquals(2, len(self._written))
+        self.assertTrue('refs/heads/new' in new_refs)
+        self.assertNotEquals(advertisement, new_advertisement)
+
+    def test_not_on_disk(self):
+        self.assertEquals(None, self._cache.get(BackendRepo(), 'key',
+                                                self.write_advertisement))
+        self.assertEquals(None, self._cache.get_refs(BackendRepo()))
+
+    def test_get_refs(self):
+        refs, peeled = self._cache.get_refs(self._repo)
+        self.assertEquals(self._repo.get_refs(), refs)
+        self.assertEquals(self._repo.get_peeled('refs/tags/mytag'),
+                          peeled['refs/tags/mytag'])
+        self.assertEquals(self._repo.get_peeled('refs/heads/master'),
+                          peeled['refs/heads/master'])
+        # The refs are read and peeled once for all advertisements
+        self._repo.get_refs = lambda: self.fail('refs are read')
+        self._repo.get_peeled = lambda name: self.fail('refs are peeled')
+        self.assertEquals((refs, peeled), self._cache.get_refs(self._repo))
+        self.assertEquals(refs, self.get()[0])
+
+
+class RefAdvertisementHandlerTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._repo = open_repo('a.git')
+        backdate_refs(self._repo, 100)
+
+    def tearDown(self):
+        tear_down_repo(self._repo)
+        TestCase.tearDown(self)
+
+    def advertise(self, cls, cache):
+        backend = DictBackend({'/': self._repo})
+        backend.ref_advertisement_cache = cache
+        output = StringIO()
+        cls(backend, ['/'], Protocol(None, output.write),
+            stateless_rpc=True, advertise_refs=True).handle()
+        return output.getvalue()
+
+    def test_upload_pack(self):
+        advertisement = self.advertise(UploadPackHandler, None)
+        self.assertTrue('refs/tags/mytag^{}' in advertisement)
+        cache = RefAdvertisementCache()
+        self.assertEquals(advertisement,
+                          self.advertise(UploadPackHandler, cache))
+        # Tags are not peeled again
+        def get_peeled(name):
+            self.fail('refs are peeled')
+        self._repo.get_peeled = get_peeled
+        self.assertEquals(advertisement,
+                          self.advertise(UploadPackHandler, cache))
+
+    def fetch(self, cache):
+        backend = DictBackend({'/': self._repo})
+        backend.ref_advertisement_cache = cache
+        head = self._repo.refs['refs/heads/master']
+        input = StringIO()
+        client = Protocol(None, input.write)
+        for line in ['want %s side-band-64k thin-pack ofs-delta include-tag\n'
+                     % head, None, 'done\n']:
+            client.write_pkt_line(line)
+        input.seek(0)
+        output = StringIO()
+        UploadPackHandler(backend, ['/'],
+                          ReceivableProtocol(input.read, output.write)).handle()
+        return output.getvalue()
+
+    def test_upload_pack_fetch(self):
+        cache = RefAdvertisementCache()
+        output = self.fetch(cache)
+        self.assertEquals(self.fetch(None), output)
+        # The refs and the tags to include are not read or peeled again
+        self._repo.get_refs = lambda: self.fail('refs are read')
+        self._repo.get_peeled = lambda name: self.fail('refs are peeled')
+        self.assertEquals(output, self.fetch(cache))
+
+    def test_receive_pack(self):
+        advertisement = self.advertise(ReceivePackHandler, None)
+        cache = RefAdvertisementCache()
+        self.assertEquals(advertisement,
+                          self.advertise(ReceivePackHandler, cache))
+        self._repo.get_refs = lambda: self.fail('refs are read')
+        self.assertEquals(advertisement,
+                          self.advertise(ReceivePackHandler, cache))
+        del self._repo.get_refs
+        # The advertisements of both handlers are told apart
+        self.assertNotEquals(advertisement,
+                             self.advertise(UploadPackHandler, cache))
+
+
+class UploadPackV2HandlerTests(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._repo = open_repo('a.git')
+        self._backend = DictBackend({'/': self._repo})
+        self._head = self._repo.refs['refs/heads/master']
+        self._parent = self._repo[self._head].parents[0]
+
+    def tearDown(self):
+        tear_down_repo(self._repo)
+        TestCase.tearDown(self)
+
+    def run_handler(self, lines, stateless_rpc=True, advertise_refs=False):
+        """Run the handler on a scripted request.
+
+        :return: List with the pkt-lines the handler wrote, with the packs on
+            the side-band replaced by 'PACK'
+        """
+        input = StringIO()
+        client = Protocol(None, input.write)
+        for line in lines:
+            client.write_pkt_line(line)
+        input.seek(0)
+        output = StringIO()
+        UploadPackV2Handler(self._backend, ['/'],
+            ReceivableProtocol(input.read, output.write),
+            stateless_rpc=stateless_rpc, advertise_refs=advertise_refs
+            ).handle()
+        proto = Protocol(StringIO(output.getvalue()).read, None)
+        pkts = []
+        while True:
+            try:
+                pkt = proto.read_pkt_line()
+            except HangupException:
+                return pkts
+            if pkt is None or pkt is DELIM_PKT:
+                pkts.append(pkt)
+            elif pkt[0] == '\x01':
+                if pkt[1:5] == 'PACK':
+                    pkts.append('PACK')
+            elif pkt[0] != '\x02':
+                pkts.append(pkt)
+
+    def command(self, command, args):
+        return (['command=%s\n' % command, 'agent=test\n', DELIM_PKT] +
+                args + [None])
+
+    def test_advertise(self):
+        self.assertEquals(
+            ['version 2\n', 'ls-refs\n', 'fetch=shallow filter\n', None],
+            self.run_handler([], advertise_refs=True))
+
+    def test_ls_refs(self):
+        self.assertEquals(
+            ['%s HEAD\n' % self._head,
+             '%s refs/heads/master\n' % self._head,
+             '28237f4dc30d0d462658d6b937b08a0f0b6ef55a refs/tags/mytag\n',
+             'b0931cadc54336e78a1d980420e3268903b57a50 refs/tags/mytag-packed\n',
+             None],
+            self.run_handler(self.command('ls-refs', [])))
+
+    def test_ls_refs_prefix(self):
+        self.assertEquals(
+            ['b0931cadc54336e78a1d980420e3268903b57a50 refs/tags/mytag-packed '
+             'peeled:%s\n' % self._parent, None],
+            self.run_handler(self.command('ls-refs',
+                ['peel\n', 'ref-prefix refs/tags/mytag-\n'])))
+        self.assertEquals(
+            ['%s HEAD symref-target:refs/heads/master\n' % self._head,
+             '%s refs/heads/master\n' % self._head, None],
+            self.run_handler(self.command('ls-refs',
+                ['symrefs\n', 'ref-prefix HEAD\n',
+                 'ref-prefix refs/heads/\n'])))
+        self.assertEquals([None], self.run_handler(self.command('ls-refs',
+            ['ref-prefix refs/remotes/\n'])))
+
+    def test_cached_refs(self):
+        backdate_refs(self._repo, 100)
+        requests = [
+            self.command('ls-refs', ['peel\n']),
+            self.command('fetch', ['include-tag\n', 'ofs-delta\n',
+                                   'want %s\n' % self._head, 'done\n'])]
+        responses = [self.run_handler(request) for request in requests]
+        # While the refs don't change they are not read or peeled again
+        self._repo.get_refs = lambda: self.fail('refs are read')
+        self._repo.get_peeled = lambda name: self.fail('refs are peeled')
+        self.assertEquals(responses,
+                          [self.run_handler(request) for request in requests])
+
+    def test_ls_refs_invalid(self):
+        self.assertRaises(GitProtocolError, self.run_handler,
+                          self.command('ls-refs', ['foo\n']))
+
+    def test_fetch_done(self):
+        self.assertEquals(['packfile\n', 'PACK', None],
+            self.run_handler(self.command('fetch',
+                ['ofs-delta\n', 'want %s\n' % self._head, 'done\n'])))
+
+    def test_fetch_ready(self):
+        self.assertEquals(
+            ['acknowledgments\n', 'ACK %s\n' % self._parent, 'ready\n',
+             DELIM_PKT, 'packfile\n', 'PACK', None],
+            self.run_handler(self.command('fetch',
+                ['want %s\n' % self._head, 'have %s\n' % ('1' * 40),
+                 'have %s\n' % self._parent])))
+
+    def test_fetch_not_ready(self):
+        self.assertEquals(['acknowledgments\n', 'NAK\n', None],
+            self.run_handler(self.command('fetch',
+                ['want %s\n' % self._head, 'have %s\n' % ('1' * 40)])))
+
+    def test_fetch_deepen(self):
+        self.assertEquals(
+            ['shallow-info\n', 'shallow %s\n' % self._head, DELIM_PKT,
+             'packfile\n', 'PACK', None],
+            self.run_handler(self.command('fetch',
+                ['want %s\n' % self._head, 'deepen 1\n', 'done\n'])))
+        self.assertEquals(
+            ['shallow-info\n', 'shallow %s\n' % self._parent,
+             'unshallow %s\n' % self._head, DELIM_PKT,
+             'packfile\n', 'PACK', None],
+            self.run_handler(self.command('fetch',
+                ['want %s\n' % self._head, 'shallow %s\n' % self._head,
+                 'deepen 1\n', 'deepen-relative\n', 'done\n'])))
+
+    def test_fetch_invalid_want(self):
+        self.assertRaises(GitProtocolError, self.run_handler,
+            self.command('fetch', ['want %s\n' % ('1' * 40), 'done\n']))
+
+    def test_stateful(self):
+        # Without stateless RPC, the capabilities are advertised first, and
+        # commands are read until the client sends a flush-pkt
+        pkts = self.run_handler(
+            self.command('ls-refs', ['ref-prefix refs/heads/\n']) +
+            self.command('fetch', ['want %s\n' % self._head, 'done\n']) +
+            [None], stateless_rpc=False)
+        self.assertEquals(
+            ['version 2\n', 'ls-refs\n', 'fetch=shallow filter\n', None,
+             '%s refs/heads/master\n' % self._head, None,
+             'packfile\n', 'PACK', None], pkts)
+
+    def test_get_handler_class(self):
+        self.assertEquals(UploadPackHandler,
+            get_handler_class('git-upload-pack', ['/', 'host=foo']))
+        self.assertEquals(UploadPackV2Handler,
+            get_handler_class('git-upload-pack',
+                              ['/', 'host=foo', '', 'version=2']))
+        self.assertEquals(ReceivePackHandler,
+            get_handler_class('git-receive-pack',
+                              ['/', 'host=foo', '', 'version=2']))
+        self.assertEquals(None, get_handler_class('git-foo', ['/']))
+
+
+class ThreadedTCPGitServerTests(TestCase):
+
+    server_class = ThreadedTCPGitServer
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._repo = open_repo('a.git')
+        self._sockets = []
+        self._server = None
+
+    def tearDown(self):
+        for sock in self._sockets:
+            sock.close()
+        if self._server is not None:
+            self._server.shutdown_gracefully(5)
+        tear_down_repo(self._repo)
+        TestCase.tearDown(self)
+
+    def start_server(self, **kwargs):
+        self._server = self.server_class(DictBackend({'/': self._repo}),
+                                         'localhost', 0, **kwargs)
+        threading.Thread(target=self._server.serve).start()
+        return self._server.socket.getsockname()[1]
+
+    def connect(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(('localhost', port))
+        self._sockets.append(sock)
+        proto = Protocol(sock.makefile('rb').read, sock.sendall)
+        proto.send_cmd('git-upload-pack', '/', 'host=localhost')
+        return sock, proto
+
+    def is_served(self, sock, timeout=0.5):
+        return bool(select.select([sock], [], [], timeout)[0])
+
+    def finish(self, sock, proto):
+        # Read the ref advertisement and want nothing
+        list(proto.read_pkt_seq())
+        proto.write_pkt_line(None)
+        self.assertEquals('', sock.recv(1))
+
+    def test_concurrent(self):
+        port = self.start_server(max_connections=3)
+        conns = [self.connect(port) for i in range(3)]
+        for sock, proto in conns:
+            self.assertTrue(self.is_served(sock, 5))
+        for sock, proto in conns:
+            self.finish(sock, proto)
+
+    def test_max_connections(self):
+        port = self.start_server(max_connections=2)
+        conn1 = self.connect(port)
+        conn2 = self.connect(port)
+        self.assertTrue(self.is_served(conn1[0], 5))
+        self.assertTrue(self.is_served(conn2[0], 5))
+        conn3 = self.connect(port)
+        self.assertFalse(self.is_served(conn3[0]))
+        self.finish(*conn1)
+        self.assertTrue(self.is_served(conn3[0], 5))
+        self.finish(*conn2)
+        self.finish(*conn3)
+
+    def test_connection_timeout(self):
+        port = self.start_server(connection_timeout=0.1)
+        sock, proto = self.connect(port)
+        list(proto.read_pkt_seq())
+        # The server gives up waiting for the wants
+        self.assertEquals('', sock.recv(1))
+
+    def test_shutdown_gracefully(self):
+        port = self.start_server()
+        sock, proto = self.connect(port)
+        self.assertTrue(self.is_served(sock, 5))
+        server = self._server
+        self._server = None
+        self.assertFalse(server.shutdown_gracefully(0.1))
+        self.assertRaises(socket.error, self.connect, port)
+        # The connection that was being served is finished normally
+        self.finish(sock, proto)
+        self.assertTrue(server.wait_for_connections(5))
+
+    def test_shutdown_while_busy(self):
+        port = self.start_server(max_connections=1)
+        conn1 = self.connect(port)
+        self.assertTrue(self.is_served(conn1[0], 5))
+        conn2 = self.connect(port)
+        self.assertFalse(self.is_served(conn2[0]))
+        server = self._server
+        self._server = None
+        # The server is waiting for conn1 to finish before serving conn2
+        stopper = threading.Thread(target=server.shutdown)
+        stopper.setDaemon(True)
+        stopper.start()
+        stopper.join(5)
+        self.assertFalse(stopper.isAlive())
+        server.server_close()
+        self.assertEquals('', conn2[0].recv(1))
+        self.finish(*conn1)
+        self.assertTrue(server.wait_for_connections(5))
+
+    def test_concurrent_fetch(self):
+        # The connections share the Repo, and so the files and caches of its
+        # packs
+        blobs = [make_object(Blob, data="".join("line %d\n" % j
+                                                for j in range(i, i + 300)))
+                 for i in range(20)]
+        commits = build_commit_graph(self._repo.object_store,
+            [[1]] + [[i, i - 1] for i in range(2, 21)],
+            trees=dict((i + 1, [('file', blob)])
+                       for i, blob in enumerate(blobs)))
+        self._repo.refs['refs/heads/master'] = commits[-1].id
+        os.mkdir(self._repo.object_store.pack_dir)
+        pack = self._repo.object_store.repack()
+        self.assertTrue(6 in [type_num for (_, _, type_num, _, _, _, _)
+                              in pack.iter_raw_entries()])
+        port = self.start_server(max_connections=4)
+        # The clients only receive the packs; they are added to repositories
+        # once all are done, as a child forked while a client thread holds a
+        # lock of the object store module would never see it released
+        packs = []
+        errors = []
+        def fetch():
+            f = StringIO()
+            try:
+                client = TCPGitClient('localhost', port)
+                try:
+                    client.fetch_pack('/',
+                        lambda refs: [refs['refs/heads/master']],
+                        ObjectStoreGraphWalker([], None), f.write,
+                        lambda msg: None)
+                finally:
+                    client._socket.close()
+                packs.append(f.getvalue())
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals([], errors)
+        self.assertEquals(8, len(packs))
+        for data in packs:
+            target = Repo.init_bare(tempfile.mkdtemp())
+            try:
+                f, commit = target.object_store.add_pack()
+                f.write(data)
+                commit()
+                for obj in blobs + commits:
+                    self.assertEquals(obj, target[obj.id])
+            finally:
+                shutil.rmtree(target.path)
+
+
+class ForkingTCPGitServerTests(ThreadedTCPGitServerTests):
+
+    server_class = ForkingTCPGitServer
+
+    def setUp(self):
+        if not getattr(os, 'fork', None):
+            raise TestSkipped('os.fork() is not available')
+        ThreadedTCPGitServerTests.setUp(self)
+
+    def start_server(self, **kwargs):
+        # The child processes inherit the client sockets of the test, so they
+        # would never see them being closed
+        kwargs.setdefault('connection_timeout', 10)
+        return ThreadedTCPGitServerTests.start_server(self, **kwargs)
+
+
+class PooledTCPGitServerTests(ThreadedTCPGitServerTests):
+
+    server_class = PooledTCPGitServer
+
+    def start_server(self, **kwargs):
+        # Connections are not limited, the workers that serve them are
+        if 'max_connections' in kwargs:
+            kwargs['max_workers'] = kwargs.pop('max_connections')
+        return ThreadedTCPGitServerTests.start_server(self, **kwargs)
+
+    def test_shutdown_while_busy(self):
+        port = self.start_server(max_connections=1)
+        conn1 = self.connect(port)
+        self.assertTrue(self.is_served(conn1[0], 5))
+        conn2 = self.connect(port)
+        self.assertFalse(self.is_served(conn2[0]))
+        self._server.server_close()
+        # The request that was waiting for a worker is still served
+        self.finish(*conn1)
+        self.assertTrue(self.is_served(conn2[0], 5))
+        self.finish(*conn2)
+
+    def test_idle_connections(self):
+        port = self.start_server(max_connections=2)
+        idle = []
+        for i in range(50):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(('localhost', port))
+            self._sockets.append(sock)
+            idle.append(sock)
+        # Clients that have not sent a request don't hold up a worker
+        conn1 = self.connect(port)
+        conn2 = self.connect(port)
+        self.assertTrue(self.is_served(conn1[0], 5))
+        self.assertTrue(self.is_served(conn2[0], 5))
+        self.finish(*conn1)
+        self.finish(*conn2)
+
+    def test_shutdown_gracefully(self):
+        port = self.start_server()
+        sock, proto = self.connect(port)
+        self.assertTrue(self.is_served(sock, 5))
+        server = self._server
+        self._server = None
+        self.assertFalse(server.shutdown_gracefully(0.1))
+        self.assertRaises(socket.error, self.connect, port)
+        # The connection that was still being served is dropped
+        list(proto.read_pkt_seq())
+        self.assertEquals('', sock.recv(1))
+
+    def test_handle_error(self):
+        self.start_server()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            try:
+                raise ValueError('handler failed')
+            except ValueError:
+                self._server.handle_error()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('ValueError: handler failed' in output)
+
+    def test_shutdown_gracefully_finished(self):
+        port = self.start_server()
+        conn = self.connect(port)
+        self.finish(*conn)
+        server = self._server
+        self._server = None
+        self.assertTrue(server.shutdown_gracefully(5))
@@ -0,0 +1,217 @@
+# test_walk.py -- Tests for commit walking functionality.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for commit walking functionality."""
+
+import shutil
+import tempfile
+from unittest import TestCase
+
+from dulwich.errors import (
+    MissingCommitError,
+    NotCommitError,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.walk import (
+    ORDER_TOPO,
+    Walker,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_commit,
+    make_object,
+    )
+
+
+class WalkerTest(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store = MemoryObjectStore()
+
+    def make_commits(self, commit_spec, **kwargs):
+        return build_commit_graph(self.store, commit_spec, **kwargs)
+
+    def make_linear_commits(self, num_commits, **kwargs):
+        commit_spec = []
+        for i in xrange(1, num_commits + 1):
+            c = [i]
+            if i > 1:
+                c.append(i - 1)
+            commit_spec.append(c)
+        return self.make_commits(commit_spec, **kwargs)
+
+    def assertWalkYields(self, expected, *args, **kwargs):
+        walker = Walker(self.store, *args, **kwargs)
+        self.assertEquals([c.id for c in expected],
+                          [c.id for c in walker])
+
+    def test_linear(self):
+        c1, c2, c3 = self.make_linear_commits(3)
+        self.assertWalkYields([c1], [c1.id])
+        self.assertWalkYields([c2, c1], [c2.id])
+        self.assertWalkYields([c3, c2, c1], [c3.id])
+        self.assertWalkYields([c3, c2, c1], [c3.id, c1.id])
+        self.assertWalkYields([c3, c2], [c3.id], exclude=[c1.id])
+        self.assertWalkYields([c3, c2], [c3.id, c1.id], exclude=[c1.id])
+        self.assertWalkYields([c3], [c3.id, c1.id], exclude=[c2.id])
+        self.assertWalkYields([], [c3.id], exclude=[c3.id])
+
+    def test_missing(self):
+        c1, = self.make_linear_commits(1)
+        self.assertRaises(MissingCommitError, Walker, self.store, ["a" * 40])
+        self.assertRaises(NotCommitError, Walker, self.store, [c1.tree])
+
+    def test_missing_excluded(self):
+        c1, c2 = self.make_linear_commits(2)
+        self.assertWalkYields([c2, c1], [c2.id], exclude=["a" * 40])
+        # The parent of an excluded commit is missing, as for the haves of
+        # a shallow client
+        orphan = make_commit(parents=["b" * 40], commit_time=50)
+        self.store.add_object(orphan)
+        self.assertWalkYields([c2], [c2.id], exclude=[orphan.id, c1.id])
+        self.assertWalkYields([c2, c1], [c2.id], exclude=[orphan.id])
+
+    def test_branch(self):
+        c1, x2, x3, y4 = self.make_commits([[1], [2, 1], [3, 2], [4, 1]])
+        self.assertWalkYields([x3, x2, c1], [x3.id])
+        self.assertWalkYields([y4, c1], [y4.id])
+        self.assertWalkYields([y4, x2, c1], [y4.id, x2.id])
+        self.assertWalkYields([y4, x2], [y4.id, x2.id], exclude=[c1.id])
+        self.assertWalkYields([y4, x3], [y4.id, x3.id], exclude=[x2.id])
+        self.assertWalkYields([y4], [y4.id], exclude=[x3.id])
+        self.assertWalkYields([x3, x2], [x3.id], exclude=[y4.id])
+
+    def test_merge(self):
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 1], [4, 2, 3]])
+        self.assertWalkYields([c4, c3, c2, c1], [c4.id])
+        self.assertWalkYields([c3, c1], [c3.id])
+        self.assertWalkYields([c2, c1], [c2.id])
+        self.assertWalkYields([c4, c3], [c4.id], exclude=[c2.id])
+        self.assertWalkYields([c4, c2], [c4.id], exclude=[c3.id])
+
+    def test_max_entries(self):
+        c1, c2, c3 = self.make_linear_commits(3)
+        self.assertWalkYields([c3, c2, c1], [c3.id], max_entries=3)
+        self.assertWalkYields([c3, c2], [c3.id], max_entries=2)
+        self.assertWalkYields([c3], [c3.id], max_entries=1)
+        self.assertWalkYields([], [c3.id], max_entries=0)
+
+    def test_since(self):
+        c1, c2, c3 = self.make_linear_commits(3)
+        self.assertWalkYields([c3, c2, c1], [c3.id], since=-1)
+        self.assertWalkYields([c3, c2, c1], [c3.id], since=0)
+        self.assertWalkYields([c3, c2], [c3.id], since=1)
+        self.assertWalkYields([c3, c2], [c3.id], since=100)
+        self.assertWalkYields([c3], [c3.id], since=101)
+        self.assertWalkYields([], [c3.id], since=201)
+
+    def test_until(self):
+        c1, c2, c3 = self.make_linear_commits(3)
+        self.assertWalkYields([], [c3.id], until=-1)
+        self.assertWalkYields([c1], [c3.id], until=0)
+        self.assertWalkYields([c2, c1], [c3.id], until=100)
+        self.assertWalkYields([c3, c2, c1], [c3.id], until=200)
+
+    def test_out_of_order_times(self):
+        # Commit 3 has an earlier commit time than its parent 2
+        c1, c2, c3 = self.make_commits([[1], [2, 1], [3, 2]],
+                                       attrs={3: {'commit_time': 50}})
+        self.assertWalkYields([c2, c3, c1], [c2.id, c3.id])
+
+    def test_topo_order(self):
+        # Commit 3 is older than its parent 2, which is also reached through 4
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 2], [4, 2]],
+            attrs={3: {'commit_time': 10}, 4: {'commit_time': 200}})
+        self.assertWalkYields([c4, c2, c3, c1], [c4.id, c3.id])
+        self.assertWalkYields([c4, c3, c2, c1], [c4.id, c3.id],
+                              order=ORDER_TOPO)
+        self.assertWalkYields([c4, c3], [c4.id, c3.id], order=ORDER_TOPO,
+                              max_entries=2)
+
+    def test_invalid_order(self):
+        self.assertRaises(ValueError, Walker, self.store, [], order='foo')
+
+    def test_paths(self):
+        blob_a1 = make_object(Blob, data='a1')
+        blob_b2 = make_object(Blob, data='b2')
+        blob_a3 = make_object(Blob, data='a3')
+        blob_b3 = make_object(Blob, data='b3')
+        c1, c2, c3 = self.make_linear_commits(
+            3, trees={1: [('a', blob_a1)],
+                      2: [('a', blob_a1), ('x/b', blob_b2)],
+                      3: [('a', blob_a3), ('x/b', blob_b3)]})
+        self.assertWalkYields([c3, c2, c1], [c3.id])
+        self.assertWalkYields([c3, c1], [c3.id], paths=['a'])
+        self.assertWalkYields([c3, c2], [c3.id], paths=['x/b'])
+        self.assertWalkYields([c3, c2], [c3.id], paths=['x'])
+        self.assertWalkYields([c3, c2], [c3.id], paths=['x/'])
+        self.assertWalkYields([], [c3.id], paths=['y'])
+        self.assertWalkYields([c3, c2, c1], [c3.id], paths=['a', 'x'])
+
+    def test_paths_merge(self):
+        blob_a1 = make_object(Blob, data='a1')
+        blob_a2 = make_object(Blob, data='a2')
+        blob_a3 = make_object(Blob, data='a3')
+        x1, y2, m3, m4 = self.make_commits(
+            [[1], [2], [3, 1, 2], [4, 1, 2]],
+            trees={1: [('a', blob_a1)],
+                   2: [('a', blob_a2)],
+                   3: [('a', blob_a3)],
+                   4: [('a', blob_a1)]})
+        # Changed compared to both parents
+        self.assertWalkYields([m3, y2, x1], [m3.id], paths=['a'])
+        # Same as one of the parents
+        self.assertWalkYields([y2, x1], [m4.id], paths=['a'])
+
+    def test_shallow(self):
+        c1, c2, c3, c4 = self.make_commits([[1], [2, 1], [3, 2], [4, 1]])
+        self.assertWalkYields([c3, c2], [c3.id], shallow=[c2.id])
+        # 1 is still reached through 4
+        self.assertWalkYields([c4, c3, c2, c1], [c4.id, c3.id],
+                              shallow=[c2.id])
+        # The parents of an excluded shallow commit are not excluded
+        self.assertWalkYields([c3, c2, c1], [c3.id], exclude=[c4.id],
+                              shallow=[c4.id])
+        self.assertWalkYields([c3, c2], [c3.id], shallow=[c2.id],
+                              order=ORDER_TOPO)
+
+
+class CommitGraphWalkerTest(WalkerTest):
+    """Runs the walker tests against a store with a commit-graph."""
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.store_dir = tempfile.mkdtemp()
+        self.store = DiskObjectStore.init(self.store_dir)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        shutil.rmtree(self.store_dir)
+
+    def make_commits(self, commit_spec, **kwargs):
+        commits = build_commit_graph(self.store, commit_spec, **kwargs)
+        self.store.write_commit_graph([c.id for c in commits],
+                                      changed_paths=True)
+        return commits
@@ -19,20 +19,57 @@
 """Tests for the Git HTTP server."""
 
 from cStringIO import StringIO
+import gzip
+import os
 import re
+import shutil
+import tempfile
+import threading
+import time
 from unittest import TestCase
+import zlib
 
+from dulwich.errors import (
+    GitProtocolError,
+    HangupException,
+    )
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    )
 from dulwich.objects import (
     Blob,
     )
+from dulwich.server import (
+    DictBackend,
+    ReceivePackHandler,
+    UploadPackHandler,
+    UploadPackV2Handler,
+    )
+from dulwich.tests.utils import (
+    make_object,
+    open_repo,
+    tear_down_repo,
+    )
 from dulwich.web import (
     HTTP_OK,
+    HTTP_PARTIAL_CONTENT,
+    HTTP_NOT_MODIFIED,
     HTTP_NOT_FOUND,
     HTTP_FORBIDDEN,
+    HTTP_RANGE_NOT_SATISFIABLE,
+    date_time_string,
+    parse_range,
     send_file,
+    get_handler_class,
     get_info_refs,
+    get_loose_object,
+    get_request_body,
     handle_service_request,
+    _ChunkedFile,
+    _GzipFile,
     _LengthLimitedFile,
+    _StreamingOutput,
     HTTPGitRequest,
     HTTPGitApplication,
     )
@@ -91,6 +128,10 @@ class DumbHandlersTestCase(WebTestCase):
         self.assertEquals(HTTP_NOT_FOUND, self._status)
         self.assertTrue(f.closed)
 
+    def test_date_time_string(self):
+        self.assertEquals('Fri, 01 Jan 2010 00:00:00 GMT',
+                          date_time_string(1262304000))
+
     def test_get_info_refs(self):
         self._environ['QUERY_STRING'] = ''
 
@@ -151,6 +192,166 @@ class DumbHandlersTestCase(WebTestCase):
                           list(get_info_refs(self._req, TestBackend(), mat)))
 
 
+class SendFileTestCase(WebTestCase):
+
+    def setUp(self):
+        WebTestCase.setUp(self)
+        self._tempdir = tempfile.mkdtemp()
+        self._path = os.path.join(self._tempdir, 'file')
+        f = open(self._path, 'wb')
+        try:
+            f.write('0123456789')
+        finally:
+            f.close()
+        os.utime(self._path, (1262304000, 1262304000))
+        self._last_modified = 'Fri, 01 Jan 2010 00:00:00 GMT'
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+        WebTestCase.tearDown(self)
+
+    def send(self):
+        self._file = open(self._path, 'rb')
+        return ''.join(send_file(self._req, self._file, 'text/plain'))
+
+    def test_headers(self):
+        self.assertEquals('0123456789', self.send())
+        self.assertEquals(HTTP_OK, self._status)
+        self.assertTrue(('Content-Length', '10') in self._headers)
+        self.assertTrue(('Last-Modified', self._last_modified) in
+                        self._headers)
+        self.assertTrue(('Accept-Ranges', 'bytes') in self._headers)
+        self.assertTrue(self._file.closed)
+
+    def test_file_wrapper(self):
+        wrapped = []
+        def file_wrapper(f, block_size):
+            wrapped.append(f)
+            return iter(lambda: f.read(block_size), '')
+        self._environ['wsgi.file_wrapper'] = file_wrapper
+        self._environ['HTTP_RANGE'] = 'bytes=4-'
+        self.assertEquals('456789', self.send())
+        self.assertEquals([self._file], wrapped)
+        self.assertEquals(HTTP_PARTIAL_CONTENT, self._status)
+        self.assertTrue(('Content-Range', 'bytes 4-9/10') in self._headers)
+        self.assertTrue(('Content-Length', '6') in self._headers)
+
+    def test_range(self):
+        self._environ['HTTP_RANGE'] = 'bytes=2-4'
+        self.assertEquals('234', self.send())
+        self.assertEquals(HTTP_PARTIAL_CONTENT, self._status)
+        self.assertTrue(('Content-Range', 'bytes 2-4/10') in self._headers)
+        self.assertTrue(('Content-Length', '3') in self._headers)
+        self.assertTrue(self._file.closed)
+
+    def test_range_not_satisfiable(self):
+        self._environ['HTTP_RANGE'] = 'bytes=10-'
+        self._req.cache_forever()
+        self.assertEquals('Requested range not satisfiable', self.send())
+        self.assertEquals(HTTP_RANGE_NOT_SATISFIABLE, self._status)
+        self.assertEquals(set([('Content-Type', 'text/plain'),
+                               ('Content-Range', 'bytes */10')]),
+                          set(self._headers))
+        self.assertTrue(self._file.closed)
+
+    def test_if_range(self):
+        self._environ['HTTP_RANGE'] = 'bytes=2-4'
+        self._environ['HTTP_IF_RANGE'] = self._last_modified
+        self.assertEquals('234', self.send())
+        # The file changed since the client got the other parts
+        self._environ['HTTP_IF_RANGE'] = 'Thu, 31 Dec 2009 00:00:00 GMT'
+        self.assertEquals('0123456789', self.send())
+        self.assertEquals(HTTP_OK, self._status)
+
+
+class ParseRangeTestCase(TestCase):
+
+    def test_ranges(self):
+        self.assertEquals((2, 5), parse_range('bytes=2-4', 10))
+        self.assertEquals((2, 10), parse_range('bytes=2-', 10))
+        self.assertEquals((2, 10), parse_range('bytes=2-20', 10))
+        self.assertEquals((7, 10), parse_range('bytes=-3', 10))
+        self.assertEquals((0, 10), parse_range('bytes=-20', 10))
+
+    def test_not_satisfiable(self):
+        self.assertEquals((10, 10), parse_range('bytes=10-', 10))
+        self.assertEquals((12, 12), parse_range('bytes=12-14', 10))
+        self.assertEquals((10, 10), parse_range('bytes=-0', 10))
+
+    def test_whole_file(self):
+        self.assertEquals(None, parse_range(None, 10))
+        self.assertEquals(None, parse_range('items=2-4', 10))
+        self.assertEquals(None, parse_range('bytes=4-2', 10))
+        self.assertEquals(None, parse_range('bytes=a-b', 10))
+        self.assertEquals(None, parse_range('bytes=1-2,4-5', 10))
+
+
+class LooseObjectTestCase(WebTestCase):
+
+    class _TestRepo(object):
+        def __init__(self, object_store):
+            self.object_store = object_store
+
+    def setUp(self):
+        WebTestCase.setUp(self)
+        self._tempdir = tempfile.mkdtemp()
+        self._blob = make_object(Blob, data='loose data')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+        WebTestCase.tearDown(self)
+
+    def get(self, object_store, sha):
+        backend = DictBackend({'/': self._TestRepo(object_store)})
+        mat = re.search('/objects/([0-9a-f]{2})/([0-9a-f]{38})$',
+                        '/objects/%s/%s' % (sha[:2], sha[2:]))
+        return ''.join(get_loose_object(self._req, backend, mat))
+
+    def test_disk(self):
+        object_store = DiskObjectStore.init(self._tempdir)
+        object_store.add_object(self._blob)
+        path = os.path.join(self._tempdir, self._blob.id[:2],
+                            self._blob.id[2:])
+        f = open(path, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        # The file is sent as it is, without being compressed again
+        self.assertEquals(contents, self.get(object_store, self._blob.id))
+        self.assertEquals(HTTP_OK, self._status)
+        self.assertTrue(('ETag', '"%s"' % self._blob.id) in self._headers)
+        self.assertTrue(('Content-Length', str(len(contents))) in
+                        self._headers)
+        self.assertTrue(('Content-Type', 'application/x-git-loose-object') in
+                        self._headers)
+
+    def test_disk_not_modified(self):
+        object_store = DiskObjectStore.init(self._tempdir)
+        object_store.add_object(self._blob)
+        self._environ['HTTP_IF_NONE_MATCH'] = '"%s"' % self._blob.id
+        self.assertEquals('', self.get(object_store, self._blob.id))
+        self.assertEquals(HTTP_NOT_MODIFIED, self._status)
+        self.assertTrue(('ETag', '"%s"' % self._blob.id) in self._headers)
+
+    def test_memory(self):
+        object_store = MemoryObjectStore()
+        object_store.add_object(self._blob)
+        data = self.get(object_store, self._blob.id)
+        self.assertEquals(self._blob.as_raw_string(),
+                          Blob.from_string(zlib.decompress(data).split(
+                              '\x00', 1)[1]).as_raw_string())
+        self.assertEquals(HTTP_OK, self._status)
+        self.assertTrue(('ETag', '"%s"' % self._blob.id) in self._headers)
+
+    def test_not_found(self):
+        object_store = DiskObjectStore.init(self._tempdir)
+        self.get(object_store, self._blob.id)
+        self.assertEquals(HTTP_NOT_FOUND, self._status)
+        self.get(MemoryObjectStore(), self._blob.id)
+        self.assertEquals(HTTP_NOT_FOUND, self._status)
+
+
 class SmartHandlersTestCase(WebTestCase):
 
     class _TestUploadPackHandler(object):
@@ -217,6 +418,36 @@ class SmartHandlersTestCase(WebTestCase):
         self.assertTrue(self._handler.advertise_refs)
         self.assertTrue(self._handler.stateless_rpc)
 
+    def test_get_handler_class(self):
+        self.assertEquals((self._MakeHandler, 0),
+            get_handler_class(self._req, self.services(), 'git-upload-pack'))
+        self._environ['HTTP_GIT_PROTOCOL'] = 'version=2'
+        self.assertEquals((UploadPackV2Handler, 2),
+            get_handler_class(self._req,
+                              {'git-upload-pack': UploadPackHandler},
+                              'git-upload-pack'))
+        self.assertEquals((ReceivePackHandler, 0),
+            get_handler_class(self._req,
+                              {'git-receive-pack': ReceivePackHandler},
+                              'git-receive-pack'))
+        # Custom handlers keep speaking the protocol they know
+        self.assertEquals((self._MakeHandler, 0),
+            get_handler_class(self._req, self.services(), 'git-upload-pack'))
+
+    def test_get_info_refs_v2(self):
+        repo = open_repo('a.git')
+        try:
+            self._environ['QUERY_STRING'] = 'service=git-upload-pack'
+            self._environ['HTTP_GIT_PROTOCOL'] = 'version=2'
+            mat = re.search('.*', '/info/refs')
+            output = ''.join(get_info_refs(self._req,
+                                           DictBackend({'/': repo}), mat))
+        finally:
+            tear_down_repo(repo)
+        # Only the capabilities are advertised
+        self.assertEquals('000eversion 2\n000cls-refs\n'
+                          '0019fetch=shallow filter\n0000', output)
+
 
 class LengthLimitedFileTestCase(TestCase):
     def test_no_cutoff(self):
@@ -235,6 +466,152 @@ class LengthLimitedFileTestCase(TestCase):
         self.assertEquals('', f.read())
 
 
+class ChunkedFileTestCase(TestCase):
+
+    def test_read(self):
+        f = _ChunkedFile(StringIO('3\r\nfoo\r\n6;ext=1\r\nbarbaz\r\n'
+                                  '0\r\nTrailer: x\r\n\r\nrest'))
+        self.assertEquals('foobarbaz', f.read())
+        self.assertEquals('', f.read())
+
+    def test_multiple_reads(self):
+        f = _ChunkedFile(StringIO('3\r\nfoo\r\n3\r\nbar\r\n0\r\n\r\n'))
+        self.assertEquals('fo', f.read(2))
+        self.assertEquals('oba', f.read(3))
+        self.assertEquals('r', f.read(10))
+        self.assertEquals('', f.read(10))
+
+    def test_truncated(self):
+        f = _ChunkedFile(StringIO('6\r\nfoo'))
+        self.assertRaises(IOError, f.read)
+
+    def test_invalid_size(self):
+        f = _ChunkedFile(StringIO('foo\r\n'))
+        self.assertRaises(IOError, f.read)
+
+
+def gzip_data(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class GzipFileTestCase(TestCase):
+
+    def test_read(self):
+        f = _GzipFile(StringIO(gzip_data('foobar')))
+        self.assertEquals('foobar', f.read())
+        self.assertEquals('', f.read())
+
+    def test_multiple_reads(self):
+        data = 'x' * 1000000
+        f = _GzipFile(StringIO(gzip_data(data)))
+        self.assertEquals('xxx', f.read(3))
+        # Not much more than was asked for is decompressed
+        self.assertTrue(len(f._buf) < 100000)
+        self.assertEquals(data[3:], f.read())
+
+    def test_invalid(self):
+        f = _GzipFile(StringIO('foobar'))
+        self.assertRaises(IOError, f.read)
+
+
+class GetRequestBodyTestCase(TestCase):
+
+    def read(self, body, **environ):
+        environ['wsgi.input'] = StringIO(body)
+        return get_request_body(environ).read()
+
+    def test_length(self):
+        self.assertEquals('foo', self.read('foobar', CONTENT_LENGTH='3'))
+        self.assertEquals('', self.read('foobar', CONTENT_LENGTH='0'))
+        self.assertEquals('foobar', self.read('foobar', CONTENT_LENGTH=''))
+
+    def test_terminated(self):
+        self.assertEquals('foobar', self.read('foobar', CONTENT_LENGTH='3',
+            **{'wsgi.input_terminated': True}))
+
+    def test_chunked(self):
+        self.assertEquals('foo', self.read('3\r\nfoo\r\n0\r\n\r\nbar',
+                                           HTTP_TRANSFER_ENCODING='chunked'))
+
+    def test_gzip(self):
+        body = gzip_data('foobar')
+        self.assertEquals('foobar', self.read(body + 'extra',
+            CONTENT_LENGTH=str(len(body)), HTTP_CONTENT_ENCODING='gzip'))
+        chunked = '%x\r\n%s\r\n0\r\n\r\n' % (len(body), body)
+        self.assertEquals('foobar', self.read(chunked,
+            HTTP_TRANSFER_ENCODING='chunked', HTTP_CONTENT_ENCODING='gzip'))
+
+
+class StreamingOutputTestCase(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self._output = _StreamingOutput(chunk_size=3, max_chunks=2)
+        self._written = []
+        self._error = None
+        self._finished = threading.Event()
+
+    def handle(self, chunks, wait=None):
+        try:
+            try:
+                for chunk in chunks:
+                    self._output.write(chunk)
+                    self._written.append(chunk)
+                    if wait is not None:
+                        wait.wait(5)
+                        wait = None
+            except Exception, e:
+                self._error = e
+                raise
+        finally:
+            self._finished.set()
+
+    def test_chunks(self):
+        self._output.start(lambda: self.handle(['a', 'bc', 'def', 'g']))
+        self.assertEquals(['abc', 'def', 'g'], list(self._output))
+
+    def test_streams(self):
+        # The first chunk reaches the client before the handler is done
+        first_read = threading.Event()
+        self._output.start(lambda: self.handle(['abc', 'def'], first_read))
+        chunks = iter(self._output)
+        self.assertEquals('abc', chunks.next())
+        self.assertFalse(self._finished.isSet())
+        first_read.set()
+        self.assertEquals(['def'], list(chunks))
+
+    def test_backpressure(self):
+        self._output.start(lambda: self.handle(['abc'] * 10))
+        chunks = iter(self._output)
+        self.assertEquals('abc', chunks.next())
+        time.sleep(0.1)
+        # Two chunks wait in the queue, and the handler waits to add a third
+        self.assertEquals(3, len(self._written))
+        self.assertEquals(['abc'] * 9, list(chunks))
+
+    def test_client_gone(self):
+        self._output.start(lambda: self.handle(['abc'] * 10))
+        chunks = iter(self._output)
+        chunks.next()
+        chunks.close()
+        self._finished.wait(5)
+        self.assertTrue(isinstance(self._error, HangupException))
+        self.assertTrue(len(self._written) < 10)
+
+    def test_error(self):
+        def handle():
+            self._output.write('abc')
+            raise GitProtocolError('foo')
+        self._output.start(handle)
+        chunks = iter(self._output)
+        self.assertEquals('abc', chunks.next())
+        self.assertRaises(GitProtocolError, chunks.next)
+
+
 class HTTPGitRequestTestCase(WebTestCase):
     def test_not_found(self):
         self._req.cache_forever()  # cache headers should be discarded
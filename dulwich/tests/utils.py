@@ -23,7 +23,13 @@
 import os
 import shutil
 import tempfile
+import time
 
+from dulwich.index import commit_tree
+from dulwich.objects import (
+    Commit,
+    Tree,
+    )
 from dulwich.repo import Repo
 
 
@@ -49,3 +55,123 @@ def tear_down_repo(repo):
     """Tear down a test repository."""
     temp_dir = os.path.dirname(repo.path.rstrip(os.sep))
     shutil.rmtree(temp_dir)
+
+
+def backdate_refs(repo, seconds):
+    """Make the refs of a repository look like they were changed a while ago.
+
+    :param repo: Repository on disk
+    :param seconds: Number of seconds ago the refs were changed
+    """
+    mtime = time.time() - seconds
+    paths = [os.path.join(repo.controldir(), 'HEAD'),
+             os.path.join(repo.controldir(), 'packed-refs')]
+    for root, dirs, files in os.walk(os.path.join(repo.controldir(), 'refs')):
+        paths.append(root)
+        paths.extend(os.path.join(root, name) for name in files)
+    for path in paths:
+        if os.path.exists(path):
+            os.utime(path, (mtime, mtime))
+
+
+def make_object(cls, **attrs):
+    """Make an object for testing and assign some members.
+
+    :param cls: The class of the object to create
+    :param attrs: dict of attributes to set on the new object.
+    :return: A newly initialized object of type cls.
+    """
+    obj = cls()
+    for name, value in attrs.iteritems():
+        setattr(obj, name, value)
+    return obj
+
+
+def make_commit(**attrs):
+    """Make a Commit object with a default set of members.
+
+    :param attrs: dict of attributes to overwrite from the default values.
+    :return: A newly initialized Commit object.
+    """
+    default_time = 1262304000 # 2010-01-01 00:00:00
+    all_attrs = {'author': 'Test Author <test@nodomain.com>',
+                 'author_time': default_time,
+                 'author_timezone': 0,
+                 'committer': 'Test Committer <test@nodomain.com>',
+                 'commit_time': default_time,
+                 'commit_timezone': 0,
+                 'message': 'Test message.',
+                 'parents': [],
+                 'tree': '0' * 40}
+    all_attrs.update(attrs)
+    return make_object(Commit, **all_attrs)
+
+
+def build_commit_graph(object_store, commit_spec, trees=None, attrs=None):
+    """Build a commit graph from a concise specification.
+
+    Sample usage:
+    >>> c1, c2, c3 = build_commit_graph(store, [[1], [2, 1], [3, 1, 2]])
+    >>> store[store[c3].parents[0]] == c1
+    True
+
+    If not otherwise specified, commits will refer to the empty tree and have
+    commit times increasing in the same order as the commit spec.
+
+    :param object_store: An ObjectStore to commit objects to.
+    :param commit_spec: An iterable of iterables of ints defining the commit
+        graph. Each entry defines one commit, and entries must be in
+        topological order. The first element of each entry is a commit number,
+        and the remaining elements are its parents. The commit numbers are only
+        meaningful for the call to build_commit_graph.
+    :param trees: An optional dict of commit number -> list of (path, blob)
+        tuples for the tree of that commit; paths are relative to the root.
+    :param attrs: An optional dict of commit number -> dict of attribute ->
+        value for assigning additional values to the commits.
+    :return: The list of commit objects created.
+    :raise ValueError: If an undefined commit identifier is listed as a parent.
+    """
+    if trees is None:
+        trees = {}
+    if attrs is None:
+        attrs = {}
+    commit_time = 0
+    nums = {}
+    commits = []
+
+    empty_tree = Tree()
+    object_store.add_object(empty_tree)
+    for commit in commit_spec:
+        commit_num = commit[0]
+        try:
+            parent_ids = [nums[pn] for pn in commit[1:]]
+        except KeyError, e:
+            missing_parent, = e.args
+            raise ValueError('Unknown parent %i' % missing_parent)
+
+        if commit_num in trees:
+            blobs = []
+            for path, blob in trees[commit_num]:
+                object_store.add_object(blob)
+                blobs.append((path, blob.id, 0100644))
+            tree_id = commit_tree(object_store, blobs)
+        else:
+            tree_id = empty_tree.id
+
+        commit_attrs = {
+            'message': 'Commit %i' % commit_num,
+            'parents': parent_ids,
+            'tree': tree_id,
+            'commit_time': commit_time,
+            }
+        commit_attrs.update(attrs.get(commit_num, {}))
+        commit_obj = make_commit(**commit_attrs)
+
+        # By default, increment the time by a lot. Out-of-order commits should
+        # be closer together than this because their main cause is clock skew.
+        commit_time = commit_attrs['commit_time'] + 100
+        nums[commit_num] = commit_obj.id
+        object_store.add_object(commit_obj)
+        commits.append(commit_obj)
+
+    return commits
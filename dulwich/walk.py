@@ -0,0 +1,286 @@
+# walk.py -- General implementation of walking commits and their contents.
+# Copyright (C) 2026 agent <agent@local>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# or (at your option) any later version of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""General implementation of walking commits and their contents."""
+
+import heapq
+import stat
+
+from dulwich.errors import (
+    MissingCommitError,
+    NotCommitError,
+    )
+from dulwich.objects import (
+    Commit,
+    )
+
+ORDER_DATE = 'date'
+ORDER_TOPO = 'topo'
+
+ALL_ORDERS = (ORDER_DATE, ORDER_TOPO)
+
+
+class Walker(object):
+    """Object for performing a walk of commits in a store.
+
+    Walker objects are initialized with a store and other options and can then
+    be treated as iterators of Commit objects.
+
+    Commits are kept in a priority queue ordered by commit time, so the walk
+    is lazy and costs O(n log n) for n commits. Parents and commit times are
+    looked up through the object store, which can answer them from a
+    commit-graph file; only commits that are returned are read in full.
+
+    The walk can be limited to commits that change certain paths. Such a
+    commit differs from each of its parents in at least one of the paths; the
+    entries for a path are compared by SHA1, so only the trees leading to it
+    are read. If the commit-graph has changed-path Bloom filters, most
+    commits that do not touch the paths are rejected without reading any
+    tree.
+
+    Like git, the walker assumes that commits are not older than their
+    parents when deciding that the remaining commits are all excluded or older
+    than the since cutoff. Commits with badly skewed clocks may therefore be
+    returned even though they are reachable from an excluded commit.
+    """
+
+    def __init__(self, store, include, exclude=None, order=ORDER_DATE,
+                 max_entries=None, since=None, until=None, paths=None,
+                 shallow=None):
+        """Constructor.
+
+        :param store: ObjectStore instance for looking up objects.
+        :param include: Iterable of SHAs of commits to include along with their
+            ancestors.
+        :param exclude: Iterable of SHAs of commits to exclude along with their
+            ancestors, overriding includes.
+        :param order: ORDER_* constant specifying the order of results. Anything
+            other than ORDER_DATE may result in O(n) memory usage and a delay
+            before the first commit is returned.
+        :param max_entries: The maximum number of commits to yield, or None for
+            no limit.
+        :param since: Timestamp to list commits after.
+        :param until: Timestamp to list commits before.
+        :param paths: Iterable of file or directory paths, relative to the
+            root of the tree, to limit the walk to; or None for all commits.
+        :param shallow: Iterable of SHAs of commits whose parents are not
+            walked, such as the shallow commits of a repository. They are
+            treated as root commits.
+        :raise MissingCommitError: If one of the included commits is missing;
+            missing excluded commits are ignored
+        :raise NotCommitError: If one of the included SHAs is not a commit
+        """
+        if order not in ALL_ORDERS:
+            raise ValueError('Unknown walk order %s' % order)
+        self.store = store
+        self.order = order
+        self.max_entries = max_entries
+        self.since = since
+        self.until = until
+        if paths is not None:
+            paths = [p.strip("/") for p in paths]
+        self.paths = paths
+        self._path_entries = {}
+        self.shallow = frozenset(shallow or [])
+
+        self._queue = []
+        self._counter = 0
+        self._seen = set()
+        self._excluded = set()
+        # Queued commits that are not excluded
+        self._interesting = set()
+        graph = store.commit_graph
+        for sha in include:
+            if graph is None or sha not in graph:
+                # Anything in the commit-graph is known to be a commit
+                self._get_commit(sha)
+            self._push(sha)
+        for sha in exclude or []:
+            self._mark_excluded(sha)
+
+    def _get_commit(self, sha):
+        try:
+            commit = self.store[sha]
+        except KeyError:
+            raise MissingCommitError(sha)
+        if not isinstance(commit, Commit):
+            raise NotCommitError(commit)
+        return commit
+
+    def _get_parents(self, sha):
+        if sha in self.shallow:
+            return []
+        return self.store.get_parents(sha)
+
+    def _push(self, sha):
+        if sha in self._seen:
+            return
+        self._seen.add(sha)
+        try:
+            commit_time = self.store.get_commit_time(sha)
+        except KeyError:
+            raise MissingCommitError(sha)
+        self._counter += 1
+        if sha not in self._excluded:
+            self._interesting.add(sha)
+        # The counter keeps the order stable for equal commit times.
+        heapq.heappush(self._queue, (-commit_time, self._counter, sha))
+
+    def _mark_excluded(self, sha):
+        self._excluded.add(sha)
+        self._interesting.discard(sha)
+        try:
+            self._push(sha)
+        except MissingCommitError:
+            # Excluded commits may be missing, for example those at the edge
+            # of a shallow history; they are treated as roots.
+            pass
+
+    def _next_sha(self):
+        """Return the next commit SHA and commit time in date order."""
+        while self._interesting:
+            neg_time, _, sha = heapq.heappop(self._queue)
+            commit_time = -neg_time
+            parents = self._get_parents(sha)
+            if sha in self._excluded:
+                for parent in parents:
+                    self._mark_excluded(parent)
+                continue
+            self._interesting.remove(sha)
+            if self.since is not None and commit_time < self.since:
+                # Everything left in the queue is older
+                return None
+            for parent in parents:
+                self._push(parent)
+            if self.until is not None and commit_time > self.until:
+                continue
+            if self.paths is not None and not self._changes_paths(sha,
+                                                                  parents):
+                continue
+            return sha, commit_time
+        return None
+
+    def _get_tree(self, sha):
+        graph = self.store.commit_graph
+        if graph is not None:
+            try:
+                return graph.get_tree(sha)
+            except KeyError:
+                pass
+        return self.store[sha].tree
+
+    def _lookup_path(self, tree_sha, path):
+        """Find the SHA1 of the entry for a path in a tree, or None."""
+        if not path:
+            return tree_sha
+        key = (tree_sha, path)
+        try:
+            return self._path_entries[key]
+        except KeyError:
+            pass
+        name, _, rest = path.partition("/")
+        try:
+            mode, sha = self.store[tree_sha][name]
+        except KeyError:
+            sha = None
+        else:
+            if rest:
+                if stat.S_ISDIR(mode):
+                    sha = self._lookup_path(sha, rest)
+                else:
+                    sha = None
+        self._path_entries[key] = sha
+        return sha
+
+    def _changes_paths(self, sha, parents):
+        """Check whether a commit changes the walked paths.
+
+        A commit is considered to change the paths unless there is a parent
+        that has the same entries for all of them.
+        """
+        graph = self.store.commit_graph
+        if parents and graph is not None:
+            for path in self.paths:
+                if graph.path_maybe_changed(sha, path):
+                    break
+            else:
+                # Same as the first parent
+                return False
+        tree = self._get_tree(sha)
+        entries = [self._lookup_path(tree, path) for path in self.paths]
+        if not parents:
+            return entries != [None] * len(entries)
+        for parent in parents:
+            parent_tree = self._get_tree(parent)
+            if entries == [self._lookup_path(parent_tree, path)
+                           for path in self.paths]:
+                return False
+        return True
+
+    def _iter_date_order(self):
+        while True:
+            entry = self._next_sha()
+            if entry is None:
+                return
+            yield entry[0]
+
+    def _iter_topo_order(self):
+        """Iterate over the walked commits so that children come first.
+
+        All commits are collected first; then commits are emitted once all
+        their children have been, newest first.
+        """
+        shas = list(self._iter_date_order())
+        positions = {}
+        parents = {}
+        num_children = dict.fromkeys(shas, 0)
+        for i, sha in enumerate(shas):
+            positions[sha] = i
+            parents[sha] = [p for p in self._get_parents(sha)
+                            if p in num_children]
+            for parent in parents[sha]:
+                num_children[parent] += 1
+        # Commits are ordered by their position in the date ordered list.
+        ready = [positions[sha] for sha in shas if num_children[sha] == 0]
+        heapq.heapify(ready)
+        while ready:
+            sha = shas[heapq.heappop(ready)]
+            yield sha
+            for parent in parents[sha]:
+                num_children[parent] -= 1
+                if num_children[parent] == 0:
+                    heapq.heappush(ready, positions[parent])
+
+    def iter_shas(self):
+        """Iterate over the SHA1s of the walked commits.
+
+        Unlike iterating over the walker itself, this does not read the
+        commits, which can be avoided if the store has a commit-graph.
+        """
+        if self.order == ORDER_TOPO:
+            shas = self._iter_topo_order()
+        else:
+            shas = self._iter_date_order()
+        for i, sha in enumerate(shas):
+            if self.max_entries is not None and i >= self.max_entries:
+                return
+            yield sha
+
+    def __iter__(self):
+        for sha in self.iter_shas():
+            yield self.store[sha]
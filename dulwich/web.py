@@ -19,24 +19,54 @@
 """HTTP server for dulwich that implements the git smart HTTP protocol."""
 
 from cStringIO import StringIO
+import os
+import Queue
 import re
+import sys
+import threading
 import time
+import zlib
 
 try:
     from urlparse import parse_qs
 except ImportError:
     from dulwich.misc import parse_qs
+from dulwich.errors import (
+    HangupException,
+    )
 from dulwich.protocol import (
     ReceivableProtocol,
+    protocol_version,
     )
 from dulwich.server import (
+    PROTOCOL_V2_HANDLERS,
     ReceivePackHandler,
     UploadPackHandler,
     )
 
 HTTP_OK = '200 OK'
+HTTP_PARTIAL_CONTENT = '206 Partial Content'
+HTTP_NOT_MODIFIED = '304 Not Modified'
 HTTP_NOT_FOUND = '404 Not Found'
 HTTP_FORBIDDEN = '403 Forbidden'
+HTTP_RANGE_NOT_SATISFIABLE = '416 Requested Range Not Satisfiable'
+
+# Size of the blocks in which files are read, if they are not sent by the
+# wsgi.file_wrapper of the server
+SEND_FILE_BLOCK_SIZE = 10240
+
+# Size of the blocks in which the wsgi.file_wrapper of the server reads
+# files, if it can't send them directly from the file descriptor
+FILE_WRAPPER_BLOCK_SIZE = 64 * 1024
+
+# Size of the chunks in which the output of the smart HTTP handlers is sent,
+# and number of chunks that may be waiting to be sent before the handler
+# has to wait for the client
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_CHUNKS = 16
+
+# Number of bytes of a gzip-encoded request body to decompress at once
+GZIP_READ_SIZE = 64 * 1024
 
 
 def date_time_string(timestamp=None):
@@ -48,7 +78,7 @@ def date_time_string(timestamp=None):
     if timestamp is None:
         timestamp = time.time()
     year, month, day, hh, mm, ss, wd, y, z = time.gmtime(timestamp)
-    return '%s, %02d %3s %4d %02d:%02d:%02d GMD' % (
+    return '%s, %02d %3s %4d %02d:%02d:%02d GMT' % (
             weekdays[wd], day, months[month], year, hh, mm, ss)
 
 
@@ -68,22 +98,54 @@ def get_repo(backend, mat):
     return backend.open_repository(url_prefix(mat))
 
 
-def send_file(req, f, content_type):
-    """Send a file-like object to the request output.
+def parse_range(header, size):
+    """Parse the value of a Range header.
 
-    :param req: The HTTPGitRequest object to send output to.
-    :param f: An open file-like object to send; will be closed.
-    :param content_type: The MIME type for the file.
-    :yield: The contents of the file.
+    Only a single byte range is supported; like other servers, the whole file
+    is sent for requests with a header that is invalid or asks for several
+    ranges.
+
+    :param header: The value of the header, or None if there is none
+    :param size: The size of the file in bytes
+    :return: A tuple with the offset of the first byte and the offset just
+        past the last byte, with a first offset of at least size if the range
+        can't be satisfied, or None if the whole file is to be sent
     """
-    if f is None:
-        yield req.not_found('File not found')
-        return
+    if header is None or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec or '-' not in spec:
+        return None
+    first, last = [part.strip() for part in spec.split('-', 1)]
+    try:
+        if not first:
+            # The last bytes of the file
+            length = int(last)
+            if length == 0:
+                return (size, size)
+            return (max(size - length, 0), size)
+        start = int(first)
+        if not last:
+            return (start, max(start, size))
+        end = int(last) + 1
+    except ValueError:
+        return None
+    if end <= start:
+        return None
+    return (start, max(start, min(end, size)))
+
+
+def _send_file_contents(req, f, content_type, status=HTTP_OK, headers=None,
+                        length=None):
     try:
         try:
-            req.respond(HTTP_OK, content_type)
-            while True:
-                data = f.read(10240)
+            req.respond(status, content_type, headers)
+            while length is None or length > 0:
+                if length is None:
+                    data = f.read(SEND_FILE_BLOCK_SIZE)
+                else:
+                    data = f.read(min(length, SEND_FILE_BLOCK_SIZE))
+                    length -= len(data)
                 if not data:
                     break
                 yield data
@@ -93,6 +155,61 @@ def send_file(req, f, content_type):
         f.close()
 
 
+def send_file(req, f, content_type):
+    """Send a file-like object to the request output.
+
+    Files on disk are sent with a Content-Length and a Last-Modified
+    header, and only the byte range asked for in a Range header, so clients
+    can resume interrupted downloads. If the WSGI server has a
+    wsgi.file_wrapper, it sends them, possibly straight from the file
+    descriptor.
+
+    :param req: The HTTPGitRequest object to send output to.
+    :param f: An open file-like object to send; will be closed.
+    :param content_type: The MIME type for the file.
+    :return: An iterable over the contents of the file.
+    """
+    if f is None:
+        return [req.not_found('File not found')]
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, IOError, OSError):
+        # Not a file on disk
+        return _send_file_contents(req, f, content_type)
+    last_modified = date_time_string(st.st_mtime)
+    headers = [('Last-Modified', last_modified), ('Accept-Ranges', 'bytes')]
+    byte_range = None
+    # Only send part of the file if it is still the file the client has
+    # the other parts of
+    if req.environ.get('HTTP_IF_RANGE', last_modified) == last_modified:
+        byte_range = parse_range(req.environ.get('HTTP_RANGE'), st.st_size)
+    if byte_range is None:
+        status = HTTP_OK
+        start, end = 0, st.st_size
+    else:
+        start, end = byte_range
+        if start >= st.st_size:
+            f.close()
+            return [req.range_not_satisfiable(st.st_size)]
+        status = HTTP_PARTIAL_CONTENT
+        headers.append(('Content-Range', 'bytes %d-%d/%d' %
+                        (start, end - 1, st.st_size)))
+    headers.append(('Content-Length', str(end - start)))
+    file_wrapper = req.environ.get('wsgi.file_wrapper')
+    try:
+        if start:
+            f.seek(start)
+    except IOError:
+        f.close()
+        return [req.not_found('Error reading file')]
+    if file_wrapper is not None and end == st.st_size:
+        # The file wrapper sends the file from the current position to its end
+        req.respond(status, content_type, headers)
+        return file_wrapper(f, FILE_WRAPPER_BLOCK_SIZE)
+    return _send_file_contents(req, f, content_type, status, headers,
+                               end - start)
+
+
 def get_text_file(req, backend, mat):
     req.nocache()
     return send_file(req, get_repo(backend, mat).get_named_file(mat.group()),
@@ -102,16 +219,29 @@ def get_text_file(req, backend, mat):
 def get_loose_object(req, backend, mat):
     sha = mat.group(1) + mat.group(2)
     object_store = get_repo(backend, mat).object_store
+    # Objects never change, so their SHA1 is all a client needs to know
+    # whether the copy it has is current
+    etag = '"%s"' % sha
+    f = object_store.open_legacy_loose_object(sha)
+    if f is not None:
+        if req.environ.get('HTTP_IF_NONE_MATCH') == etag:
+            f.close()
+            req.cache_forever()
+            return [req.not_modified(etag)]
+        # The file is what dumb clients expect, so send it as it is
+        req.cache_forever()
+        req.add_header('ETag', etag)
+        return send_file(req, f, 'application/x-git-loose-object')
     if not object_store.contains_loose(sha):
-        yield req.not_found('Object not found')
-        return
+        return [req.not_found('Object not found')]
     try:
         data = object_store[sha].as_legacy_object()
     except IOError:
-        yield req.not_found('Error reading object')
+        return [req.not_found('Error reading object')]
     req.cache_forever()
-    req.respond(HTTP_OK, 'application/x-git-loose-object')
-    yield data
+    req.respond(HTTP_OK, 'application/x-git-loose-object',
+                [('ETag', etag)])
+    return [data]
 
 
 def get_pack_file(req, backend, mat):
@@ -128,13 +258,36 @@ def get_idx_file(req, backend, mat):
 
 default_services = {'git-upload-pack': UploadPackHandler,
                     'git-receive-pack': ReceivePackHandler}
+
+
+def get_handler_class(req, services, service):
+    """Find the handler for a service, taking the protocol into account.
+
+    Clients ask for a protocol version in the Git-Protocol header. If they ask
+    for version 2 and the service supports it, its version 2 handler is used.
+
+    :param req: The HTTPGitRequest for the service
+    :param services: Dictionary mapping service names to handler classes
+    :param service: Name of the service
+    :return: Tuple with the handler class, or None if the service is not
+        supported, and the protocol version
+    """
+    handler_cls = services.get(service, None)
+    parameters = req.environ.get('HTTP_GIT_PROTOCOL', '').split(':')
+    if handler_cls is not None and protocol_version(parameters) == 2:
+        v2_handler_cls = PROTOCOL_V2_HANDLERS.get(service, None)
+        if (v2_handler_cls is not None and isinstance(handler_cls, type) and
+            issubclass(v2_handler_cls, handler_cls)):
+            return v2_handler_cls, 2
+    return handler_cls, 0
+
 def get_info_refs(req, backend, mat, services=None):
     if services is None:
         services = default_services
     params = parse_qs(req.environ['QUERY_STRING'])
     service = params.get('service', [None])[0]
     if service and not req.dumb:
-        handler_cls = services.get(service, None)
+        handler_cls, version = get_handler_class(req, services, service)
         if handler_cls is None:
             yield req.forbidden('Unsupported service %s' % service)
             return
@@ -144,8 +297,9 @@ def get_info_refs(req, backend, mat, services=None):
         proto = ReceivableProtocol(StringIO().read, output.write)
         handler = handler_cls(backend, [url_prefix(mat)], proto,
                               stateless_rpc=True, advertise_refs=True)
-        handler.proto.write_pkt_line('# service=%s\n' % service)
-        handler.proto.write_pkt_line(None)
+        if version < 2:
+            handler.proto.write_pkt_line('# service=%s\n' % service)
+            handler.proto.write_pkt_line(None)
         handler.handle()
         yield output.getvalue()
     else:
@@ -199,29 +353,223 @@ class _LengthLimitedFile(object):
     # TODO: support more methods as necessary
 
 
+class _ChunkedFile(object):
+    """Wrapper class to decode a request body sent with chunked encoding.
+
+    WSGI servers that don't decode the chunks themselves pass them on as they
+    are, without a Content-Length; git sends large requests this way.
+    """
+
+    def __init__(self, input):
+        self._input = input
+        self._chunk_avail = 0
+        self._eof = False
+
+    def _next_chunk(self):
+        line = self._input.readline()
+        try:
+            self._chunk_avail = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError('Invalid chunk size %r' % line)
+        if self._chunk_avail == 0:
+            # Skip the trailer
+            line = self._input.readline()
+            while line not in ('', '\r\n', '\n'):
+                line = self._input.readline()
+            self._eof = True
+
+    def read(self, size=-1):
+        ret = []
+        while size != 0 and not self._eof:
+            if self._chunk_avail == 0:
+                self._next_chunk()
+                continue
+            if size < 0 or size > self._chunk_avail:
+                to_read = self._chunk_avail
+            else:
+                to_read = size
+            data = self._input.read(to_read)
+            if not data:
+                raise IOError('Request body ended in the middle of a chunk')
+            self._chunk_avail -= len(data)
+            if size > 0:
+                size -= len(data)
+            if self._chunk_avail == 0:
+                # Skip the line break after the chunk
+                self._input.readline()
+            ret.append(data)
+        return ''.join(ret)
+
+
+class _GzipFile(object):
+    """Wrapper class to decompress a gzip-encoded request body as it is read.
+
+    At most GZIP_READ_SIZE bytes more than asked for are decompressed at a
+    time, however well the body compresses.
+    """
+
+    def __init__(self, input):
+        self._input = input
+        # Expect a gzip header and trailer
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buf = ''
+        self._eof = False
+
+    def _decompress(self, data):
+        try:
+            return self._decompressor.decompress(data, GZIP_READ_SIZE)
+        except zlib.error, e:
+            raise IOError('Invalid gzip request body: %s' % e)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._input.read(GZIP_READ_SIZE)
+            if not data:
+                self._buf += self._decompressor.flush()
+                self._eof = True
+            else:
+                self._buf += self._decompress(data)
+        if size < 0:
+            size = len(self._buf)
+        ret = self._buf[:size]
+        self._buf = self._buf[size:]
+        return ret
+
+
+def get_request_body(environ):
+    """Get a file-like object to read the body of a request from.
+
+    The body is decoded as it is read, so a request body is never held in
+    memory as a whole.
+
+    :param environ: The WSGI environment of the request
+    :return: A file-like object with a read() method that returns the empty
+        string once the body has been read
+    """
+    input = environ['wsgi.input']
+    content_length = environ.get('CONTENT_LENGTH')
+    if environ.get('wsgi.input_terminated'):
+        # The server already takes care of the end of the body
+        pass
+    elif environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+        input = _ChunkedFile(input)
+    elif content_length not in (None, ''):
+        # This is not necessary if this app is run from a conforming WSGI
+        # server. Unfortunately, there's no way to tell that at this point.
+        input = _LengthLimitedFile(input, int(content_length))
+    if environ.get('HTTP_CONTENT_ENCODING', '').lower() in ('gzip', 'x-gzip'):
+        input = _GzipFile(input)
+    return input
+
+
+class _StreamingOutput(object):
+    """Output of a smart HTTP handler, sent to the client as it is written.
+
+    The handler runs in a thread of its own, see start(), while the WSGI
+    application iterates over the output. What the handler writes is
+    collected into chunks of about chunk_size bytes, and once max_chunks
+    chunks are waiting the handler blocks until the client has read some,
+    so a slow client slows down the handler rather than making its output
+    pile up in memory.
+    """
+
+    def __init__(self, chunk_size=STREAM_CHUNK_SIZE,
+                 max_chunks=STREAM_MAX_CHUNKS):
+        self._chunk_size = chunk_size
+        self._queue = Queue.Queue(max_chunks)
+        self._pending = []
+        self._pending_size = 0
+        self._closed = False
+        self._exc_info = None
+
+    def write(self, data):
+        if self._closed:
+            # The client went away
+            raise HangupException()
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._queue.put(''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _run(self, handle):
+        try:
+            try:
+                handle()
+                self._flush()
+            except HangupException:
+                if not self._closed:
+                    self._exc_info = sys.exc_info()
+            except:
+                self._exc_info = sys.exc_info()
+        finally:
+            if not self._closed:
+                self._queue.put(None)
+
+    def start(self, handle):
+        """Start running a handler in a thread of its own.
+
+        :param handle: Function that runs the handler
+        """
+        thread = threading.Thread(target=self._run, args=(handle,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _close(self):
+        self._closed = True
+        # Wake up the handler if it is waiting for room in the queue; its
+        # next write fails
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def __iter__(self):
+        finished = False
+        try:
+            chunk = self._queue.get()
+            while chunk is not None:
+                yield chunk
+                chunk = self._queue.get()
+            finished = True
+        finally:
+            if not finished:
+                self._close()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+
 def handle_service_request(req, backend, mat, services=None):
     if services is None:
         services = default_services
     service = mat.group().lstrip('/')
-    handler_cls = services.get(service, None)
+    handler_cls, version = get_handler_class(req, services, service)
     if handler_cls is None:
         yield req.forbidden('Unsupported service %s' % service)
         return
     req.nocache()
     req.respond(HTTP_OK, 'application/x-%s-response' % service)
 
-    output = StringIO()
-    input = req.environ['wsgi.input']
-    # This is not necessary if this app is run from a conforming WSGI server.
-    # Unfortunately, there's no way to tell that at this point.
-    # TODO: git may used HTTP/1.1 chunked encoding instead of specifying
-    # content-length
-    if 'CONTENT_LENGTH' in req.environ:
-        input = _LengthLimitedFile(input, int(req.environ['CONTENT_LENGTH']))
+    output = _StreamingOutput()
+    input = get_request_body(req.environ)
     proto = ReceivableProtocol(input.read, output.write)
     handler = handler_cls(backend, [url_prefix(mat)], proto, stateless_rpc=True)
-    handler.handle()
-    yield output.getvalue()
+    output.start(handler.handle)
+    chunks = iter(output)
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        # Stop the handler if the client went away
+        chunks.close()
 
 
 class HTTPGitRequest(object):
@@ -251,6 +599,14 @@ class HTTPGitRequest(object):
 
         self._start_response(status, self._headers)
 
+    def not_modified(self, etag):
+        """Begin a HTTP 304 response and return an empty body.
+
+        :param etag: The entity tag of the resource the client has
+        """
+        self.respond(HTTP_NOT_MODIFIED, headers=[('ETag', etag)])
+        return ''
+
     def not_found(self, message):
         """Begin a HTTP 404 response and return the text of a message."""
         self._cache_headers = []
@@ -263,6 +619,16 @@ class HTTPGitRequest(object):
         self.respond(HTTP_FORBIDDEN, 'text/plain')
         return message
 
+    def range_not_satisfiable(self, size):
+        """Begin a HTTP 416 response and return the text of a message.
+
+        :param size: The size of the file the range was asked for
+        """
+        self._cache_headers = []
+        self.respond(HTTP_RANGE_NOT_SATISFIABLE, 'text/plain',
+                     [('Content-Range', 'bytes */%d' % size)])
+        return 'Requested range not satisfiable'
+
     def nocache(self):
         """Set the response to never be cached by the client."""
         self._cache_headers = [